@@ -1,8 +1,11 @@
 # ▼▼▼ 修改 1: 匯入 os 和 send_from_directory ▼▼▼
-from flask import Flask, render_template, request, jsonify, url_for, send_from_directory
+from flask import Flask, render_template, request, jsonify, url_for, send_from_directory, session
 import io
 import base64 
 import os # <-- 需要 os 模組來組合路徑
+import secrets
+import time
+import click
 
 try:
     import llm_core
@@ -12,12 +15,65 @@ except ImportError:
     print("錯誤: 找不到 llm_core.py。")
     print("="*50)
 
+from utils.head_to_head import get_head_to_head, describe_pair, export_pair_charts, PAIR_CHARTS
+from utils.momentum import momentum_chart
+from utils.conversation import ConversationStore
+from utils.report_store import open_store, seed_store
+from utils.report_snapshot import (
+    export_snapshot, snapshot_path, snapshot_filename, snapshot_version, remove_snapshot, prune_assets,
+    ASSETS_DIR, ASSET_PREFIXES
+)
+
 #init
 app = Flask(__name__)
 
+# 未設定 FLASK_SECRET_KEY 時自動產生的金鑰 (存在 cache/ 中，重新啟動與多個 worker 共用同一把)
+SECRET_KEY_PATH = os.getenv("FLASK_SECRET_KEY_PATH", os.path.join("cache", "flask_secret_key"))
+
+def load_secret_key(path=SECRET_KEY_PATH):
+    """
+    session cookie 的簽章金鑰：優先使用環境變數 / .env 的 FLASK_SECRET_KEY；
+    未設定時讀取 (或第一次產生) path 中的金鑰並大聲警告，而不是讓整個服務無法啟動
+    """
+    key = os.getenv("FLASK_SECRET_KEY")
+    if key:
+        return key
+    print("="*50)
+    print("警告: 未設定 FLASK_SECRET_KEY，改用自動產生並保存在", path, "的金鑰。")
+    print("部署時請在環境變數或 .env 中設定固定的金鑰 (python -c \"import secrets; print(secrets.token_hex(32))\")，")
+    print("否則刪除這個檔案或換一台機器後，教練的對話會全部遺失。")
+    print("="*50)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        # O_EXCL：多個 worker 同時啟動時只有一個會寫入，其他的讀取同一把金鑰
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # 已產生過 (或其他 worker 剛建立檔案、尚未寫入)：讀取同一把金鑰
+        for _ in range(50):
+            with open(path, encoding="utf-8") as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f"{path} 是空的：請刪除這個檔案後重新啟動，或設定 FLASK_SECRET_KEY。")
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(key)
+    return key
+
+# session cookie 只存放對話 ID，對話內容存在伺服器端
+# 對話 ID 只從簽章過的 cookie 取得，所以金鑰必須固定
+# (每次啟動隨機產生的金鑰在重新啟動或多個 worker 之間不一致，教練的對話會不斷遺失)
+app.secret_key = load_secret_key()
+
+# 每位教練的對話記憶 (LRU + TTL，只保存壓縮後的歷史)
+CONVERSATIONS = ConversationStore()
+
 # ▼▼▼ 修改 2: (Part 1) 定義 report_pics 資料夾的絕對路徑 ▼▼▼
 # app.root_path 指的是 app.py 所在的資料夾
 REPORT_PICS_DIR = os.path.join(app.root_path, 'report_pics')
+# 報告頁面的靜態快照 (flask --app app export-snapshots 輸出)
+SNAPSHOT_DIR = os.path.join(app.root_path, os.getenv("REPORT_SNAPSHOT_DIR", "snapshots"))
 # 
 # 你的資料夾結構現在應該是:
 # badminton_app/
@@ -30,109 +86,129 @@ REPORT_PICS_DIR = os.path.join(app.root_path, 'report_pics')
 # └── templates/
 #
 
-#fake db
-# --- 模擬資料庫  ---
+def get_conversation_id():
+    """
+    取得目前教練的對話 ID：只使用簽章過的 session cookie 中的 ID (不存在時建立)，
+    不接受請求內容指定的 ID，避免讀取或清除其他教練的對話
+    """
+    if 'conversation_id' not in session:
+        session['conversation_id'] = ConversationStore.new_session_id()
+    return session['conversation_id']
+
+# --- 場次 / 報告 / 圖表的 SQLite 儲存 (取代原本的模擬資料) ---
+# 啟動時建立初始資料：場次 (對應 match_id)、R001 與對戰矩陣中每一組對戰的報告
+REPORT_STORE = open_store()
+
+def get_head_to_head_matrix():
+    """取得預先計算的對戰矩陣 (llm_core 未載入時回傳 None)"""
+    if llm_core is None or llm_core.df is None:
+        return None
+    return get_head_to_head(llm_core.df)
+
+seed_store(
+    REPORT_STORE,
+    df=llm_core.df if llm_core is not None else None,
+    h2h=get_head_to_head_matrix(),
+    report_pics_dir=REPORT_PICS_DIR
+)
+
 def get_sessions_from_db():
-    """模擬抓取場次"""
-    return [
-        {"id": "S001", "name": "場次1"},
-    ]
+    """抓取場次 (依 position 排序)"""
+    return REPORT_STORE.list_sessions()
 
 def get_attributes_list():
     """定義可以分析的屬性"""
     return ["ALL (總覽)", "勝率", "失誤率", "出席率", "球落點分布", "球種"]
 
 def get_report_links():
-    """模擬 HTML 中的 links"""
+    """所有報告的連結 (包含對戰矩陣中每一組對戰的報告)"""
     return [
-        {"route": "report_view", "param": "R001", "name": "R001: 趙 vs 陶 (chao_vs_tao)"},
+        {"route": "report_view", "param": report["id"], "name": report["title"]}
+        for report in REPORT_STORE.list_reports()
     ]
 
-def get_main_text(report_id):
-    """ 模擬你要放的主要文字 (根據 ID) """
-    return f"""
-    這裡是報告 {report_id} 的主要文字區塊。
-    周天成的主要得分手段為「落地致勝」，主要失分原因為「出界」、「掛網」和「未過網」。
-
-    關鍵發現：
+def get_pair_for_report(report_id):
+    """報告 ID 若為對戰報告 (H2H-<雜湊>)，回傳 (player, opponent)，否則回傳 None"""
+    h2h = get_head_to_head_matrix()
+    if h2h is None:
+        return None
+    return h2h.parse_report_id(report_id)
 
-    得分手段集中： 周天成的得分手段主要依賴於「落地致勝」（80次），遠高於其他得分方式。這顯示其進攻具備一定威脅性，能直接得分。
-    數據來源：player_win_reasons
-    非受迫性失誤為主： 周天成的失分主要來自於「出界」（74次）、「掛網」（60次）和「未過網」（24次），這些都屬於非受迫性失誤。這暗示周天成在比賽中可能存在穩定性問題，需要減少自身失誤。
-    數據來源：player_lose_reasons
-    
-    總結：
+def get_main_text(report_id):
+    """ 報告的主要文字 (根據 ID，從 REPORT_STORE 讀取) """
+    pair = get_pair_for_report(report_id)
+    if pair is not None:
+        # 對戰報告直接由 (快取的) 對戰矩陣組成，不需要呼叫 LLM，也會隨資料集更新
+        return describe_pair(get_head_to_head_matrix(), *pair)
 
-    周天成具備強勁的進攻能力，但需要透過減少非受迫性失誤來提升比賽穩定性。
-    """
+    report = REPORT_STORE.get_report(report_id)
+    if report is None or not report["main_text"]:
+        return f"找不到報告 {report_id} 的內容。"
+    return report["main_text"]
 
-# ▼▼▼ 修改 3: 調整 get_chart_card_data ▼▼▼
 def get_chart_card_data(report_id):
     """
-    模擬圖表的資料 (根據 ID)
+    報告的圖表 (根據 ID，從 REPORT_STORE 讀取)；
+    image_url 指向 /report-images/，由 serve_report_image() 傳送
     """
-    image_folder_name = ""
-    if report_id == "R001":
-        # 這裡對應到你說的資料夾
-        image_folder_name = "chao_vs_tao" 
-    elif report_id == "R002":
-        image_folder_name = "other" # 假設有另一個
-    else:
-        # 給一個預設值，以防萬一
-        image_folder_name = "default" 
+    charts = REPORT_STORE.report_charts(report_id)
+    pair = get_pair_for_report(report_id)
+    if pair is not None and (not charts or charts[0]["dataset_version"] != llm_core.DATASET_VERSION):
+        # 對戰報告的圖表尚未輸出，或資料集已更新
+        return get_pair_chart_card_data(report_id, *pair)
 
-    # *** 請確保你的 'report_pics/chao_vs_tao/' 資料夾中
-    # *** 真的有 'win_rate.png' 和 'error_rate.png' 這兩個檔案
-    
-    mock_data = [
-        {
-            # 這是關鍵修改：
-            # 網址 (URL) 指向我們即將建立的新路由 /report-images/
-            # Flask 會把這個請求轉發給 serve_report_image() 函式
-            "image_url": f"/report-images/{image_folder_name}/diff_balls.png", 
-            "title": f"{image_folder_name} - 不同球種",
-            "description": "這是從 report_pics 動態載入的球種圖。"
-        },
-        {
-            "image_url": f"/report-images/{image_folder_name}/different_places_score.png",
-            "title": f"{image_folder_name} - 得分分布圖",
-            "description": "這是從 report_pics 動態載入的得分分布圖。"
-        },
-        {
-            "image_url": f"/report-images/{image_folder_name}/opp_lose_reasons.png",
-            "title": f"{image_folder_name} - 得分分析圖",
-            "description": "這是從 report_pics 動態載入的得分分析圖。"
-        },
-        {
-            "image_url": f"/report-images/{image_folder_name}/running.png",
-            "title": f"{image_folder_name} - 得分分析圖",
-            "description": "這是從 report_pics 動態載入的得分分析圖。"
-        },
-        {
-            "image_url": f"/report-images/{image_folder_name}/score_reason.png",
-            "title": f"{image_folder_name} - 得分分析圖",
-            "description": "這是從 report_pics 動態載入的得分分析圖。"
-        },
-        {
-            "image_url": f"/report-images/{image_folder_name}/smash.png",
-            "title": f"{image_folder_name} - 得分分析圖",
-            "description": "這是從 report_pics 動態載入的得分分析圖。"
-        },
+    return [
         {
-            "image_url": f"/report-images/{image_folder_name}/time_error.png",
-            "title": f"{image_folder_name} - 得分分析圖",
-            "description": "這是從 report_pics 動態載入的得分分析圖。"
-        },
+            "image_url": url_for('serve_report_image', path_to_image=chart["path"]),
+            "title": chart["title"],
+            "description": chart["description"],
+        }
+        for chart in charts
     ]
-    
-    # 附註: 更保險的寫法是使用 url_for
-    # path = f'{image_folder_name}/win_rate.png'
-    # mock_data[0]["image_url"] = url_for('serve_report_image', path_to_image=path)
-    # 這樣如果未來你改了 @app.route 的網址，這裡會自動更新。
-    # 不過目前 f-string 的寫法是最直觀的。
-    
-    return mock_data
-# --- ▲▲▲ 修改 3 完畢 ▲▲▲ ---
+
+def get_pair_chart_card_data(report_id, player, opponent):
+    """
+    對戰報告的圖表：由對戰矩陣繪製並存入 report_pics/h2h/<資料版本>/<report_id>/，
+    之後的瀏覽直接沿用已輸出的圖片
+    """
+    h2h = get_head_to_head_matrix()
+    folder = os.path.join("h2h", llm_core.DATASET_VERSION, report_id)
+    export_pair_charts(
+        h2h, player, opponent,
+        out_dir=os.path.join(REPORT_PICS_DIR, folder),
+        font_path_or_name=llm_core.GLOBAL_CHINESE_FONT_PATH_OR_NAME
+    )
+    REPORT_STORE.set_report_charts(report_id, [
+        {
+            "path": f"{folder.replace(os.sep, '/')}/{chart}.png",
+            "title": f"{player} vs {opponent} - {title}",
+            "description": description,
+        }
+        for chart, (title, description) in PAIR_CHARTS.items()
+    ], dataset_version=llm_core.DATASET_VERSION)
+    return get_chart_card_data(report_id)
+
+def get_report_match_ids(report_id):
+    """報告涵蓋的場次：對戰報告為兩人交手的所有場次，其他報告為其場次對應的 match_id"""
+    if llm_core is None or llm_core.momentum is None:
+        return []
+    pair = get_pair_for_report(report_id)
+    if pair is not None:
+        players = llm_core.momentum.drop_duplicates("match_id")
+        same_pair = (
+            ((players["player_a"] == pair[0]) & (players["player_b"] == pair[1]))
+            | ((players["player_a"] == pair[1]) & (players["player_b"] == pair[0]))
+        )
+        return players.loc[same_pair, "match_id"].tolist()
+    report = REPORT_STORE.get_report(report_id)
+    if report is None or not report["session_id"]:
+        return []
+    return REPORT_STORE.session_match_ids(report["session_id"])
+
+def get_momentum_chart_data(report_id):
+    """報告頁面的比賽走勢圖 (整場勝率折線，直接畫在 report.html 中)"""
+    charts = [momentum_chart(llm_core.momentum, match_id) for match_id in get_report_match_ids(report_id)]
+    return [chart for chart in charts if chart is not None]
 
 
 # --- 路由 1: 儀表板首頁 (保持不變) ---
@@ -163,25 +239,47 @@ def api_analyze():
         search_query = data.get('search_query')
         session_id = data.get('session_id')
         attribute = data.get('attribute_name')
+        analysis_mode = data.get('analysis_mode') or 'code'
+        follow_up = bool(data.get('follow_up'))
 
         if not session_id or not attribute:
             return jsonify({"error": "缺少 'session_id' 或 'attribute_name'"}), 400
+        if analysis_mode not in ("code", "tools", "spec", "client"):
+            return jsonify({"error": f"不支援的 analysis_mode: {analysis_mode}"}), 400
         
         print(f"--- 收到 API 請求 ---")
-        print(f"搜尋: {search_query}, 場次: {session_id}, 屬性: {attribute}")
+        print(f"搜尋: {search_query}, 場次: {session_id}, 屬性: {attribute}, 模式: {analysis_mode}, 追問: {follow_up}")
+
+        # 追問時帶入伺服器端保存的 (已壓縮) 歷史；否則開始新的對話
+        conversation_id = get_conversation_id()
+        if not follow_up:
+            CONVERSATIONS.reset(conversation_id)
+        history = CONVERSATIONS.get_history(conversation_id)
         
         result = llm_core.generate_analysis_from_dashboard(
             session_id=session_id,
             attribute=attribute,
-            search_query=search_query
+            search_query=search_query,
+            analysis_mode=analysis_mode,
+            history=history
         )
         
         if result["error"]:
             print(f"AI 執行錯誤: {result['error']}")
+            if result.get("degraded"):
+                # AI 服務暫時無法使用 (斷路器開啟 / 重試用盡) 且沒有先前的結果可用
+                retry_after = max(1, int(llm_core.LLM_CLIENT.breaker.retry_in()))
+                return jsonify({"error": result["error"]}), 503, {"Retry-After": str(retry_after)}
             return jsonify({"error": f"AI 分析失敗: {result['error']}"}), 500
+
+        if result.get("history_user") and result.get("history_model"):
+            CONVERSATIONS.append_turn(conversation_id, result["history_user"], result["history_model"])
         
         image_base64 = None
-        if result["figure"]:
+        if result.get("image_png"):
+            # llm_core 已將圖表轉成 PNG (合併的請求共用同一份，不再重複繪製)
+            image_base64 = base64.b64encode(result["image_png"]).decode('utf-8')
+        elif result["figure"]:
             buf = io.BytesIO()
             result["figure"].savefig(buf, format='png', dpi=150, bbox_inches='tight')
             image_bytes = buf.getvalue()
@@ -191,19 +289,55 @@ def api_analyze():
         return jsonify({
             "status": "success",
             "analysis_text": result["text"], 
-            "chart_image_base64": image_base64 
+            "chart_image_base64": image_base64,
+            # 圖表規格「瀏覽器繪圖」模式：只回傳資料，由 static/scripts.js 繪製
+            "chart_data": result.get("chart_data") if analysis_mode == "client" else None,
+            "conversation_turns": len(CONVERSATIONS.get_history(conversation_id)) // 2,
+            "coalesced": bool(result.get("coalesced")),
+            # AI 服務無法使用時改用先前產生的圖表
+            "stale": bool(result.get("stale")),
+            "warnings": result.get("warnings") or []
         })
 
     except Exception as e:
         print(f"Error in /api/analyze: {e}")
         return jsonify({"error": str(e)}), 500
 
-# --- 路由 3: 報告頁面 (保持不變) ---
-@app.route('/report/<report_id>')
-def report_view(report_id):
+# --- 路由 2a: 清除目前教練的對話記憶 ---
+@app.route('/api/conversation/reset', methods=['POST'])
+def api_conversation_reset():
+    CONVERSATIONS.reset(get_conversation_id())
+    return jsonify({"status": "success"})
+
+# --- 路由 2b: 比賽走勢 / 勝率序列 (JSON；報告頁面的走勢圖由伺服器端直接繪製) ---
+@app.route('/api/momentum/<match_id>', methods=['GET'])
+def api_momentum(match_id):
     """
-    動態報告頁面
+    回傳某場比賽每個回合的勝率與走勢序列 (預先計算，不呼叫 LLM)
     """
+    if llm_core is None or llm_core.momentum is None:
+        return jsonify({"error": "比賽走勢資料尚未載入。"}), 500
+
+    try:
+        match_id_value = float(match_id)
+    except ValueError:
+        return jsonify({"error": f"無效的 match_id: {match_id}"}), 400
+
+    series = llm_core.momentum[llm_core.momentum["match_id"] == match_id_value]
+    if series.empty:
+        return jsonify({"error": f"找不到場次 {match_id}"}), 404
+
+    return jsonify({
+        "status": "success",
+        "match_id": match_id,
+        "player_a": series["player_a"].iloc[0],
+        "player_b": series["player_b"].iloc[0],
+        "rallies": series.drop(columns=["match_id", "player_a", "player_b"]).to_dict(orient="records")
+    })
+
+# --- 路由 3: 報告頁面 ---
+def render_report_page(report_id):
+    """以 report.html 繪製報告頁面 (動態瀏覽與快照輸出共用)"""
     print(f"正在為 {report_id} 生成報告頁面...")
     main_text = get_main_text(report_id)
     chart_items = get_chart_card_data(report_id) # <-- 這裡會抓到新的 URL
@@ -212,9 +346,69 @@ def report_view(report_id):
         'report.html', 
         report_title=f"報告 {report_id} 分析", 
         main_introduction_text=main_text,
-        chart_data_list=chart_items
+        chart_data_list=chart_items,
+        momentum_charts=get_momentum_chart_data(report_id)
     )
 
+def current_dataset_version():
+    """目前載入的資料集版本 (llm_core 未載入時為 None)"""
+    return llm_core.DATASET_VERSION if llm_core is not None else None
+
+@app.route('/report/<report_id>')
+def report_view(report_id):
+    """
+    報告頁面：已輸出且與目前資料集版本相同的靜態快照直接傳送 (不繪製、不查詢)，否則動態繪製；
+    快照已過期 (資料集更新，或舊版輸出沒有版本紀錄) 時，以這次繪製的結果重新輸出快照。
+    ?live=1 可略過快照
+    """
+    if request.args.get('live') == '1' or not snapshot_path(report_id, SNAPSHOT_DIR):
+        return render_report_page(report_id)
+    version = current_dataset_version()
+    if snapshot_version(report_id, SNAPSHOT_DIR) == version and version is not None:
+        return send_from_directory(SNAPSHOT_DIR, snapshot_filename(report_id))
+
+    print(f"報告 {report_id} 的快照已過期，重新輸出...")
+    html = render_report_page(report_id)
+    export_snapshot(report_id, html, resolve_asset_url, SNAPSHOT_DIR, dataset_version=version)
+    return html
+
+@app.route(f'/report/{ASSETS_DIR}/<path:filename>')
+def serve_snapshot_asset(filename):
+    """快照引用的資源檔 (檔名含內容雜湊，內容不會改變，可以長期快取)"""
+    return send_from_directory(os.path.join(SNAPSHOT_DIR, ASSETS_DIR), filename, max_age=365 * 24 * 3600)
+
+def resolve_asset_url(url_path):
+    """快照輸出用：網址路徑 (/report-images/..., /static/...) -> 本機檔案路徑"""
+    folders = {"/report-images/": REPORT_PICS_DIR, "/static/": app.static_folder}
+    for prefix in ASSET_PREFIXES:
+        if url_path.startswith(prefix):
+            root = os.path.realpath(folders[prefix])
+            path = os.path.realpath(os.path.join(root, url_path[len(prefix):]))
+            return path if path.startswith(root + os.sep) else None
+    return None
+
+@app.cli.command('export-snapshots')
+@click.argument('report_ids', nargs=-1)
+@click.option('--remove', is_flag=True, help='刪除指定報告的快照 (改回動態繪製)')
+def export_snapshots_command(report_ids, remove):
+    """
+    將報告凍結成靜態快照 (省略 REPORT_IDS 時輸出所有報告)：
+    flask --app app export-snapshots [R001 H2H-1f3a5c7e9b ...]
+    """
+    report_ids = list(report_ids) or [report["id"] for report in REPORT_STORE.list_reports()]
+    for report_id in report_ids:
+        if remove:
+            remove_snapshot(report_id, SNAPSHOT_DIR)
+            click.echo(f"已刪除快照: {report_id}")
+            continue
+        with app.test_request_context(f'/report/{report_id}'):
+            html = render_report_page(report_id)
+        path = export_snapshot(report_id, html, resolve_asset_url, SNAPSHOT_DIR, dataset_version=current_dataset_version())
+        click.echo(f"已輸出快照: {path}")
+    removed = prune_assets(SNAPSHOT_DIR)
+    if removed:
+        click.echo(f"已刪除 {len(removed)} 個未使用的資源檔。")
+
 # ▼▼▼ 修改 2: (Part 2) 新增 "圖片傳送路由" ▼▼▼
 #
 @app.route('/report-images/<path:path_to_image>')
@@ -4,13 +4,15 @@ System Prompts for BadmintonAI
 """
 
 
-def create_system_prompt(data_schema_info: str, column_definitions_info: str) -> str:
+def create_system_prompt(data_schema_info: str, column_definitions_info: str,
+                         derived_tables_info: str = "") -> str:
     """
     建立給 LLM 的系統指令
 
     Args:
         data_schema_info: DataFrame 的結構資訊（欄位名稱、型態等）
         column_definitions_info: 欄位定義說明
+        derived_tables_info: 執行環境中預先計算好的衍生資料表說明（可為空）
 
     Returns:
         str: 完整的系統指令文字
@@ -24,6 +26,8 @@ def create_system_prompt(data_schema_info: str, column_definitions_info: str) ->
 {data_schema_info}
 2.  **欄位定義:**
 {column_definitions_info}
+3.  **執行環境中已預先計算的衍生資料（可直接使用，不需自行建立）:**
+{derived_tables_info or "（無）"}
 
 **你的程式碼必須嚴格遵守以下規則:**
 
@@ -126,4 +130,83 @@ plt.tight_layout()
 **你的回覆格式:**
 1.  一個簡短的文字說明（1-2句），解釋你將如何分析以及圖表的意涵
 2.  一個 Python 程式碼區塊 (```python ... ```)，完整包含上述所有規範
-"""
\ No newline at end of file
+"""
+
+def create_chart_spec_prompt(data_schema_info: str, column_definitions_info: str, table_columns_info: str) -> str:
+    """
+    建立「圖表規格模式」的系統指令：模型只回傳 JSON 圖表規格，不寫程式碼
+
+    Args:
+        data_schema_info: DataFrame 的結構資訊（欄位名稱、型態等）
+        column_definitions_info: 欄位定義說明
+        table_columns_info: 可查詢的資料表與其欄位
+
+    Returns:
+        str: 完整的系統指令文字
+    """
+    return f"""
+你是一位頂尖的羽球數據科學家。請根據使用者的問題，回傳**一個** JSON 圖表規格，由系統負責查詢資料與繪圖。
+
+**數據資訊:**
+1.  **DataFrame Schema:**
+{data_schema_info}
+2.  **欄位定義:**
+{column_definitions_info}
+3.  **可查詢的資料表:**
+{table_columns_info}
+
+**JSON 圖表規格格式:**
+```json
+{{
+  "chart": "bar | barh | stacked_bar | pie | line",
+  "table": "df | rallies | momentum",
+  "filters": [{{"column": "欄位", "op": "== | != | > | >= | < | <= | in | not_in | notna | isna", "value": "值"}}],
+  "x": "分組欄位 (類別軸)",
+  "series": "第二個分組欄位，產生多個系列 (可省略)",
+  "metric": "count | share | sum | mean | median | max | min",
+  "value_column": "metric 為 sum/mean/median/max/min 時要彙總的欄位",
+  "top_k": 10,
+  "sort": "desc | asc | none",
+  "title": "圖表標題",
+  "x_label": "X軸名稱",
+  "y_label": "Y軸名稱"
+}}
+```
+
+**規則:**
+1.  只能使用上面列出的資料表與欄位；類別值必須與資料中的值完全相同（例如球員全名）。
+2.  比例問題用 `"metric": "share"`；圓餅圖只能有一個系列（不要設定 series）。
+3.  時間或回合序列用 `"chart": "line"` 並設定 `"sort": "none"`。
+4.  標題與軸名稱使用繁體中文。
+
+**你的回覆格式:** 只回傳一個 ```json ... ``` 區塊，不要有任何其他文字。
+"""
+
+def create_tool_calling_prompt(column_definitions_info: str, data_values_info: str) -> str:
+    """
+    建立「工具呼叫模式」的系統指令：模型呼叫經過驗證的分析函數，不寫程式碼
+
+    Args:
+        column_definitions_info: 欄位定義說明
+        data_values_info: 資料中的球員名稱、場次、球種等可用值
+
+    Returns:
+        str: 完整的系統指令文字
+    """
+    return f"""
+你是一位頂尖的羽球數據分析師。系統已提供一組經過驗證的分析函數（工具），請**呼叫這些函數**取得數據來回答使用者的問題，不要撰寫任何程式碼。
+
+**數據資訊:**
+1.  **欄位定義:**
+{column_definitions_info}
+2.  **資料中的可用值:**
+{data_values_info}
+
+**規則:**
+1.  參數值必須與資料中的值完全相同（例如球員全名、球種名稱）；不需要的參數請省略。
+2.  每次查詢的結果都有 `result_id`；需要圖表時，用 `plot_chart` 把最能回答問題的那個結果畫出來（最多一次）。
+3.  取得足夠的數據後，不要再呼叫工具，直接用繁體中文撰寫精簡的數據洞察報告，包含：
+    1.  **直接回答**：直接且明確地回答使用者的問題。
+    2.  **關鍵發現**：從數據中提煉出 1 到 3 個最關鍵的觀察或趨勢。
+    3.  **總結**：用一句話總結分析結果。
+"""
@@ -1,5 +1,7 @@
 import os
 import io
+import json
+import hashlib
 import platform
 import pandas as pd
 from dotenv import load_dotenv
@@ -8,8 +10,29 @@ import traceback # --- [新增]：用於印出詳細錯誤 ---
 
 # --- 關鍵：從你的 Streamlit 專案中，把這些檔案/資料夾複製過來 ---
 try:
-    from utils.data_loader import load_all_data
-    from config.prompts import create_system_prompt
+    from utils.data_loader import load_all_data, stamp_dataset_version
+    from utils.rally_features import get_rally_table, RALLY_TABLE_DESCRIPTION
+    from utils.court_spatial import (
+        court_grid, area_counts, composite_grids, draw_court_heatmap, COURT_SPATIAL_DESCRIPTION
+    )
+    from utils.shot_patterns import get_shot_pattern_index, SHOT_PATTERN_DESCRIPTION
+    from utils.momentum import get_momentum_table, MOMENTUM_DESCRIPTION
+    from utils.head_to_head import get_head_to_head, HEAD_TO_HEAD_DESCRIPTION
+    from utils.movement import get_movement_load, MOVEMENT_DESCRIPTION
+    from utils.code_checker import build_column_catalog, validate_and_repair, CodeValidationError
+    from utils.chart_spec import (
+        parse_chart_spec, validate_chart_spec, execute_chart_spec, render_chart, chart_payload, ChartSpecError
+    )
+    from utils.analytics import (
+        tool_declarations, call_analytics, result_to_response, PLOT_TOOL_NAME
+    )
+    from utils.analysis_memory import AnalysisMemory, normalize_question
+    from utils.single_flight import SingleFlight
+    from utils.llm_client import ResilientLLM, LLMUnavailableError
+    from utils.report_store import open_store, content_hash, DASHBOARD_CHART_DIR
+    from utils.result_summary import summarize_results, is_summary_candidate, estimate_tokens
+    from utils.conversation import compact_history, compact_model_turn, HISTORY_TOKEN_BUDGET
+    from config.prompts import create_system_prompt, create_chart_spec_prompt, create_tool_calling_prompt
 except ImportError:
     print("="*50)
     print("錯誤：請確保 'utils' 和 'config' 資料夾存在。")
@@ -37,6 +60,59 @@ if df is None:
     print("警告 [llm_core]: 'all_dataset.csv' 檔案載入失敗。")
     print("="*50)
 
+# --- 1b. [新增] 預先計算的衍生資料表 (注入 exec 環境) ---
+rallies = get_rally_table(df)
+shot_patterns = get_shot_pattern_index(df)
+momentum = get_momentum_table(df)
+head_to_head = get_head_to_head(df)
+movement = get_movement_load(df)
+DERIVED_TABLES_INFO = "\n".join([
+    RALLY_TABLE_DESCRIPTION,
+    COURT_SPATIAL_DESCRIPTION,
+    SHOT_PATTERN_DESCRIPTION,
+    MOMENTUM_DESCRIPTION,
+    HEAD_TO_HEAD_DESCRIPTION,
+    MOVEMENT_DESCRIPTION,
+])
+if rallies is not None:
+    print(f"[llm_core DEBUG] 回合特徵表已建立: {len(rallies)} 個回合。")
+
+# 供靜態檢查與圖表規格模式使用的欄位 / 類別值目錄
+CHART_SPEC_FRAMES = {"df": df, "rallies": rallies, "momentum": momentum}
+COLUMN_CATALOG = build_column_catalog(CHART_SPEC_FRAMES)
+CHART_SPEC_TABLES_INFO = "\n".join(
+    f"- `{name}`: {', '.join(columns)}" for name, columns in COLUMN_CATALOG.items()
+)
+
+# 成功分析的相似問題索引（提到的球員 / 球種不同時不會直接重用）
+ANALYSIS_MEMORY_PATH = os.getenv("ANALYSIS_MEMORY_PATH", "cache/analysis_memory.json")
+ANALYSIS_MEMORY = AnalysisMemory(
+    ANALYSIS_MEMORY_PATH,
+    entity_values=[] if df is None else list(df["player"].dropna().unique()) + list(df["type"].dropna().unique()),
+)
+
+# 資料集版本（相同請求合併的 key 之一）與進行中的儀表板分析
+DATASET_VERSION = stamp_dataset_version(df) if df is not None else None
+DASHBOARD_FLIGHT = SingleFlight()
+
+# 場次 (對應的 match_id)、圖表與分析結果的 SQLite 儲存 (與 app.py 共用)
+REPORT_STORE = open_store()
+REPORT_PICS_DIR = "report_pics"
+ALL_MATCH_IDS = [] if df is None else sorted(int(m) for m in df["match_id"].dropna().unique())
+
+# 洞察提示中「核心數據變數」的 token 上限
+SUMMARY_TOKEN_BUDGET = 1200
+# 存入對話歷史的關鍵結果 token 上限
+KEY_RESULT_TOKEN_BUDGET = 150
+
+# 供工具呼叫模式使用：資料中的可用參數值
+MAX_TOOL_ROUNDS = 5
+ANALYTICS_VALUES_INFO = "" if df is None else "\n".join([
+    f"- 球員 (player): {', '.join(sorted(df['player'].dropna().unique()))}",
+    f"- 場次 (match_id): {', '.join(str(int(m)) for m in sorted(df['match_id'].dropna().unique()))}",
+    f"- 球種 (shot_type): {', '.join(df['type'].value_counts().index)}",
+])
+
 # --- 2. [升級] 設定模型與 API Key ---
 # --- 使用不同的模型來執行不同任務，更具成本效益 ---
 ENHANCER_MODEL = "gemini-2.0-flash" # 用於快速、便宜的問題強化
@@ -58,6 +134,15 @@ else:
     except Exception as e:
         print(f"[llm_core DEBUG] Google AI SDK 設定失敗: {e}")
 
+# --- 2b. [新增] 容錯的 LLM 呼叫層 (逾時、429 退避、hedge、並行上限、斷路器) ---
+# 所有模型呼叫都經過 LLM_CLIENT；供應商故障時斷路器開啟，改用快取 / 先前的結果
+LLM_CLIENT = ResilientLLM(
+    timeout=float(os.getenv("LLM_TIMEOUT_SECONDS", "60")),
+    max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", "3")),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+    hedge=os.getenv("LLM_HEDGE", "0") == "1",
+)
+
 # --- 3. 自動搜尋中文字型 (保持不變) ---
 def get_chinese_font():
     """在系統中自動搜尋可用的中文字型"""
@@ -99,9 +184,11 @@ GLOBAL_CHINESE_FONT_PATH_OR_NAME = get_chinese_font()
 
 
 # --- 5. [新增] 移植自 Streamlit 的「提示詞強化」邏輯 ---
-def enhance_user_prompt(original_prompt: str, schema_info: str) -> str:
+def enhance_user_prompt(original_prompt: str, schema_info: str, warnings: list = None) -> str:
     """
     使用 LLM 將模糊的使用者問題轉化為清晰的分析任務。
+    [升級] 強化失敗時仍使用原始問題，但會記錄失敗原因 (加入 warnings)，不再默默吞掉錯誤；
+    AI 服務無法使用時直接拋出 LLMUnavailableError，不再繼續後面注定失敗的呼叫。
     """
     print(f"[llm_core DEBUG] 正在強化提示詞: {original_prompt}")
     
@@ -126,7 +213,8 @@ def enhance_user_prompt(original_prompt: str, schema_info: str) -> str:
     try:
         model = genai.GenerativeModel(ENHANCER_MODEL)
         # --- [關鍵] 使用低溫 (temperature=0.2) 確保轉譯的準確性與一致性 ---
-        response = model.generate_content(
+        response = LLM_CLIENT.generate(
+            model,
             [
                 {'role': 'user', 'parts': [enhancement_system_prompt]},
                 {'role': 'model', 'parts': ["好的，我會將使用者的問題轉化為清晰的任務。請給我使用者的問題。"]},
@@ -135,41 +223,152 @@ def enhance_user_prompt(original_prompt: str, schema_info: str) -> str:
             generation_config={"temperature": 0.2} 
         )
         enhanced_prompt = response.text.strip()
-        print(f"[llm_core DEBUG] 強化後的提示詞: {enhanced_prompt}")
-        return enhanced_prompt
+    except LLMUnavailableError:
+        raise
     except Exception as e:
-        print(f"[llm_core DEBUG] 提示詞強化失敗: {e}。將使用原始提示詞。")
+        # 例如 400 錯誤，或回應被安全機制擋下 (response.text 拋出 ValueError)
+        message = f"提示詞強化失敗 ({type(e).__name__}: {e})，已使用原始問題。"
+        print(f"[llm_core DEBUG] {message}")
+        if warnings is not None:
+            warnings.append(message)
+        return original_prompt
+    if not enhanced_prompt:
+        message = "提示詞強化回傳空白內容，已使用原始問題。"
+        print(f"[llm_core DEBUG] {message}")
+        if warnings is not None:
+            warnings.append(message)
         return original_prompt
+    print(f"[llm_core DEBUG] 強化後的提示詞: {enhanced_prompt}")
+    return enhanced_prompt
 
 # --- 6. [新增] 移植自 Streamlit 的「結果格式化」邏輯 ---
-def _format_summary_info_for_prompt(summary_info: dict) -> str:
+def _format_summary_info_for_prompt(summary_info: dict, code: str = None,
+                                    token_budget: int = SUMMARY_TOKEN_BUDGET) -> str:
     """
-    將 Python 執行結果的摘要字典，格式化為給 LLM 閱讀的 Markdown 字串。
+    將 Python 執行結果的摘要字典，格式化為給 LLM 閱讀的精簡文字。
+    [升級] 依關聯性排序變數，只輸出前 k 名 / 總和 / 占比，並限制在 token 預算內
+    （不再對每個 DataFrame 先做完整的 to_markdown）。
     """
     if not summary_info:
         return "AI 程式碼未產生任何可供分析的摘要變數。"
-        
-    analysis_context_str = "程式碼執行後，擷取出以下核心變數與其值：\n\n"
-    for name, val in summary_info.items():
-        analysis_context_str += f"### 變數 `{name}` (型別: `{type(val).__name__}`)\n"
-        
-        if isinstance(val, (pd.DataFrame, pd.Series)):
-            try:
-                # 嘗試轉換為 Markdown，如果太大或失敗則用 str
-                md = val.to_markdown()
-                if len(md) > 1000: # 限制長度
-                    analysis_context_str += f"```\n{str(val)}\n(資料過長，僅顯示部分)\n```\n\n"
-                else:
-                    analysis_context_str += f"```markdown\n{md}\n```\n\n"
-            except Exception:
-                analysis_context_str += f"```\n{str(val)}\n```\n\n"
-        else:
-            analysis_context_str += f"```\n{str(val)}\n```\n\n"
-    return analysis_context_str
+
+    summary_text, used, dropped = summarize_results(summary_info, code=code, token_budget=token_budget)
+    print(f"[llm_core DEBUG] 結果摘要: 放入 {used}，略過 {dropped}，約 {estimate_tokens(summary_text)} tokens。")
+    if not used:
+        return "AI 程式碼未產生任何可供分析的摘要變數。"
+    return "程式碼執行後，擷取出以下核心變數（依重要性排序，數值為精簡摘要）：\n\n" + summary_text
+
+
+# --- 6b. [新增] 洞察生成 (程式碼模式與圖表規格模式共用) ---
+def _generate_insight(analysis_model, natural_language_prompt: str, analysis_context_str: str):
+    """
+    根據使用者問題與分析結果，呼叫 LLM 生成數據洞察文字。
+    AI 服務無法使用時，改為回傳計算結果的摘要（圖表與數據仍然有效）。
+
+    Returns:
+        tuple: (洞察文字, 是否由模型生成；False 代表改用了結果摘要或錯誤訊息)
+    """
+    # --- [升級] 移植自 Streamlit 的「洞察提示」邏輯 ---
+    insight_prompt = f"""
+    你是一位專業的羽球數據分析師。
+    使用者的原始問題是：「{natural_language_prompt}」
+
+    根據這個問題，AI 產生並執行了一段 Python 程式碼，程式碼執行後產生的核心數據變數如下。
+
+    --- 核心數據變數 ---
+    {analysis_context_str}
+    --- 核心數據變數結束 ---
+
+    請你基於「使用者問題」和上述所有「核心數據變數」，用繁體中文撰寫一份精簡、條理分明的數據洞察報告。
+    報告應包含以下部分：
+    1.  **直接回答**：直接且明確地回答使用者的問題。
+    2.  **關鍵發現**：從數據中提煉出 1 到 3 個最關鍵的觀察或趨勢。
+    3.  **總結**：用一句話總結分析結果。
+
+    請避免重複描述數據內容，專注於提供有價值的見解。
+    """
+
+    try:
+        # --- [關鍵] 使用中低溫 (temperature=0.4) 確保洞察的專業性與可讀性 ---
+        insight_response = LLM_CLIENT.generate(
+            analysis_model,
+            insight_prompt,
+            generation_config={"temperature": 0.4}
+        )
+        print("[llm_core DEBUG] AI 洞察生成完畢。")
+        return insight_response.text, True
+    except LLMUnavailableError as e:
+        print(f"[llm_core DEBUG] AI 洞察生成失敗，改用結果摘要: {e}")
+        return f"*(AI 服務暫時無法使用，以下為計算結果摘要: {e})*\n\n{analysis_context_str}", False
+    except Exception as e:
+        print(f"[llm_core DEBUG] AI 洞察生成失敗: {e}")
+        return f"*(無法自動生成數據洞察: {e})*", False
+
+
+# --- 6c. [新增] 執行 AI 程式碼並擷取結果 (生成的程式碼與重用的程式碼共用) ---
+def _execute_analysis_code(code_to_execute: str):
+    """
+    靜態檢查後執行程式碼，擷取圖表與摘要變數。
+
+    Returns:
+        tuple: (實際執行的程式碼, 圖表 Figure 或 None, summary_info dict)
+
+    Raises:
+        Exception: 靜態檢查或執行失敗
+    """
+    # 副本不記錄版本：AI 程式碼可能在原地修改數值，court_grid / area_counts 對副本的快取鍵每次重新計算
+    df_copy = df.copy()
+    exec_globals = {
+        "pd": pd, "df": df_copy,
+        "rallies": rallies.copy(),
+        "court_grid": court_grid, "area_counts": area_counts,
+        "composite_grids": composite_grids, "draw_court_heatmap": draw_court_heatmap,
+        "shot_patterns": shot_patterns.copy(),
+        "momentum": momentum.copy(),
+        "head_to_head": head_to_head.copy(),
+        "movement": movement.copy(),
+        "platform": platform, "io": io
+    }
+
+    # --- [新增] exec 前的靜態檢查：機械式問題在本地修正，省下一次 LLM 修正來回 ---
+    check = validate_and_repair(code_to_execute, COLUMN_CATALOG, predefined_names=exec_globals.keys())
+    if check["repairs"]:
+        print(f"[llm_core DEBUG] 靜態檢查已在本地修正: {check['repairs']}")
+        code_to_execute = check["code"]
+    if check["errors"]:
+        raise CodeValidationError("；".join(check["errors"]))
+
+    print("[llm_core DEBUG] 正在執行 AI 程式碼 (exec)...")
+    exec(code_to_execute, exec_globals)
+    print("[llm_core DEBUG] 程式碼執行完畢。")
+
+    # --- [升級] 移植自 Streamlit 的「結果擷取」邏輯 ---
+    # (只做過濾，不做格式化；排序與截斷交給 _format_summary_info_for_prompt)
+    summary_info = {} # --- [升級] 使用字典擷取結果 ---
+    ignore_list = ['df', 'rallies', 'shot_patterns', 'momentum', 'head_to_head', 'movement', 'pd', 'platform', 'io', 'fig', 'np', 'plt', 'sns', 'fm']
+    for name, val in exec_globals.items():
+        if name in ignore_list or name == '__builtins__':
+            continue
+        if is_summary_candidate(name, val):
+            summary_info[name] = val
+
+    final_fig = exec_globals.get('fig', None)
+    print(f"[llm_core DEBUG] 成功！擷取到 {len(summary_info)} 個變數。")
+    return code_to_execute, final_fig, summary_info
+
+
+# --- 6d. [新增] AI 服務無法使用時的結果 ---
+def _degraded_result(error: Exception) -> dict:
+    """
+    斷路器開啟、重試用盡或逾時：回傳 degraded 結果（由呼叫端改用先前的結果，或回應 503）。
+    """
+    print(f"[llm_core DEBUG] AI 服務無法使用: {error} (LLM 呼叫統計: {LLM_CLIENT.stats})")
+    return {"text": None, "figure": None, "error": str(error), "degraded": True}
 
 
 # --- 7. [重大升級] 核心分析函數 ---
-def run_analysis(natural_language_prompt: str, history: list = None, max_retries: int = 2) -> dict:
+def run_analysis(natural_language_prompt: str, history: list = None, max_retries: int = 2,
+                 use_tools: bool = False) -> dict:
     """
     【重大升級版】
     - 支援交談記憶 (history)
@@ -177,6 +376,7 @@ def run_analysis(natural_language_prompt: str, history: list = None, max_retries
     - 支援程式碼自我修正 (self-correction loop)
     - 支援更強大的結果擷取 (summary_info)
     - 策略性使用 temperature
+    - use_tools=True：工具呼叫模式，模型呼叫 utils.analytics 的分析函數，不生成程式碼
     """
     
     if df is None:
@@ -184,229 +384,394 @@ def run_analysis(natural_language_prompt: str, history: list = None, max_retries
     if not API_KEY:
         return {"text": None, "figure": None, "error": "未設定 GEMINI_API_KEY。"}
 
-    if history is None:
-        history = []
+    # [升級] 歷史壓縮到 token 預算內（由新到舊保留），追問的成本與第一個問題相近
+    history = compact_history(history or [], HISTORY_TOKEN_BUDGET)
+
+    if use_tools:
+        return _run_tool_analysis(natural_language_prompt, history)
 
+    warnings = []
     try:
         # --- 步驟 0: 初始化分析模型 ---
         analysis_model = genai.GenerativeModel(ANALYSIS_MODEL)
         
-        # --- 步驟 1: 【新】強化提示詞 ---
-        # (此步驟使用 ENHANCER_MODEL，已在函數內)
-        enhanced_prompt = enhance_user_prompt(natural_language_prompt, data_schema_info)
-
-        # --- 步驟 2: 【修改】生成程式碼 (加入記憶與字型) ---
-        print(f"[llm_core DEBUG] 正在使用 {ANALYSIS_MODEL} 呼叫 Google API (生成程式碼)...")
+        # --- 步驟 0b: 【新】相似問題重用 (只用於新對話；追問依賴前文，不重用) ---
+        memory_hit = {"action": "miss", "score": 0.0, "entry": None}
+        if not history:
+            memory_hit = ANALYSIS_MEMORY.lookup(natural_language_prompt)
+            print(f"[llm_core DEBUG] 相似問題查詢: {memory_hit['action']} (相似度 {memory_hit['score']:.2f})")
+
+        reused_from = None
+        if memory_hit["action"] == "reuse":
+            try:
+                code_to_execute, final_fig, summary_info = _execute_analysis_code(memory_hit["entry"]["code"])
+                ai_response_text = f"```python\n{code_to_execute}\n```"
+                reused_from = memory_hit["entry"]["question"]
+                print(f"[llm_core DEBUG] 直接重用相似問題的程式碼: {reused_from}")
+            except Exception as e:
+                # 重用的程式碼已無法執行：移除該紀錄，改走一般流程
+                print(f"[llm_core DEBUG] 重用的程式碼執行失敗，改為重新生成: {e}")
+                ANALYSIS_MEMORY.remove(memory_hit["entry"]["question"])
+                memory_hit = {"action": "miss", "score": 0.0, "entry": None}
+
+        if reused_from is None:
+            # --- 步驟 1: 【新】強化提示詞 ---
+            # (此步驟使用 ENHANCER_MODEL，已在函數內)
+            enhanced_prompt = enhance_user_prompt(natural_language_prompt, data_schema_info, warnings)
+
+            # --- 步驟 2: 【修改】生成程式碼 (加入記憶與字型) ---
+            print(f"[llm_core DEBUG] 正在使用 {ANALYSIS_MODEL} 呼叫 Google API (生成程式碼)...")
         
-        system_prompt = create_system_prompt(data_schema_info, column_definitions_info)
+            system_prompt = create_system_prompt(data_schema_info, column_definitions_info, DERIVED_TABLES_INFO)
         
-        # --- ▼ 注入字體指令 (保持不變) ▼ ---
-        font_prompt_injection = ""
-        if GLOBAL_CHINESE_FONT_PATH_OR_NAME:
-            font_path_or_name_str = repr(GLOBAL_CHINESE_FONT_PATH_OR_NAME)
-            font_prompt_injection = f"""
-            *** EXTREMELY IMPORTANT (FONT SETTING) ***
-            You MUST add the following 3 lines of code right after `import matplotlib.pyplot as plt` to set the Chinese font:
-            ```python
-            import matplotlib.pyplot as plt
-            import matplotlib.font_manager as fm
+            # --- ▼ 注入字體指令 (保持不變) ▼ ---
+            font_prompt_injection = ""
+            if GLOBAL_CHINESE_FONT_PATH_OR_NAME:
+                font_path_or_name_str = repr(GLOBAL_CHINESE_FONT_PATH_OR_NAME)
+                font_prompt_injection = f"""
+                *** EXTREMELY IMPORTANT (FONT SETTING) ***
+                You MUST add the following 3 lines of code right after `import matplotlib.pyplot as plt` to set the Chinese font:
+                ```python
+                import matplotlib.pyplot as plt
+                import matplotlib.font_manager as fm
             
-            # --- START FONT SETTING ---
-            font_path_or_name = {font_path_or_name_str}
-            try:
-                font_prop = fm.FontProperties(fname=font_path_or_name)
-                plt.rcParams['font.sans-serif'] = [font_prop.get_name()]
-            except Exception:
-                plt.rcParams['font.sans-serif'] = [font_path_or_name]
-            plt.rcParams['axes.unicode_minus'] = False # Fix for minus sign
-            # --- END FONT SETTING ---
-            ```
-            ******************************************
-            """
-        system_prompt += font_prompt_injection
-        # --- ▲ 修改完畢 ▲ ---
+                # --- START FONT SETTING ---
+                font_path_or_name = {font_path_or_name_str}
+                try:
+                    font_prop = fm.FontProperties(fname=font_path_or_name)
+                    plt.rcParams['font.sans-serif'] = [font_prop.get_name()]
+                except Exception:
+                    plt.rcParams['font.sans-serif'] = [font_path_or_name]
+                plt.rcParams['axes.unicode_minus'] = False # Fix for minus sign
+                # --- END FONT SETTING ---
+                ```
+                ******************************************
+                """
+            system_prompt += font_prompt_injection
+            # --- ▲ 修改完畢 ▲ ---
         
-        # --- 【修改】組合訊息 (加入 history) ---
-        messages_for_api = [
-            {'role': 'user', 'parts': [system_prompt]},
-            {'role': 'model', 'parts': ["好的，我準備好了。我會依照指示，在 `matplotlib` 程式碼中加入設定中文字型的區塊。請給我使用者的問題。"]},
-        ]
+            # --- 【修改】組合訊息 (加入 history) ---
+            messages_for_api = [
+                {'role': 'user', 'parts': [system_prompt]},
+                {'role': 'model', 'parts': ["好的，我準備好了。我會依照指示，在 `matplotlib` 程式碼中加入設定中文字型的區塊。請給我使用者的問題。"]},
+            ]
         
-        # 加入歷史對話
-        messages_for_api.extend(history)
+            # 加入歷史對話
+            messages_for_api.extend(history)
         
-        # 加入本次強化後的問題
-        messages_for_api.append({'role': 'user', 'parts': [enhanced_prompt]})
+            # 加入相似問題的成功程式碼作為範例 (few-shot)
+            if memory_hit["action"] == "few_shot":
+                print(f"[llm_core DEBUG] 加入相似問題作為範例: {memory_hit['entry']['question']}")
+                messages_for_api.append({'role': 'user', 'parts': [memory_hit["entry"]["question"]]})
+                messages_for_api.append({'role': 'model', 'parts': [f"```python\n{memory_hit['entry']['code']}\n```"]})
+            
+            # 加入本次強化後的問題
+            messages_for_api.append({'role': 'user', 'parts': [enhanced_prompt]})
         
-        # --- 步驟 3: 【新】程式碼生成與自我修正迴圈 ---
-        code_to_execute = None
-        ai_response_text = ""
+            # --- 步驟 3: 【新】程式碼生成與自我修正迴圈 ---
+            code_to_execute = None
+            ai_response_text = ""
         
-        for attempt in range(max_retries):
-            if attempt > 0:
-                print(f"[llm_core DEBUG] 偵測到錯誤，正在進行第 {attempt + 1} 次修正嘗試...")
-            
-            # --- [關鍵] 使用低溫 (temperature=0.1) 確保程式碼的精確性 ---
-            response = analysis_model.generate_content(
-                messages_for_api,
-                generation_config={"temperature": 0.1}
-            )
-            ai_response_text = response.text
+            for attempt in range(max_retries):
+                if attempt > 0:
+                    print(f"[llm_core DEBUG] 偵測到錯誤，正在進行第 {attempt + 1} 次修正嘗試...")
             
-            # (1) 解析程式碼
-            if "```python" in ai_response_text:
-                code_start = ai_response_text.find("```python") + len("```python\n")
-                code_end = ai_response_text.rfind("```")
-                code_to_execute = ai_response_text[code_start:code_end].strip()
-            else:
-                # AI 沒有回傳程式碼，可能只是純文字回答
-                if not code_to_execute:
-                    print("[llm_core DEBUG] AI 回應中未偵測到程式碼。")
-                    # 如果是第一次嘗試就沒程式碼，可能
-                    return {"text": ai_response_text, "figure": None, "error": None}
-
-
-            print("--- [llm_core DEBUG] 偵測到 AI 生成的程式碼 (嘗試 {}): ---".format(attempt + 1))
-            print(code_to_execute)
-            print("-------------------------------------------------")
+                # --- [關鍵] 使用低溫 (temperature=0.1) 確保程式碼的精確性 ---
+                response = LLM_CLIENT.generate(
+                    analysis_model,
+                    messages_for_api,
+                    generation_config={"temperature": 0.1}
+                )
+                ai_response_text = response.text
             
-            # (2) 執行程式碼
-            final_fig = None
-            summary_info = {} # --- [升級] 使用字典擷取結果 ---
+                # (1) 解析程式碼
+                if "```python" in ai_response_text:
+                    code_start = ai_response_text.find("```python") + len("```python\n")
+                    code_end = ai_response_text.rfind("```")
+                    code_to_execute = ai_response_text[code_start:code_end].strip()
+                else:
+                    # AI 沒有回傳程式碼，可能只是純文字回答
+                    if not code_to_execute:
+                        print("[llm_core DEBUG] AI 回應中未偵測到程式碼。")
+                        # 如果是第一次嘗試就沒程式碼，可能
+                        return {"text": ai_response_text, "figure": None, "error": None}
+
+
+                print("--- [llm_core DEBUG] 偵測到 AI 生成的程式碼 (嘗試 {}): ---".format(attempt + 1))
+                print(code_to_execute)
+                print("-------------------------------------------------")
             
-            try:
-                print("[llm_core DEBUG] 正在執行 AI 程式碼 (exec)...")
-                exec_globals = {
-                    "pd": pd, "df": df.copy(),
-                    "platform": platform, "io": io
-                }
-                exec(code_to_execute, exec_globals)
-                print("[llm_core DEBUG] 程式碼執行完畢。")
-                
-                # --- [升級] 移植自 Streamlit 的「結果擷取」邏輯 ---
-                ignore_list = ['df', 'pd', 'platform', 'io', 'fig', 'np', 'plt', 'sns', 'fm']
-                for name, val in exec_globals.items():
-                    if name.startswith('_') or name in ignore_list:
-                        continue
-                    if isinstance(val, (int, float, str, bool)):
-                        summary_info[name] = val
-                    elif hasattr(val, '__len__') and not isinstance(val, str) and len(val) < 20:
-                        summary_info[name] = val
-                
-                final_fig = exec_globals.get('fig', None)
-                print(f"[llm_core DEBUG] 成功！擷取到 {len(summary_info)} 個變數。")
-                
-                # 執行成功，跳出修正迴圈
-                break 
+                # (2) 執行程式碼
+                try:
+                    code_to_execute, final_fig, summary_info = _execute_analysis_code(code_to_execute)
+
+                    # 執行成功，跳出修正迴圈
+                    break 
                 
-            except Exception as e:
-                print(f"[llm_core DEBUG] 程式碼執行失敗: {e}")
-                traceback.print_exc() # 印出更詳細的錯誤
-                error_message = f"程式碼執行失敗: {type(e).__name__}: {e}"
+                except Exception as e:
+                    print(f"[llm_core DEBUG] 程式碼執行失敗: {e}")
+                    traceback.print_exc() # 印出更詳細的錯誤
+                    error_message = f"程式碼執行失敗: {type(e).__name__}: {e}"
                 
-                if attempt == max_retries - 1:
-                    # 達到最大重試次數，宣告失敗
-                    print("[llm_core DEBUG] 達到最大重試次數，宣告失敗。")
-                    return {"text": None, "figure": None, "error": error_message}
+                    if attempt == max_retries - 1:
+                        # 達到最大重試次數，宣告失敗
+                        print("[llm_core DEBUG] 達到最大重試次數，宣告失敗。")
+                        return {"text": None, "figure": None, "error": error_message}
                 
-                # --- [關鍵] 建立修正提示 ---
-                # 告訴 AI 錯在哪，並要求修正
-                fix_prompt = f"""
-                你之前生成的 Python 程式碼在執行時發生了以下錯誤：
+                    # --- [關鍵] 建立修正提示 ---
+                    # 告訴 AI 錯在哪，並要求修正
+                    fix_prompt = f"""
+                    你之前生成的 Python 程式碼在執行時發生了以下錯誤：
                 
-                錯誤類型: {type(e).__name__}
-                錯誤訊息: {e}
+                    錯誤類型: {type(e).__name__}
+                    錯誤訊息: {e}
 
-                這是你之前生成的 (錯誤的) 程式碼：
-                ```python
-                {code_to_execute}
-                ```
+                    這是你之前生成的 (錯誤的) 程式碼：
+                    ```python
+                    {code_to_execute}
+                    ```
                 
-                請修正這個錯誤，並**只**提供修正後的完整 Python 程式碼區塊 (```python ... ```)。
-                """
-                # 將修正請求加入到對話歷史中，準備下一次迴圈
-                messages_for_api.append({'role': 'model', 'parts': [ai_response_text]}) # AI 的錯誤回答
-                messages_for_api.append({'role': 'user', 'parts': [fix_prompt]})      # 我們的修正請求
+                    請修正這個錯誤，並**只**提供修正後的完整 Python 程式碼區塊 (```python ... ```)。
+                    """
+                    # 將修正請求加入到對話歷史中，準備下一次迴圈
+                    messages_for_api.append({'role': 'model', 'parts': [ai_response_text]}) # AI 的錯誤回答
+                    messages_for_api.append({'role': 'user', 'parts': [fix_prompt]})      # 我們的修正請求
         
         # --- 步驟 4: 【升級】第二次 AI 呼叫 (生成洞察) ---
         print("[llm_core DEBUG] 正在呼叫 Google API (生成洞察)...")
         
         # (1) 格式化 summary_info
-        analysis_context_str = _format_summary_info_for_prompt(summary_info)
-        
-        # (2) 建立洞察提示
-        # --- [升級] 移植自 Streamlit 的「洞察提示」邏輯 ---
-        insight_prompt = f"""
-        你是一位專業的羽球數據分析師。
-        使用者的原始問題是：「{natural_language_prompt}」
+        analysis_context_str = _format_summary_info_for_prompt(summary_info, code=code_to_execute)
         
-        根據這個問題，AI 產生並執行了一段 Python 程式碼，程式碼執行後產生的核心數據變數如下。
+        # (2) 生成洞察
+        summary_text, insight_generated = _generate_insight(analysis_model, natural_language_prompt, analysis_context_str)
 
-        --- 核心數據變數 ---
-        {analysis_context_str}
-        --- 核心數據變數結束 ---
 
-        請你基於「使用者問題」和上述所有「核心數據變數」，用繁體中文撰寫一份精簡、條理分明的數據洞察報告。
-        報告應包含以下部分：
-        1.  **直接回答**：直接且明確地回答使用者的問題。
-        2.  **關鍵發現**：從數據中提煉出 1 到 3 個最關鍵的觀察或趨勢。
-        3.  **總結**：用一句話總結分析結果。
-        
-        請避免重複描述數據內容，專注於提供有價值的見解。
-        """
-
-        try:
-            # --- [關鍵] 使用中低溫 (temperature=0.4) 確保洞察的專業性與可讀性 ---
-            insight_response = analysis_model.generate_content(
-                insight_prompt,
-                generation_config={"temperature": 0.4}
-            )
-            summary_text = insight_response.text
-            print("[llm_core DEBUG] AI 洞察生成完畢。")
-        except Exception as e:
-            summary_text = f"*(無法自動生成數據洞察: {e})*"
-            print(f"[llm_core DEBUG] AI 洞察生成失敗: {e}")
+        # --- 步驟 5: 【修改】組合最終結果 (支援歷史) ---
+        # [升級] 歷史只保存「程式碼摘要 + 關鍵結果 + 結論開頭」，不再保存完整程式碼區塊與洞察，
+        # 追問時的提示長度不會隨輪數線性成長
+        key_results, _, _ = summarize_results(summary_info, code=code_to_execute, token_budget=KEY_RESULT_TOKEN_BUDGET)
 
+        # --- [新增] 記住通過檢查的程式碼，供之後換句話說的問題重用 ---
+        # (「執行沒有錯誤」不夠：還必須算出非空的結果，且洞察是由模型根據這些結果生成的)
+        if not history and reused_from is None and key_results and insight_generated:
+            ANALYSIS_MEMORY.add(natural_language_prompt, code_to_execute)
 
-        # --- 步驟 5: 【修改】組合最終結果 (支援歷史) ---
-        
-        # 這是 AI 第一次的回應 (包含程式碼)
-        code_block_for_history = ai_response_text
-        
-        # 這是 AI 第二次的回應 (洞察)
-        # 我們將兩者組合起來，儲存到 history 中
-        final_content_for_history = (
-            f"{code_block_for_history}\n\n"
-            f"---\n"
-            f"### 📊 數據洞察\n"
-            f"{summary_text}"
-        )
+        final_content_for_history = compact_model_turn(code=code_to_execute, key_results=key_results, insight=summary_text)
         
         return {
             "text": summary_text,  # 最終的洞察文字
             "figure": final_fig,           # 最終的圖表物件
             "code_executed": code_to_execute, # 最終 (或修正後) 執行的程式碼
+            "reused_from": reused_from,       # 直接重用的相似問題 (None 代表重新生成)
+            "warnings": warnings,             # 非致命的問題 (例如提示詞強化失敗)
             "error": None,
             
             # --- [關鍵] 回傳這兩項，用於建立下一次呼叫的 history ---
             "history_user": {"role": "user", "parts": [natural_language_prompt]}, # 儲存「原始」問題
-            "history_model": {"role": "model", "parts": [final_content_for_history.strip()]}
+            "history_model": {"role": "model", "parts": [final_content_for_history]}
         }
 
+    except LLMUnavailableError as e:
+        return _degraded_result(e)
     except Exception as e:
         print(f"[llm_core DEBUG] run_analysis 執行時發生嚴重錯誤: {e}")
         traceback.print_exc()
         return {"text": None, "figure": None, "error": str(e)}
 
 
+# --- 7a. [新增] 工具呼叫模式 (模型呼叫經過驗證的分析函數，不生成程式碼) ---
+def _plot_tool_result(results: dict, args: dict):
+    """
+    以 utils.chart_spec 的樣式模板繪製某次查詢的結果 (plot_chart 工具)
+    """
+    result_id = args.get("result_id")
+    if result_id not in results:
+        raise KeyError(f"找不到 result_id {result_id!r}，可用: {list(results)}")
+    table = results[result_id]["result"]
+    numeric = [str(col) for col in table.select_dtypes("number").columns]
+    columns = [col for col in (args.get("columns") or []) if col in numeric] or numeric[:1]
+    if not columns:
+        raise ValueError(f"結果 {result_id} 沒有可繪製的數值欄位。")
+    data = table.copy()
+    data.columns = data.columns.map(str)
+    data = data[columns]
+    data.index = data.index.map(str)
+    spec = {
+        "chart": args.get("chart", "bar"),
+        "x": table.index.name or "",
+        "metric": columns[0] if len(columns) == 1 else "",
+        "title": args.get("title", ""),
+    }
+    for label in ("x_label", "y_label"):
+        if args.get(label):
+            spec[label] = args[label]
+    return render_chart(spec, data, GLOBAL_CHINESE_FONT_PATH_OR_NAME)
+
+
+def _run_tool_analysis(natural_language_prompt: str, history: list, max_rounds: int = MAX_TOOL_ROUNDS) -> dict:
+    """
+    工具呼叫模式：
+    - 模型以 function calling 呼叫 utils.analytics 的函數（結果依參數快取）
+    - 函數失敗時把錯誤訊息回傳給模型，讓它修正參數（取代程式碼自我修正迴圈）
+    - 模型最後的文字回應即為數據洞察，省下生成程式碼與第二次洞察呼叫的 token
+    """
+    try:
+        analysis_model = genai.GenerativeModel(ANALYSIS_MODEL, tools=tool_declarations())
+        system_prompt = create_tool_calling_prompt(column_definitions_info, ANALYTICS_VALUES_INFO)
+        messages_for_api = [
+            {'role': 'user', 'parts': [system_prompt]},
+            {'role': 'model', 'parts': ["好的，我會呼叫分析函數取得數據後再撰寫洞察。請給我使用者的問題。"]},
+        ]
+        messages_for_api.extend(history)
+        messages_for_api.append({'role': 'user', 'parts': [natural_language_prompt]})
+
+        results = {}      # result_id -> {"name", "args", "result"}
+        tool_calls = []
+        final_fig = None
+        summary_text = ""
+
+        for round_index in range(max_rounds):
+            print(f"[llm_core DEBUG] 正在使用 {ANALYSIS_MODEL} 呼叫 Google API (工具呼叫，第 {round_index + 1} 輪)...")
+            response = LLM_CLIENT.generate(
+                analysis_model,
+                messages_for_api,
+                generation_config={"temperature": 0.1}
+            )
+            content = response.candidates[0].content
+            calls = [part.function_call for part in content.parts if part.function_call.name]
+            if not calls:
+                summary_text = "".join(part.text for part in content.parts).strip()
+                break
+
+            messages_for_api.append(content)
+            response_parts = []
+            for call in calls:
+                args = type(call).to_dict(call).get("args") or {}
+                try:
+                    if call.name == PLOT_TOOL_NAME:
+                        final_fig = _plot_tool_result(results, args)
+                        payload = {"status": "ok"}
+                    else:
+                        result, used_args = call_analytics(df, call.name, args)
+                        result_id = f"r{len(results) + 1}"
+                        results[result_id] = {"name": call.name, "args": used_args, "result": result}
+                        payload = result_to_response(result_id, result)
+                    print(f"[llm_core DEBUG] 工具呼叫成功: {call.name}({args})")
+                except Exception as e:
+                    print(f"[llm_core DEBUG] 工具呼叫失敗: {call.name}({args}): {e}")
+                    payload = {"error": f"{type(e).__name__}: {e}"}
+                tool_calls.append({"name": call.name, "args": args})
+                response_parts.append(genai.protos.Part(
+                    function_response=genai.protos.FunctionResponse(name=call.name, response=payload)
+                ))
+            messages_for_api.append({'role': 'user', 'parts': response_parts})
+
+        summary_info = {
+            f"{item['name']}({', '.join(f'{k}={v!r}' for k, v in item['args'].items())})": item["result"]
+            for item in results.values()
+        }
+        if not summary_text:
+            # 模型沒有在輪數內給出結論：以查詢結果另外生成洞察
+            summary_text, _ = _generate_insight(
+                analysis_model, natural_language_prompt, _format_summary_info_for_prompt(summary_info)
+            )
+
+        key_results, _, _ = summarize_results(summary_info, token_budget=KEY_RESULT_TOKEN_BUDGET)
+        return {
+            "text": summary_text,
+            "figure": final_fig,
+            "tool_calls": tool_calls,
+            "error": None,
+            "history_user": {"role": "user", "parts": [natural_language_prompt]},
+            "history_model": {"role": "model", "parts": [
+                compact_model_turn(key_results=key_results, insight=summary_text)
+            ]},
+        }
+
+    except LLMUnavailableError as e:
+        return _degraded_result(e)
+    except Exception as e:
+        print(f"[llm_core DEBUG] _run_tool_analysis 執行時發生嚴重錯誤: {e}")
+        traceback.print_exc()
+        return {"text": None, "figure": None, "error": str(e)}
+
+
+# --- 7b. [新增] 圖表規格模式 (模型只回傳 JSON 規格，不生成程式碼) ---
+def run_chart_spec_analysis(natural_language_prompt: str, render: str = "server", max_retries: int = 2) -> dict:
+    """
+    圖表規格模式：
+    - 模型回傳精簡的 JSON 圖表規格 (輸出 token 遠少於完整的 matplotlib 程式碼)
+    - 由 utils.chart_spec 的向量化查詢引擎計算資料，不 exec 任何 AI 程式碼
+    - render="server": 用預先設定好樣式的模板繪製 Figure
+      render="client": 不繪圖，回傳 chart_data 交給瀏覽器繪製
+    """
+    if df is None:
+        return {"text": None, "figure": None, "error": "資料集 'all_dataset.csv' 未載入。"}
+    if not API_KEY:
+        return {"text": None, "figure": None, "error": "未設定 GEMINI_API_KEY。"}
+
+    try:
+        analysis_model = genai.GenerativeModel(ANALYSIS_MODEL)
+        system_prompt = create_chart_spec_prompt(data_schema_info, column_definitions_info, CHART_SPEC_TABLES_INFO)
+        messages_for_api = [
+            {'role': 'user', 'parts': [system_prompt]},
+            {'role': 'model', 'parts': ["好的，我只會回傳 JSON 圖表規格。請給我使用者的問題。"]},
+            {'role': 'user', 'parts': [natural_language_prompt]},
+        ]
+
+        spec, data = None, None
+        for attempt in range(max_retries):
+            print(f"[llm_core DEBUG] 正在使用 {ANALYSIS_MODEL} 生成圖表規格 (嘗試 {attempt + 1})...")
+            response = LLM_CLIENT.generate(
+                analysis_model,
+                messages_for_api,
+                generation_config={"temperature": 0.1}
+            )
+            try:
+                spec = validate_chart_spec(parse_chart_spec(response.text), COLUMN_CATALOG)
+                data = execute_chart_spec(spec, CHART_SPEC_FRAMES)
+                print(f"[llm_core DEBUG] 圖表規格執行完畢: {spec}")
+                break
+            except (ChartSpecError, KeyError, TypeError, ValueError) as e:
+                print(f"[llm_core DEBUG] 圖表規格無效: {e}")
+                if attempt == max_retries - 1:
+                    return {"text": None, "figure": None, "error": f"圖表規格無效: {e}"}
+                messages_for_api.append({'role': 'model', 'parts': [response.text]})
+                messages_for_api.append({'role': 'user', 'parts': [
+                    f"你的圖表規格有以下問題：{e}\n請修正後**只**回傳修正後的 ```json ... ``` 區塊。"
+                ]})
+
+        figure = render_chart(spec, data, GLOBAL_CHINESE_FONT_PATH_OR_NAME) if render == "server" else None
+        analysis_context_str = _format_summary_info_for_prompt({"chart_data": data})
+        summary_text, _ = _generate_insight(analysis_model, natural_language_prompt, analysis_context_str)
+
+        return {
+            "text": summary_text,
+            "figure": figure,
+            "chart_spec": spec,
+            "chart_data": chart_payload(spec, data),
+            "error": None,
+        }
+
+    except LLMUnavailableError as e:
+        return _degraded_result(e)
+    except Exception as e:
+        print(f"[llm_core DEBUG] run_chart_spec_analysis 執行時發生嚴重錯誤: {e}")
+        traceback.print_exc()
+        return {"text": None, "figure": None, "error": str(e)}
+
+
 # --- (保持不變) 儀表板翻譯器 ---
-def generate_analysis_from_dashboard(session_id: str, attribute: str, search_query: str) -> dict:
+def build_dashboard_prompt(attribute: str, search_query: str, match_ids: list = None) -> str:
     """
-    (保持不變)
     將儀表板的「選項」轉換成「自然語言問題」。
+    match_ids: 場次對應的比賽；省略或涵蓋全部比賽時分析所有場次
     """
-    
-    prompt = f"請幫我分析所有場次的數據。"
+    if match_ids and sorted(match_ids) != ALL_MATCH_IDS:
+        prompt = f"請幫我分析 match_id 為 {', '.join(str(m) for m in match_ids)} 的比賽數據 (先以 match_id 篩選 df)。"
+    else:
+        prompt = f"請幫我分析所有場次的數據。"
     
     if search_query:
         prompt += f" 請特別針對學生 '{search_query}' 進行分析。"
@@ -419,21 +784,111 @@ def generate_analysis_from_dashboard(session_id: str, attribute: str, search_que
     
     else:
         prompt += f" 請專注於分析 '{attribute}' 這個指標，並為此生成一個最合適的圖表。"
-    
-    print(f"[llm_core] 翻譯後的 Prompt: {prompt}")
-    
-    result = run_analysis(prompt, history=None)
+    return prompt
+
 
+def _run_dashboard_analysis(prompt: str, analysis_mode: str, history: list, owner: tuple = None) -> dict:
+    """
+    執行一次儀表板分析，並把圖表轉成 PNG 一次（存檔與 API 回應共用，避免重複繪製）。
+    owner: 實際執行的請求 (session_id, attribute, search_query)，記錄在 result["owner"]，
+           共用結果的請求據此判斷圖表與結果是否已由它記錄
+    """
+    if analysis_mode == "spec":
+        result = run_chart_spec_analysis(prompt, render="server")
+    elif analysis_mode == "client":
+        result = run_chart_spec_analysis(prompt, render="client")
+    elif analysis_mode == "tools":
+        result = run_analysis(prompt, history=history, use_tools=True)
+    else:
+        result = run_analysis(prompt, history=history)
+
+    result = dict(result)
     if result["figure"] is not None:
-        import os
-        save_dir = "report_pics/others"
-        os.makedirs(save_dir, exist_ok=True)
-        
-        save_path = os.path.join(save_dir, f"{session_id}_{attribute}.png")
-        result["figure"].savefig(save_path, dpi=150, bbox_inches='tight')
-        print(f"圖表已存檔: {save_path}")
-    # --- 注意：這裡我們「沒有」傳入 history ---
-    # --- 這表示從儀表板點擊的分析，永遠都是「新的對話」---
+        buf = io.BytesIO()
+        result["figure"].savefig(buf, format='png', dpi=150, bbox_inches='tight')
+        result["image_png"] = buf.getvalue()
+        buf.close()
+    result["owner"] = owner
+    return result
+
+
+def _serve_previous_result(result: dict, session_id: str, attribute: str, search_query: str):
+    """
+    AI 服務無法使用時，改用 REPORT_STORE 中相同場次 / 指標先前的分析結果或圖表 (就地更新 result)。
+    """
+    previous = REPORT_STORE.latest_result(session_id, attribute, player=search_query)
+    chart_path = previous["chart_path"] if previous else None
+    if chart_path is None:
+        # 只用同一位球員 (或同樣沒有指定球員) 的圖表，不拿其他球員的圖表充數
+        chart = REPORT_STORE.latest_chart(session_id, attribute, player=search_query)
+        chart_path = chart["path"] if chart else None
+    image_path = os.path.join(REPORT_PICS_DIR, chart_path) if chart_path else None
+    if previous is None and (image_path is None or not os.path.exists(image_path)):
+        return
+    if image_path and os.path.exists(image_path):
+        with open(image_path, "rb") as f:
+            result["image_png"] = f.read()
+    notice = f"*(AI 服務暫時無法使用，以下為先前的分析結果: {result['error']})*"
+    result.update(
+        text=f"{notice}\n\n{previous['text']}" if previous and previous["text"] else notice,
+        error=None,
+        stale=True,
+    )
+    print(f"[llm_core DEBUG] AI 服務無法使用，改用先前的結果: {session_id} / {attribute}")
+
+
+def generate_analysis_from_dashboard(session_id: str, attribute: str, search_query: str,
+                                     analysis_mode: str = "code", history: list = None) -> dict:
+    """
+    將儀表板的「選項」轉換成「自然語言問題」並執行分析。
+    history: 追問時由 app.py 傳入的 (伺服器端保存的) 對話歷史；圖表規格模式不使用歷史
+    analysis_mode: "code" (AI 生成程式碼)、"tools" (呼叫分析函數)、
+                   "spec" (圖表規格，伺服器繪圖)、"client" (圖表規格，瀏覽器繪圖)
+
+    [新增] 相同的請求（正規化後的問題、模式、歷史與資料集版本都相同）同時進行時，
+    只執行一次 LLM 流程，其他請求共用結果 (result["coalesced"] 為 True)。
+    [新增] 場次對應的 match_id、產生的圖表與結果都經由 REPORT_STORE 查詢 / 記錄；
+    AI 服務無法使用時改用先前的結果 (result["stale"] 為 True)。
+    """
+    prompt = build_dashboard_prompt(attribute, search_query, REPORT_STORE.session_match_ids(session_id))
+    print(f"[llm_core] 翻譯後的 Prompt: {prompt}")
+
+    if analysis_mode not in ("code", "tools"):
+        history = None
+    history_key = hashlib.sha1(
+        json.dumps(history or [], ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    flight_key = (normalize_question(prompt), analysis_mode, DATASET_VERSION, history_key)
+
+    owner = (session_id, attribute, search_query)
+    result, shared = DASHBOARD_FLIGHT.do(flight_key, _run_dashboard_analysis, prompt, analysis_mode, history, owner=owner)
+    if shared:
+        print(f"[llm_core DEBUG] 相同的分析正在執行中，已共用其結果: {prompt}")
+    result = dict(result, coalesced=shared)
+    # 共用結果時：執行的請求是同一個場次 / 指標 / 球員，圖表與結果已由它存檔記錄；
+    # 其他場次 (match_id 相同所以問題相同) 則替這個場次另外存檔記錄
+    result_owner = result.pop("owner", None)
+    record = not shared or result_owner != owner
+
+    if result.get("degraded"):
+        _serve_previous_result(result, session_id, attribute, search_query)
+    elif not result["error"] and record:
+        # [升級] 圖表以內容雜湊命名 (不再覆寫 {session_id}_{attribute}.png)，並記錄到 REPORT_STORE
+        chart_path = None
+        if result.get("image_png"):
+            chart_path = f"{DASHBOARD_CHART_DIR}/{session_id}_{attribute}_{content_hash(result['image_png'])}.png"
+            save_path = os.path.join(REPORT_PICS_DIR, chart_path)
+            if not os.path.exists(save_path):
+                os.makedirs(os.path.dirname(save_path), exist_ok=True)
+                with open(save_path, "wb") as f:
+                    f.write(result["image_png"])
+                print(f"圖表已存檔: {save_path}")
+            REPORT_STORE.add_chart(chart_path, session_id=session_id, attribute=attribute, player=search_query,
+                                   title=attribute, dataset_version=DATASET_VERSION)
+        REPORT_STORE.save_result(session_id, attribute, analysis_mode, result["text"], chart_path=chart_path,
+                                 player=search_query, dataset_version=DATASET_VERSION)
+    # --- 注意：history 只有在儀表板勾選「延續上一題」時才會傳入 ---
+    # --- 否則從儀表板點擊的分析，永遠都是「新的對話」---
     return result
 
 
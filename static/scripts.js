@@ -16,6 +16,10 @@ document.addEventListener("DOMContentLoaded", function() {
             const search_query = document.getElementById("search_input").value;
             const session_id = document.getElementById("session_select").value;
             const attribute_name = document.getElementById("attribute_select").value;
+            const modeSelect = document.getElementById("analysis_mode_select");
+            const analysis_mode = modeSelect ? modeSelect.value : "code";
+            const followUpCheckbox = document.getElementById("follow_up_checkbox");
+            const follow_up = followUpCheckbox ? followUpCheckbox.checked : false;
 
             // 簡單的前端驗證
             if (!session_id || !attribute_name) {
@@ -33,7 +37,9 @@ document.addEventListener("DOMContentLoaded", function() {
             const requestData = {
                 search_query: search_query,
                 session_id: session_id,
-                attribute_name: attribute_name
+                attribute_name: attribute_name,
+                analysis_mode: analysis_mode,
+                follow_up: follow_up
             };
 
             // 5. 使用 fetch 呼叫我們的 Flask API (/api/analyze)
@@ -64,16 +70,23 @@ document.addEventListener("DOMContentLoaded", function() {
                         html_output += "<p>AI 未提供文字分析。</p>";
                     }
 
-                    // 處理 AI 生成的圖表 (Base64 圖片)
+                    // 處理 AI 生成的圖表 (Base64 圖片，或圖表規格資料由瀏覽器繪製)
                     if (data.chart_image_base64) {
                         html_output += `<h3>分析圖表</h3>`;
                         html_output += `<img src="data:image/png;base64,${data.chart_image_base64}" alt="AI 分析圖表">`;
+                    } else if (data.chart_data) {
+                        html_output += `<h3>分析圖表</h3>`;
+                        html_output += `<canvas id="chart-canvas" width="1200" height="700"></canvas>`;
                     } else {
                         html_output += "<p>AI 未生成圖表。</p>";
                     }
                     
                     resultArea.innerHTML = html_output;
 
+                    if (data.chart_data && !data.chart_image_base64) {
+                        renderChartSpec(document.getElementById("chart-canvas"), data.chart_data);
+                    }
+
                 } else {
                     resultArea.innerHTML = `<p class="error-message">分析失敗：\n${data.error}</p>`;
                 }
@@ -135,3 +148,149 @@ function updateReportLinks() {
     }
 }
 
+
+
+// --- 3. 【新增】圖表規格模式：在瀏覽器端繪製圖表 (不需要下載 PNG) ---
+// chartData 格式: {chart, title, x_label, y_label, labels, series: [{name, values}], colors}
+function renderChartSpec(canvas, chartData) {
+    if (!canvas || !chartData) {
+        return;
+    }
+    const ctx = canvas.getContext("2d");
+    const width = canvas.width;
+    const height = canvas.height;
+    const colors = chartData.colors || ["#FF6B6B", "#4ECDC4", "#45B7D1", "#FFA07A", "#98D8C8"];
+    const labels = chartData.labels || [];
+    const series = chartData.series || [];
+
+    ctx.clearRect(0, 0, width, height);
+    ctx.fillStyle = "#333";
+    ctx.textAlign = "center";
+    ctx.font = "bold 32px system-ui, sans-serif";
+    ctx.fillText(chartData.title || "", width / 2, 44);
+
+    if (chartData.chart === "pie") {
+        const values = series.length ? series[0].values.map(v => v || 0) : [];
+        const total = values.reduce((a, b) => a + b, 0) || 1;
+        const cx = width * 0.38, cy = height * 0.55, r = height * 0.36;
+        let angle = -Math.PI / 2;
+        values.forEach((v, i) => {
+            const slice = (v / total) * Math.PI * 2;
+            ctx.beginPath();
+            ctx.moveTo(cx, cy);
+            ctx.arc(cx, cy, r, angle, angle + slice);
+            ctx.closePath();
+            ctx.fillStyle = colors[i % colors.length];
+            ctx.fill();
+            // 百分比文字 (白色粗體，靠近中心)
+            const mid = angle + slice / 2;
+            ctx.fillStyle = "#fff";
+            ctx.font = "bold 20px system-ui, sans-serif";
+            ctx.fillText(`${(v / total * 100).toFixed(1)}%`, cx + Math.cos(mid) * r * 0.7, cy + Math.sin(mid) * r * 0.7);
+            angle += slice;
+        });
+        // 圖例放在右側
+        ctx.textAlign = "left";
+        ctx.font = "22px system-ui, sans-serif";
+        labels.forEach((label, i) => {
+            const y = 120 + i * 36;
+            ctx.fillStyle = colors[i % colors.length];
+            ctx.fillRect(width * 0.72, y - 18, 24, 24);
+            ctx.fillStyle = "#333";
+            ctx.fillText(label, width * 0.72 + 36, y);
+        });
+        return;
+    }
+
+    const left = 100, right = width - 40, top = 80, bottom = height - 150;
+    const horizontal = chartData.chart === "barh";
+    const stacked = chartData.chart === "stacked_bar";
+    const totals = labels.map((_, i) => series.reduce((sum, s) => sum + (s.values[i] || 0), 0));
+    const maxValue = Math.max(...(stacked ? totals : series.flatMap(s => s.values.map(v => v || 0))), 0) || 1;
+
+    // 座標軸與網格線
+    ctx.strokeStyle = "rgba(0,0,0,0.15)";
+    ctx.setLineDash([6, 4]);
+    ctx.font = "18px system-ui, sans-serif";
+    ctx.fillStyle = "#555";
+    for (let k = 0; k <= 5; k++) {
+        const value = maxValue * k / 5;
+        ctx.beginPath();
+        if (horizontal) {
+            const x = left + (right - left) * k / 5;
+            ctx.moveTo(x, top); ctx.lineTo(x, bottom);
+            ctx.textAlign = "center";
+            ctx.fillText(+value.toPrecision(3), x, bottom + 24);
+        } else {
+            const y = bottom - (bottom - top) * k / 5;
+            ctx.moveTo(left, y); ctx.lineTo(right, y);
+            ctx.textAlign = "right";
+            ctx.fillText(+value.toPrecision(3), left - 8, y + 6);
+        }
+        ctx.stroke();
+    }
+    ctx.setLineDash([]);
+
+    const slot = (horizontal ? (bottom - top) : (right - left)) / Math.max(labels.length, 1);
+    const barWidth = stacked ? slot * 0.8 : slot * 0.8 / Math.max(series.length, 1);
+    const offsets = labels.map(() => 0);
+
+    series.forEach((s, k) => {
+        const color = series.length === 1 && chartData.chart !== "line" ? "steelblue" : colors[k % colors.length];
+        ctx.fillStyle = color;
+        ctx.strokeStyle = color;
+        ctx.lineWidth = 3;
+        if (chartData.chart === "line") {
+            ctx.beginPath();
+            s.values.forEach((v, i) => {
+                const x = left + slot * (i + 0.5);
+                const y = bottom - (bottom - top) * (v || 0) / maxValue;
+                i === 0 ? ctx.moveTo(x, y) : ctx.lineTo(x, y);
+            });
+            ctx.stroke();
+            return;
+        }
+        s.values.forEach((v, i) => {
+            const size = (horizontal ? (right - left) : (bottom - top)) * (v || 0) / maxValue;
+            const start = slot * i + slot * 0.1 + (stacked ? 0 : barWidth * k);
+            if (horizontal) {
+                ctx.fillRect(left + offsets[i], top + start, size, barWidth);
+            } else {
+                ctx.fillRect(left + start, bottom - offsets[i] - size, barWidth, size);
+            }
+            if (stacked) {
+                offsets[i] += size;
+            }
+        });
+    });
+
+    // 類別標籤
+    ctx.fillStyle = "#333";
+    ctx.font = "18px system-ui, sans-serif";
+    labels.forEach((label, i) => {
+        const center = slot * (i + 0.5);
+        if (horizontal) {
+            ctx.textAlign = "right";
+            ctx.fillText(label, left - 8, top + center + 6);
+        } else {
+            ctx.save();
+            ctx.translate(left + center, bottom + 16);
+            ctx.rotate(-Math.PI / 4);
+            ctx.textAlign = "right";
+            ctx.fillText(label, 0, 0);
+            ctx.restore();
+        }
+    });
+
+    // 圖例 (多個系列時)
+    if (series.length > 1) {
+        ctx.textAlign = "left";
+        series.forEach((s, k) => {
+            const x = right - 220, y = top + 10 + k * 30;
+            ctx.fillStyle = colors[k % colors.length];
+            ctx.fillRect(x, y - 16, 20, 20);
+            ctx.fillStyle = "#333";
+            ctx.fillText(s.name, x + 30, y);
+        });
+    }
+}
@@ -0,0 +1,371 @@
+"""
+成功分析的相似問題重用
+Similarity-based reuse of previously successful analyses
+
+教練的問題常常只是換句話說（「誰是失誤王」與「失誤最多的是誰」），完全比對的快取抓不到。
+這裡以字元 n-gram 的 TF-IDF（純 NumPy，不需要網路或額外套件）建立過去問題的索引，
+每筆紀錄保存「執行成功、算出非空結果且已生成洞察」的程式碼：
+- 提到的實體（球員（含只寫姓或名，例如「MOMOTA」）、球種、場次 / 局數、引號內的指標）與語意標記
+  （多 / 少、高 / 低、得分 / 失分、勝 / 敗、次數 / 比例 / 平均、失誤、圖表種類等）完全相同，
+  且非常相似、或只是換了語序（「失誤最多的是誰」與「誰的失誤最多」）-> 直接重用程式碼；
+- 部分相似 -> 只作為 few-shot 範例放進訊息，縮短生成；
+- 其他 -> 一般流程。
+字元 n-gram 分不出「最多」與「最少」、「第一局」與「第二局」，所以直接重用必須同時通過語意標記的比對。
+"""
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+
+NGRAM_RANGE = (1, 2)
+REUSE_THRESHOLD = 0.6
+FEW_SHOT_THRESHOLD = 0.3
+MAX_ENTRIES = 500
+
+# 只用於比對的正規化：移除標點與空白，英文轉小寫
+_PUNCTUATION = re.compile(r"[\s\.,!?;:'\"`()\[\]{}<>，。！？；：、「」『』（）《》~～\-_/\\|]+")
+_QUOTED = re.compile(r"['\"「『]([^'\"」』]+)['\"」』]")
+_NUMBERS = re.compile(r"\d+")
+# 中文序數 / 數量：「第二局」、「三場」（只認「第」之後或單位之前的中文數字，避免「一個圖表」被當成實體）
+_CHINESE_NUMBERS = re.compile(r"第\s*([一二兩三四五六七八九十]+)|([一二兩三四五六七八九十]+)\s*(?=局|場|拍|回合)")
+# 球員名稱中可單獨代表該球員的片段（姓或名）的最短長度
+MIN_ALIAS_LENGTH = 2
+_ASCII_TERM = re.compile(r"^[a-z0-9 ]+$")
+_CHINESE_DIGITS = {"一": 1, "二": 2, "兩": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+
+# 會改變答案的語意標記：詞 -> 標準化標記（由長到短比對，比對過的文字會被移除）
+# 同義詞對應到同一個標記（「失誤王」=「失誤最多」），反義詞對應到不同標記
+MEANING_MARKERS = {
+    "多少次": "次數", "幾次": "次數", "次數": "次數", "多少": "",
+    "最多": "多", "最常": "多", "最少": "少", "最不常": "少", "王": "多", "多": "多", "少": "少",
+    "最高": "高", "最低": "低", "高": "高", "低": "低",
+    "得分": "得分", "失分": "失分", "失誤": "失誤",
+    "勝": "勝", "贏": "勝", "敗": "敗", "輸": "敗",
+    "比例": "比例", "比率": "比例", "占比": "比例", "率": "率",
+    "平均": "平均", "最長": "長", "最短": "短", "長": "長", "短": "短",
+    "前段": "前", "前半": "前", "後段": "後", "後半": "後",
+    "局": "局", "場": "場",
+    "圓餅": "圓餅", "餅圖": "圓餅", "長條": "長條", "柱狀": "長條", "直條": "長條", "折線": "折線",
+    "熱區": "熱區", "熱力": "熱區", "熱圖": "熱區",
+}
+_MARKER_TERMS = sorted(MEANING_MARKERS, key=len, reverse=True)
+# 只影響語氣、不影響答案的字：語意簽章相同時，移除實體、語意標記與這些字後的內容字相同，代表只是換了語序
+FILLER_CHARS = frozenset("的是嗎呢了吧啊呀請幫我")
+
+
+def _chinese_number(text):
+    """一 ~ 九十九 的中文數字 -> int"""
+    if "十" not in text:
+        return _CHINESE_DIGITS.get(text)
+    tens, _, ones = text.partition("十")
+    return _CHINESE_DIGITS.get(tens, 1) * 10 + _CHINESE_DIGITS.get(ones, 0)
+
+
+def normalize_question(text):
+    """正規化問題文字（小寫、移除標點與空白）"""
+    return _PUNCTUATION.sub("", str(text).lower())
+
+
+def _ngrams(text):
+    """字元 n-gram（中文沒有空白分詞，以字元 1-2 gram 表示）"""
+    grams = []
+    for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+class AnalysisMemory:
+    """
+    過去成功分析的 TF-IDF 索引
+
+    Args:
+        path: JSON 檔案路徑；None 時只存在記憶體中
+        entity_values: 會影響答案的實體值（例如球員名稱、球種），問題中提到的實體不同時不會直接重用；
+            名稱中以空白分開的片段（姓或名）也視為同一個實體，多個名稱共用的片段則自成一個實體
+        max_entries: 最多保留的紀錄數（超過時丟棄最舊的）
+    """
+
+    def __init__(self, path=None, entity_values=(), max_entries=MAX_ENTRIES):
+        self.path = path
+        self.entity_values = sorted({str(v).lower().strip() for v in entity_values if str(v).strip()},
+                                    key=len, reverse=True)
+        self._entity_patterns = self._build_entity_patterns(self.entity_values)
+        self.max_entries = max_entries
+        self.entries = []
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._vocab = None
+        self._idf = None
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.entries = json.load(f)[-max_entries:]
+            except (OSError, ValueError) as e:
+                print(f"[analysis_memory] 無法讀取 {path}: {e}")
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _build_entity_patterns(values):
+        """
+        實體值與其片段 -> (比對用的 regex, 標準化的實體值)，由長到短排列
+
+        英數字的詞只在前後不是英數字時才算提到（「chen」不會比對到「chenlong」）。
+        """
+        canonical = {value: value for value in values}
+        owners = {}
+        for value in values:
+            for token in value.split():
+                if len(token) >= MIN_ALIAS_LENGTH and token != value:
+                    owners.setdefault(token, set()).add(value)
+        for token, names in owners.items():
+            if token not in canonical:
+                canonical[token] = next(iter(names)) if len(names) == 1 else token
+        patterns = []
+        for term in sorted(canonical, key=len, reverse=True):
+            regex = re.escape(term)
+            if _ASCII_TERM.match(term):
+                regex = rf"(?<![a-z0-9]){regex}(?![a-z0-9])"
+            patterns.append((re.compile(regex), canonical[term]))
+        return patterns
+
+    def _strip_entities(self, question):
+        """
+        取出問題中提到的實體，並回傳移除實體後的文字
+
+        Returns:
+            tuple: (實體 set, 剩餘文字)
+        """
+        lowered = str(question).lower()
+        found = set(_QUOTED.findall(lowered)) | set(_NUMBERS.findall(lowered))
+        for match in _CHINESE_NUMBERS.finditer(lowered):
+            number = _chinese_number(match.group(1) or match.group(2))
+            if number is not None:
+                found.add(str(number))
+        for pattern, value in self._entity_patterns:
+            lowered, count = pattern.subn(" ", lowered)
+            if count:
+                found.add(value)
+        for quoted in _QUOTED.findall(lowered):
+            lowered = lowered.replace(quoted, " ")
+        return {v.strip() for v in found if v.strip()}, lowered
+
+    def entities(self, question):
+        """
+        取出問題中提到的實體：已知的實體值、引號內的文字、阿拉伯數字與中文序數
+
+        Returns:
+            frozenset
+        """
+        return frozenset(self._strip_entities(question)[0])
+
+    def _signature(self, question):
+        """
+        Returns:
+            tuple: (實體 frozenset, 語意標記 frozenset, 其餘的內容字 frozenset)
+        """
+        found, text = self._strip_entities(question)
+        markers = set()
+        for term in _MARKER_TERMS:
+            if term in text:
+                markers.add(MEANING_MARKERS[term])
+                text = text.replace(term, " ")
+        markers.discard("")
+        content = frozenset(normalize_question(text)) - FILLER_CHARS
+        return frozenset(found), frozenset(markers), content
+
+    def meaning(self, question):
+        """
+        問題的語意簽章：實體 + 語意標記（多 / 少、得分 / 失分、次數 / 比例、圖表種類 ...）
+
+        兩個問題的簽章相同時，才可能是同一個問題的不同說法。
+
+        Returns:
+            tuple: (實體 frozenset, 語意標記 frozenset)
+        """
+        return self._signature(question)[:2]
+
+    def _vectorize(self, texts):
+        """以目前的詞彙表與 idf 轉成 L2 正規化的 TF-IDF 矩陣"""
+        matrix = np.zeros((len(texts), len(self._vocab)))
+        for row, text in enumerate(texts):
+            for gram in _ngrams(normalize_question(text)):
+                col = self._vocab.get(gram)
+                if col is not None:
+                    matrix[row, col] += 1.0
+        matrix *= self._idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+
+    def _rebuild(self):
+        """重建詞彙表、idf 與索引矩陣（新增紀錄後第一次查詢時才重建）"""
+        documents = [set(_ngrams(normalize_question(e["question"]))) for e in self.entries]
+        self._vocab = {gram: i for i, gram in enumerate(sorted(set().union(*documents)))}
+        df_counts = np.zeros(len(self._vocab))
+        for grams in documents:
+            df_counts[[self._vocab[g] for g in grams]] += 1
+        self._idf = np.log((1 + len(documents)) / (1 + df_counts)) + 1.0
+        self._matrix = self._vectorize([e["question"] for e in self.entries])
+
+    def add(self, question, code):
+        """
+        新增一筆已通過檢查的分析（同一個正規化問題只保留最新的程式碼）
+
+        只應在程式碼執行成功、算出非空的結果且洞察已生成後呼叫；單純「沒有錯誤」不代表答案正確。
+
+        Args:
+            question: 原始問題
+            code: 通過檢查的程式碼
+        """
+        key = normalize_question(question)
+        with self._lock:
+            self.entries = [e for e in self.entries if normalize_question(e["question"]) != key]
+            self.entries.append({"question": question, "code": code, "created": time.time()})
+            self.entries = self.entries[-self.max_entries:]
+            self._matrix = None
+            if self.path:
+                self._save()
+
+    def remove(self, question):
+        """移除某個問題的紀錄（例如重用的程式碼已無法執行）"""
+        key = normalize_question(question)
+        with self._lock:
+            self.entries = [e for e in self.entries if normalize_question(e["question"]) != key]
+            self._matrix = None
+            if self.path:
+                self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def search(self, question, k=1):
+        """
+        找出最相似的 k 筆紀錄
+
+        Returns:
+            list of (相似度, 紀錄 dict)，依相似度遞減排序
+        """
+        with self._lock:
+            if not self.entries:
+                return []
+            if self._matrix is None:
+                self._rebuild()
+            scores = self._matrix @ self._vectorize([question])[0]
+            top = np.argsort(-scores)[:k]
+            return [(float(scores[i]), self.entries[i]) for i in top]
+
+    def lookup(self, question):
+        """
+        決定如何使用過去的分析
+
+        Returns:
+            dict: {"action": "reuse" | "few_shot" | "miss", "score", "entry"}
+        """
+        hits = self.search(question, k=1)
+        if not hits:
+            return {"action": "miss", "score": 0.0, "entry": None}
+        score, entry = hits[0]
+        exact = normalize_question(question) == normalize_question(entry["question"])
+        signature, past_signature = self._signature(question), self._signature(entry["question"])
+        # 語意簽章相同時：非常相似，或只是換了語序（內容字相同）才直接重用
+        same_meaning = signature[:2] == past_signature[:2]
+        reordered = same_meaning and signature[2] == past_signature[2]
+        if exact or (score >= FEW_SHOT_THRESHOLD and same_meaning and (score >= REUSE_THRESHOLD or reordered)):
+            action = "reuse"
+        elif score >= FEW_SHOT_THRESHOLD:
+            action = "few_shot"
+        else:
+            action = "miss"
+        return {"action": action, "score": score, "entry": entry}
+
+
+# --- 基準測試：換句話說的問題配對 (python -m utils.analysis_memory) ---
+BENCHMARK_SEED = [
+    "誰是失誤王？",
+    "Kento MOMOTA 的殺球次數是多少？",
+    "各球種的使用比例",
+    "CHOU Tien Chen 最常在哪些區域失分？",
+    "第 3 場比賽的走勢",
+    "雙方的得分方式比較",
+    "長回合誰比較會贏？",
+    "請幫我分析所有場次的數據。 請專注於分析 '球種' 這個指標，並為此生成一個最合適的圖表。",
+    "第一局誰的得分比較多？",
+]
+# (問題, 應重用的種子索引；None 代表不應重用)
+BENCHMARK_QUERIES = [
+    ("失誤最多的是誰", 0),
+    ("誰的失誤最多？", 0),
+    ("kento momota殺球幾次", 1),
+    ("Kento MOMOTA 總共殺球幾次？", 1),
+    ("球種使用比例分布", 2),
+    ("CHOU Tien Chen 在哪些區域最常失分", 3),
+    ("第3場比賽走勢如何", 4),
+    ("比較雙方的得分方式", 5),
+    ("長回合時誰的勝率比較高", 6),
+    ("請幫我分析所有場次的數據。請專注於分析「球種」這個指標，並為此生成一個最合適的圖表。", 7),
+    # 相似但答案不同：不可直接重用
+    ("CHOU Tien Chen 的殺球次數是多少？", None),
+    ("Kento MOMOTA 的切球次數是多少？", None),
+    ("第 5 場比賽的走勢", None),
+    ("請幫我分析所有場次的數據。 請專注於分析 '失誤' 這個指標，並為此生成一個最合適的圖表。", None),
+    ("發球的平均拍數", None),
+    ("第一局誰得分比較多", 8),
+    # 字面相近但意思相反 / 指標不同：不可直接重用
+    ("失誤最少的是誰", None),
+    ("CHOU Tien Chen 最常在哪些區域得分？", None),
+    ("第二局誰的得分比較多？", None),
+    ("第一局誰的失分比較多？", None),
+    ("第一局誰的得分比較少？", None),
+    ("Kento MOMOTA 的殺球得分率是多少？", None),
+    ("Kento MOMOTA 的殺球失誤次數是多少？", None),
+    # 只寫姓或名的球員：與全名是同一個實體，與沒有指定球員的問題不同
+    ("MOMOTA 總共殺球幾次？", 1),
+    ("CHOU 的殺球次數是多少？", None),
+    ("只看MOMOTA，誰是失誤王？", None),
+    # 指定了圖表種類：不可直接重用沒有指定（或指定其他種類）的程式碼
+    ("用圓餅圖畫各球種的使用比例", None),
+    ("各球種的使用比例長條圖", None),
+]
+
+
+def run_benchmark():
+    """對換句話說的問題配對計算命中率與查詢延遲"""
+    memory = AnalysisMemory(entity_values=[
+        "Kento MOMOTA", "CHOU Tien Chen", "殺球", "切球", "挑球", "長球", "網前球", "推撲球", "發短球", "發長球", "平球",
+    ])
+    for i, question in enumerate(BENCHMARK_SEED):
+        memory.add(question, f"# seed {i}")
+    memory.search("warm up")
+
+    counts = {"reuse_correct": 0, "reuse_wrong": 0, "few_shot": 0, "miss": 0}
+    latencies = []
+    for question, expected in BENCHMARK_QUERIES:
+        start = time.perf_counter()
+        result = memory.lookup(question)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if result["action"] == "reuse":
+            correct = expected is not None and result["entry"]["code"] == f"# seed {expected}"
+            counts["reuse_correct" if correct else "reuse_wrong"] += 1
+        else:
+            counts[result["action"]] += 1
+        print(f"{result['action']:>8}  {result['score']:.2f}  {question}")
+
+    paraphrases = sum(1 for _, expected in BENCHMARK_QUERIES if expected is not None)
+    print(f"\n紀錄數: {len(memory)}，查詢數: {len(BENCHMARK_QUERIES)}（換句話說 {paraphrases}）")
+    print(f"直接重用命中率: {counts['reuse_correct']}/{paraphrases}，錯誤重用: {counts['reuse_wrong']}，"
+          f"few-shot: {counts['few_shot']}，未命中: {counts['miss']}")
+    print(f"查詢延遲: 平均 {np.mean(latencies):.3f} ms，最大 {np.max(latencies):.3f} ms")
+    return counts, latencies
+
+
+if __name__ == "__main__":
+    run_benchmark()
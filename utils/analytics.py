@@ -0,0 +1,544 @@
+"""
+經過驗證的向量化分析函數庫
+Vetted vectorized analytics library exposed to the model via function calling
+
+常見問題（失誤王、得分 / 失分原因、球種分布、球種效率、落點、回合長度、關鍵分）
+都在這裡用固定且經過驗證的 groupby 實作。工具呼叫模式下模型只需要選擇函數與參數，
+不必每次重新寫 pandas 程式碼；結果依 (資料集版本, 函數名稱, 參數) 快取。
+
+`python -m utils.analytics` 會以逐列迴圈的參考實作對照 all_dataset.csv 檢查每個函數。
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+from utils.data_loader import cached_dataset_version
+from utils.rally_features import NO_RETURN_TYPE, get_rally_table
+from utils.court_spatial import area_counts
+from utils.momentum import get_momentum_table
+from utils.head_to_head import ERROR_REASONS
+
+
+# 回傳給模型的結果列數上限（完整結果仍保留在伺服器端，用於繪圖與洞察）
+MAX_RESULT_ROWS = 30
+
+_RESULT_CACHE = {}
+_MAX_CACHE_ENTRIES = 512
+
+
+def _rally_filter(rallies, match_id=None, set=None):
+    """依場次 / 局數篩選回合表"""
+    mask = np.ones(len(rallies), dtype=bool)
+    if match_id is not None:
+        mask &= rallies["match_id"].to_numpy() == match_id
+    if set is not None:
+        mask &= rallies["set"].to_numpy() == set
+    return rallies[mask]
+
+
+def _stroke_filter(df, player=None, match_id=None, set=None):
+    """依擊球者 / 場次 / 局數篩選逐拍資料（排除「接不到」）"""
+    mask = df["type"].ne(NO_RETURN_TYPE).to_numpy() & df["type"].notna().to_numpy()
+    if player is not None:
+        mask &= (df["player"] == player).to_numpy()
+    if match_id is not None:
+        mask &= df["match_id"].to_numpy() == match_id
+    if set is not None:
+        mask &= df["set"].to_numpy() == set
+    return df[mask]
+
+
+def error_counts(df, match_id=None, set=None):
+    """
+    各球員的失誤次數（失分原因屬於 ERROR_REASONS 的回合），並拆成各失誤原因
+
+    Args:
+        df: 逐拍資料 DataFrame
+        match_id: 篩選場次 (可選)
+        set: 篩選局數 (可選)
+
+    Returns:
+        pd.DataFrame: index 為球員，欄位 `errors`, `rallies_lost`, `error_share` 與各失誤原因次數，依 errors 遞減排序
+    """
+    rallies = _rally_filter(get_rally_table(df), match_id, set).dropna(subset=["loser"])
+    is_error = rallies["lose_reason"].isin(ERROR_REASONS)
+    by_reason = rallies[is_error].groupby(["loser", "lose_reason"]).size().unstack(fill_value=0)
+    lost = rallies.groupby("loser").size()
+
+    result = pd.DataFrame(index=lost.index)
+    result["errors"] = by_reason.sum(axis=1).reindex(lost.index, fill_value=0)
+    result["rallies_lost"] = lost
+    result["error_share"] = result["errors"] / result["rallies_lost"].replace(0, np.nan)
+    result = result.join(by_reason.reindex(lost.index, fill_value=0))
+    result.index.name = "player"
+    result.columns.name = None
+    return result.sort_values("errors", ascending=False)
+
+
+def reason_counts(df, kind="win", player=None, match_id=None, set=None):
+    """
+    得分方式 (kind='win') 或失分原因 (kind='lose') 的次數與比例
+
+    Args:
+        df: 逐拍資料 DataFrame
+        kind: 'win'（以得分者為準）或 'lose'（以失分者為準）
+        player: 篩選球員 (可選)
+        match_id: 篩選場次 (可選)
+        set: 篩選局數 (可選)
+
+    Returns:
+        pd.DataFrame: index 為原因，欄位 `count`, `share`
+    """
+    if kind not in ("win", "lose"):
+        raise ValueError(f"kind 必須是 'win' 或 'lose'，收到: {kind!r}")
+    rallies = _rally_filter(get_rally_table(df), match_id, set)
+    player_col, reason_col = ("winner", "win_reason") if kind == "win" else ("loser", "lose_reason")
+    if player is not None:
+        rallies = rallies[rallies[player_col] == player]
+    counts = rallies[reason_col].value_counts()
+    result = pd.DataFrame({"count": counts, "share": counts / max(counts.sum(), 1)})
+    result.index.name = reason_col
+    return result
+
+
+def shot_type_distribution(df, player=None, match_id=None, set=None, normalize=False):
+    """
+    球種分布（每位球員一欄）
+
+    Args:
+        df: 逐拍資料 DataFrame
+        player: 篩選擊球者 (可選)
+        match_id: 篩選場次 (可選)
+        set: 篩選局數 (可選)
+        normalize: True 時每位球員的欄位轉為比例
+
+    Returns:
+        pd.DataFrame: index 為球種 (`type`)，欄位為球員
+    """
+    strokes = _stroke_filter(df, player, match_id, set)
+    counts = strokes.groupby(["type", "player"]).size().unstack(fill_value=0)
+    counts.columns.name = None
+    if normalize:
+        counts = counts / counts.sum(axis=0).replace(0, np.nan)
+    return counts.loc[counts.sum(axis=1).sort_values(ascending=False).index]
+
+
+def shot_effectiveness(df, player=None, match_id=None, set=None):
+    """
+    各球種的得分 / 失分效率：該拍直接得分 (winners) 與直接失分 (errors) 的次數與比例
+
+    Args:
+        df: 逐拍資料 DataFrame
+        player: 篩選擊球者 (可選)
+        match_id: 篩選場次 (可選)
+        set: 篩選局數 (可選)
+
+    Returns:
+        pd.DataFrame: index 為球種，欄位 `shots`, `winners`, `errors`, `winner_rate`, `error_rate`
+    """
+    strokes = _stroke_filter(df, player, match_id, set)
+    # 只有結束回合的那一拍才有 lose_reason；擊球者是否為得分者決定該拍是得分或失分
+    ends_rally = strokes["lose_reason"].notna().to_numpy()
+    hitter_won = (strokes["getpoint_player"] == strokes["player"]).to_numpy()
+    flags = pd.DataFrame({
+        "type": strokes["type"].to_numpy(),
+        "shots": 1,
+        "winners": (ends_rally & hitter_won).astype(np.int64),
+        "errors": (ends_rally & ~hitter_won).astype(np.int64),
+    })
+    result = flags.groupby("type").sum()
+    result["winner_rate"] = result["winners"] / result["shots"]
+    result["error_rate"] = result["errors"] / result["shots"]
+    return result.sort_values("shots", ascending=False)
+
+
+def points_won(df, match_id=None, set=None):
+    """
+    各球員的得分、失分與回合勝率
+
+    Args:
+        df: 逐拍資料 DataFrame
+        match_id: 篩選場次 (可選)
+        set: 篩選局數 (可選)
+
+    Returns:
+        pd.DataFrame: index 為球員，欄位 `won`, `lost`, `win_rate`
+    """
+    rallies = _rally_filter(get_rally_table(df), match_id, set).dropna(subset=["winner", "loser"])
+    won = rallies.groupby("winner").size()
+    lost = rallies.groupby("loser").size()
+    players = won.index.union(lost.index)
+    result = pd.DataFrame({
+        "won": won.reindex(players, fill_value=0),
+        "lost": lost.reindex(players, fill_value=0),
+    })
+    result["win_rate"] = result["won"] / (result["won"] + result["lost"]).replace(0, np.nan)
+    result.index.name = "player"
+    return result.sort_values("won", ascending=False)
+
+
+def rally_length_stats(df, match_id=None, set=None, bins=None):
+    """
+    依回合長度（拍數）分組的回合數與各球員得分
+
+    Args:
+        df: 逐拍資料 DataFrame
+        match_id: 篩選場次 (可選)
+        set: 篩選局數 (可選)
+        bins: 拍數分組邊界 (list of int)，預設 [0, 3, 6, 10, 15]（最後一組不設上限）
+
+    Returns:
+        pd.DataFrame: index 為拍數區間，欄位 `rallies`, `mean_duration_sec` 與各球員得分次數
+    """
+    rallies = _rally_filter(get_rally_table(df), match_id, set)
+    edges = sorted(bins) if bins else [0, 3, 6, 10, 15]
+    edges = edges + [np.inf]
+    labels = [
+        f"{int(lo) + 1}-{int(hi)}" if np.isfinite(hi) else f"{int(lo) + 1}+"
+        for lo, hi in zip(edges[:-1], edges[1:])
+    ]
+    bucket = pd.cut(rallies["shot_count"], bins=edges, labels=labels)
+    result = pd.DataFrame({
+        "rallies": rallies.groupby(bucket, observed=False).size(),
+        "mean_duration_sec": rallies.groupby(bucket, observed=False)["duration_sec"].mean(),
+    })
+    wins = rallies.groupby([bucket, "winner"], observed=False).size().unstack(fill_value=0)
+    wins.columns.name = None
+    result = result.join(wins)
+    result.index = result.index.astype(str)
+    result.index.name = "shot_count"
+    return result
+
+
+def landing_area_counts(df, player=None, shot_type=None, match_id=None, kind="landing", top_k=10):
+    """
+    各區域的落點 / 擊球點次數（使用 `utils.court_spatial.area_counts` 的快取）
+
+    Args:
+        df: 逐拍資料 DataFrame
+        player: 篩選擊球者 (可選)
+        shot_type: 篩選球種 (可選)
+        match_id: 篩選場次 (可選)
+        kind: 'landing' / 'hit' / 'player' / 'opponent'
+        top_k: 只回傳次數最多的前 k 個區域
+
+    Returns:
+        pd.DataFrame: index 為區域編號，欄位 `count`, `share`
+    """
+    counts = area_counts(df, kind, match_id=match_id, player=player, shot_type=shot_type)
+    counts = counts[counts > 0].sort_values(ascending=False)
+    result = pd.DataFrame({"count": counts, "share": counts / max(counts.sum(), 1)})
+    result.index = result.index.astype(str)
+    result.index.name = f"{kind}_area"
+    return result.head(top_k) if top_k else result
+
+
+def key_rallies(df, match_id=None, top_k=5):
+    """
+    整場勝率變化最大的關鍵回合（取自 `utils.momentum`）
+
+    Args:
+        df: 逐拍資料 DataFrame
+        match_id: 篩選場次 (可選)
+        top_k: 回傳的回合數
+
+    Returns:
+        pd.DataFrame: index 為 "場次-局-回合"，欄位 `winner`, `score` (A:B), `win_prob_swing`, `match_win_prob_after`
+    """
+    momentum = get_momentum_table(df)
+    if match_id is not None:
+        momentum = momentum[momentum["match_id"] == match_id]
+    top = momentum.loc[momentum["win_prob_swing"].abs().nlargest(top_k).index]
+    result = pd.DataFrame({
+        "winner": top["winner"].to_numpy(),
+        "score": (top["a_score_after"].astype(str) + ":" + top["b_score_after"].astype(str)).to_numpy(),
+        "win_prob_swing": top["win_prob_swing"].to_numpy(),
+        "match_win_prob_after": top["match_win_prob_after"].to_numpy(),
+    }, index=(
+        top["match_id"].astype(np.int64).astype(str) + "-" + top["set"].astype(np.int64).astype(str)
+        + "-" + top["rally"].astype(np.int64).astype(str)
+    ).to_numpy())
+    result.index.name = "rally"
+    return result
+
+
+# --- 共用參數定義 (OpenAPI schema，供 Gemini function calling 使用) ---
+_PLAYER = {"type": "string", "description": "球員全名（例如 'Kento MOMOTA'），省略代表所有球員"}
+_MATCH_ID = {"type": "integer", "description": "場次 match_id，省略代表所有場次"}
+_SET = {"type": "integer", "description": "局數 set (1, 2, 3)，省略代表所有局"}
+
+# 函數名稱 -> (函數, 說明, 參數定義)
+ANALYTICS_FUNCTIONS = {
+    "error_counts": (error_counts, "各球員的失誤次數（出界、掛網、未過網、落點判斷失誤、犯規）與各失誤原因。回答「誰是失誤王」。", {
+        "match_id": _MATCH_ID, "set": _SET,
+    }),
+    "reason_counts": (reason_counts, "得分方式 (kind='win') 或失分原因 (kind='lose') 的次數與比例。", {
+        "kind": {"type": "string", "enum": ["win", "lose"], "description": "win: 得分方式；lose: 失分原因"},
+        "player": _PLAYER, "match_id": _MATCH_ID, "set": _SET,
+    }),
+    "shot_type_distribution": (shot_type_distribution, "各球員的球種使用次數（或比例）。", {
+        "player": _PLAYER, "match_id": _MATCH_ID, "set": _SET,
+        "normalize": {"type": "boolean", "description": "true 時回傳比例"},
+    }),
+    "shot_effectiveness": (shot_effectiveness, "各球種的直接得分 / 直接失分次數與比例（球種效率）。", {
+        "player": _PLAYER, "match_id": _MATCH_ID, "set": _SET,
+    }),
+    "points_won": (points_won, "各球員的得分、失分與回合勝率。", {
+        "match_id": _MATCH_ID, "set": _SET,
+    }),
+    "rally_length_stats": (rally_length_stats, "依回合拍數分組的回合數、平均時長與各球員得分（長短球回合表現）。", {
+        "match_id": _MATCH_ID, "set": _SET,
+        "bins": {"type": "array", "items": {"type": "integer"}, "description": "拍數分組邊界，例如 [0, 3, 6, 10, 15]"},
+    }),
+    "landing_area_counts": (landing_area_counts, "各區域的落點 / 擊球點 / 站位次數與比例。", {
+        "player": _PLAYER,
+        "shot_type": {"type": "string", "description": "球種（`type` 欄位的值，例如 '殺球'）"},
+        "match_id": _MATCH_ID,
+        "kind": {"type": "string", "enum": ["landing", "hit", "player", "opponent"], "description": "座標種類"},
+        "top_k": {"type": "integer", "description": "只回傳次數最多的前 k 個區域"},
+    }),
+    "key_rallies": (key_rallies, "整場勝率變化最大的關鍵回合。", {
+        "match_id": _MATCH_ID,
+        "top_k": {"type": "integer", "description": "回傳的回合數"},
+    }),
+}
+
+# 繪圖工具：由呼叫端（llm_core）以 utils.chart_spec 的樣式模板繪製先前的查詢結果
+PLOT_TOOL_NAME = "plot_chart"
+PLOT_TOOL_DECLARATION = {
+    "name": PLOT_TOOL_NAME,
+    "description": "把先前某次查詢的結果畫成圖表（每個問題最多呼叫一次）。",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "result_id": {"type": "string", "description": "查詢結果的 result_id（例如 'r1'）"},
+            "chart": {"type": "string", "enum": ["bar", "barh", "stacked_bar", "pie", "line"]},
+            "columns": {"type": "array", "items": {"type": "string"}, "description": "要畫的欄位，省略代表第一個欄位"},
+            "title": {"type": "string", "description": "圖表標題（繁體中文）"},
+            "x_label": {"type": "string"},
+            "y_label": {"type": "string"},
+        },
+        "required": ["result_id", "chart"],
+    },
+}
+
+
+def tool_declarations():
+    """
+    建立 Gemini function calling 的工具定義
+
+    Returns:
+        list: 可直接傳給 `genai.GenerativeModel(tools=...)` 的工具清單
+    """
+    declarations = [
+        {
+            "name": name,
+            "description": description,
+            "parameters": {"type": "object", "properties": params},
+        }
+        for name, (_, description, params) in ANALYTICS_FUNCTIONS.items()
+    ]
+    declarations.append(PLOT_TOOL_DECLARATION)
+    return [{"function_declarations": declarations}]
+
+
+def _coerce_args(name, args):
+    """依參數定義轉型（模型回傳的整數常是 float），並移除未知 / 空值參數"""
+    params = ANALYTICS_FUNCTIONS[name][2]
+    coerced = {}
+    for key, value in args.items():
+        if key not in params or value is None or value == "":
+            continue
+        kind = params[key]["type"]
+        if kind == "integer":
+            value = int(value)
+        elif kind == "boolean":
+            value = bool(value)
+        elif kind == "array":
+            value = [int(v) if params[key]["items"]["type"] == "integer" else v for v in value]
+        coerced[key] = value
+    return coerced
+
+
+def call_analytics(df, name, args):
+    """
+    執行（並快取）一個分析函數；相同資料集版本與參數的呼叫直接回傳快取結果
+
+    Args:
+        df: 逐拍資料 DataFrame
+        name: ANALYTICS_FUNCTIONS 中的函數名稱
+        args: 參數 dict
+
+    Returns:
+        tuple: (pd.DataFrame 結果, 實際使用的參數 dict)
+
+    Raises:
+        KeyError: 未知的函數名稱
+    """
+    if name not in ANALYTICS_FUNCTIONS:
+        raise KeyError(f"未知的分析函數: {name!r}，可用: {list(ANALYTICS_FUNCTIONS)}")
+    args = _coerce_args(name, dict(args or {}))
+    key = (cached_dataset_version(df), name, json.dumps(args, sort_keys=True, ensure_ascii=False))
+    result = _RESULT_CACHE.get(key)
+    if result is None:
+        result = ANALYTICS_FUNCTIONS[name][0](df, **args)
+        if len(_RESULT_CACHE) >= _MAX_CACHE_ENTRIES:
+            _RESULT_CACHE.pop(next(iter(_RESULT_CACHE)))
+        _RESULT_CACHE[key] = result
+    return result, args
+
+
+def result_to_response(result_id, result, max_rows=MAX_RESULT_ROWS):
+    """
+    將查詢結果轉成回傳給模型的 JSON 相容 dict（列數過多時截斷）
+
+    Args:
+        result_id: 結果編號（供 plot_chart 參照）
+        result: pd.DataFrame
+        max_rows: 最多回傳的列數
+
+    Returns:
+        dict: {result_id, columns, index, data, total_rows}
+    """
+    table = result.head(max_rows).round(4)
+    payload = json.loads(table.to_json(orient="split", force_ascii=False))
+    payload["result_id"] = result_id
+    payload["total_rows"] = int(len(result))
+    return payload
+
+
+# --- 自我檢查：以逐列迴圈的參考實作對照每個分析函數 ---
+def _reference_rallies(records):
+    """逐列走訪資料，建立 (match_id, set, rally) -> 回合資訊（不使用 rally_features）"""
+    players = {}
+    rallies = {}
+    for row in sorted(records, key=lambda r: (r["match_id"], r["set"], r["rally"], r["ball_round"])):
+        players.setdefault(row["match_id"], set()).add(row["player"])
+        info = rallies.setdefault((row["match_id"], row["set"], row["rally"]),
+                                  {"strokes": 0, "win_reason": None, "lose_reason": None})
+        info["winner"] = row["getpoint_player"]
+        # 得分 / 失分原因記在最後一個實際擊球上，之後可能還有一列「接不到」
+        for reason in ("win_reason", "lose_reason"):
+            if not _is_missing(row[reason]):
+                info[reason] = row[reason]
+        if row["type"] != NO_RETURN_TYPE:
+            info["strokes"] += 1
+    for (match_id, _, _), info in rallies.items():
+        others = players[match_id] - {info["winner"]}
+        info["loser"] = others.pop() if len(others) == 1 else None
+    return rallies
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def _check_equal(name, expected, actual):
+    """比較兩個 {key: 數值} dict，不一致時丟出 AssertionError"""
+    keys = set(expected) | set(actual)
+    diffs = {k: (expected.get(k, 0), actual.get(k, 0)) for k in keys
+             if not np.isclose(expected.get(k, 0), actual.get(k, 0))}
+    assert not diffs, f"{name} 與參考實作不一致: {diffs}"
+    print(f"[analytics] OK  {name} ({len(keys)} 項)")
+
+
+def run_self_check(filepath="all_dataset.csv"):
+    """
+    以 all_dataset.csv 檢查每個工具函數：向量化結果必須與逐列迴圈的參考實作完全相同
+
+    Raises:
+        AssertionError: 任何一個函數的結果與參考實作不一致
+    """
+    df = pd.read_csv(filepath)
+    records = df.to_dict("records")
+    reference = _reference_rallies(records)
+    player = sorted(df["player"].dropna().unique())[0]
+    match_id = int(df["match_id"].min())
+
+    # error_counts：失分原因屬於 ERROR_REASONS 的回合數
+    expected = {}
+    for info in reference.values():
+        if info["loser"] is not None and info["lose_reason"] in ERROR_REASONS:
+            expected[info["loser"]] = expected.get(info["loser"], 0) + 1
+    _check_equal("error_counts", expected, call_analytics(df, "error_counts", {})[0]["errors"].to_dict())
+
+    # reason_counts：得分方式 / 失分原因（含球員與場次篩選）
+    for kind, who, reason in (("win", "winner", "win_reason"), ("lose", "loser", "lose_reason")):
+        expected = {}
+        for (m, _, _), info in reference.items():
+            if m == match_id and info[who] == player and not _is_missing(info[reason]):
+                expected[info[reason]] = expected.get(info[reason], 0) + 1
+        result, _ = call_analytics(df, "reason_counts", {"kind": kind, "player": player, "match_id": match_id})
+        _check_equal(f"reason_counts[{kind}]", expected, result["count"].to_dict())
+
+    # shot_type_distribution / shot_effectiveness：逐拍計數（排除「接不到」）
+    strokes = [r for r in records if r["type"] != NO_RETURN_TYPE and not _is_missing(r["type"])]
+    expected, shots, winners, errors = {}, {}, {}, {}
+    for r in strokes:
+        expected[(r["type"], r["player"])] = expected.get((r["type"], r["player"]), 0) + 1
+        if r["player"] != player:
+            continue
+        shots[r["type"]] = shots.get(r["type"], 0) + 1
+        if not _is_missing(r["lose_reason"]):
+            target = winners if r["getpoint_player"] == r["player"] else errors
+            target[r["type"]] = target.get(r["type"], 0) + 1
+    distribution = call_analytics(df, "shot_type_distribution", {})[0]
+    _check_equal("shot_type_distribution", expected,
+                 {k: v for k, v in distribution.stack().to_dict().items() if v})
+    effectiveness = call_analytics(df, "shot_effectiveness", {"player": player})[0]
+    _check_equal("shot_effectiveness[shots]", shots, effectiveness["shots"].to_dict())
+    _check_equal("shot_effectiveness[winners]", winners, effectiveness["winners"].to_dict())
+    _check_equal("shot_effectiveness[errors]", errors, effectiveness["errors"].to_dict())
+
+    # points_won：每回合的得分者 / 失分者（依局篩選）
+    won, lost = {}, {}
+    for (_, s, _), info in reference.items():
+        if s == 2 and info["loser"] is not None:
+            won[info["winner"]] = won.get(info["winner"], 0) + 1
+            lost[info["loser"]] = lost.get(info["loser"], 0) + 1
+    points = call_analytics(df, "points_won", {"set": 2.0})[0]
+    _check_equal("points_won[won]", won, points["won"].to_dict())
+    _check_equal("points_won[lost]", lost, points["lost"].to_dict())
+
+    # rally_length_stats：依實際擊球數分組
+    edges = [0, 3, 6, 10, 15]
+    expected = {}
+    for info in reference.values():
+        lo = max(e for e in edges if e < info["strokes"]) if info["strokes"] > 0 else None
+        if lo is None:
+            continue
+        hi = edges[edges.index(lo) + 1] if lo != edges[-1] else None
+        label = f"{lo + 1}-{hi}" if hi is not None else f"{lo + 1}+"
+        expected[label] = expected.get(label, 0) + 1
+    _check_equal("rally_length_stats", expected, call_analytics(df, "rally_length_stats", {})[0]["rallies"].to_dict())
+
+    # landing_area_counts：落點區域計數（含球員、球種與場次篩選）
+    shot_type = "殺球"
+    expected = {}
+    for r in records:
+        if (r["player"] == player and r["type"] == shot_type and r["match_id"] == match_id
+                and not _is_missing(r["landing_area"])):
+            key = str(int(r["landing_area"]))
+            expected[key] = expected.get(key, 0) + 1
+    result, _ = call_analytics(df, "landing_area_counts",
+                               {"player": player, "shot_type": shot_type, "match_id": match_id, "top_k": 0})
+    _check_equal("landing_area_counts", expected, result["count"].to_dict())
+
+    # key_rallies：依 |win_prob_swing| 遞減，得分者與參考實作一致
+    result, _ = call_analytics(df, "key_rallies", {"match_id": match_id, "top_k": 5})
+    swings = result["win_prob_swing"].abs().to_numpy()
+    assert len(result) == 5 and np.all(np.diff(swings) <= 0), f"key_rallies 未依擺盪幅度排序: {swings}"
+    for label, winner in result["winner"].items():
+        key = tuple(float(v) for v in label.split("-"))
+        assert reference[key]["winner"] == winner, f"key_rallies {label} 的得分者不一致"
+    print(f"[analytics] OK  key_rallies ({len(result)} 項)")
+
+    # call_analytics：相同參數（含型別不同）應命中快取
+    first, _ = call_analytics(df, "points_won", {"set": 2})
+    assert first is points, "call_analytics 未命中快取"
+    print("[analytics] 全部檢查通過。")
+
+
+if __name__ == "__main__":
+    run_self_check()
@@ -0,0 +1,316 @@
+"""
+宣告式圖表規格 (chart spec) 模式
+Declarative chart-spec mode: vetted query engine + pre-styled renderer
+
+模型只需回傳一段精簡的 JSON 圖表規格（圖表類型、資料查詢、分組、標籤），
+由這裡經過驗證的向量化查詢引擎計算資料，再用快取好的樣式模板繪製 matplotlib 圖表，
+或直接輸出成給瀏覽器 (`static/scripts.js`) 繪製的資料。
+不需要 exec 任何 AI 生成的程式碼。
+"""
+import json
+import re
+
+import numpy as np
+import pandas as pd
+import matplotlib
+from matplotlib.figure import Figure
+
+from utils.code_checker import closest_match
+from utils.fonts import resolve_font_family
+
+
+CHART_TYPES = ("bar", "barh", "stacked_bar", "pie", "line")
+METRICS = ("count", "share", "sum", "mean", "median", "max", "min")
+FILTER_OPS = ("==", "!=", ">", ">=", "<", "<=", "in", "not_in", "notna", "isna")
+MAX_TOP_K = 50
+
+# 與 create_system_prompt 中的圖表格式規範相同的配色
+SERIES_COLORS = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#FFA07A', '#98D8C8']
+PIE_COLORS = ['#E63946', '#2A9D8F', '#F4A261', '#264653', '#E76F51', '#8338EC', '#06BCC1', '#FF6B35']
+
+_STYLE_CACHE = {}
+
+
+class ChartSpecError(ValueError):
+    """圖表規格格式錯誤或參照了不存在的欄位"""
+
+
+def parse_chart_spec(response_text):
+    """
+    從模型回應中取出 JSON 圖表規格（支援 ```json 區塊或純 JSON）
+
+    Args:
+        response_text: 模型回應文字
+
+    Returns:
+        dict: 圖表規格
+
+    Raises:
+        ChartSpecError: 找不到或無法解析 JSON
+    """
+    match = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", response_text, re.DOTALL)
+    raw = match.group(1) if match else response_text[response_text.find("{"):response_text.rfind("}") + 1]
+    try:
+        spec = json.loads(raw)
+    except (json.JSONDecodeError, ValueError) as e:
+        raise ChartSpecError(f"無法解析 JSON 圖表規格: {e}")
+    if not isinstance(spec, dict):
+        raise ChartSpecError("圖表規格必須是 JSON 物件。")
+    return spec
+
+
+def validate_chart_spec(spec, catalog):
+    """
+    驗證並正規化圖表規格；欄位名稱 / 類別值只差大小寫或空白時直接修正，其他不符一律回報錯誤
+
+    Args:
+        spec: 圖表規格 (dict)
+        catalog: `utils.code_checker.build_column_catalog` 的結果
+
+    Returns:
+        dict: 正規化後的圖表規格（新物件）
+
+    Raises:
+        ChartSpecError: 無法修正的問題
+    """
+    spec = dict(spec)
+    spec.setdefault("chart", "bar")
+    spec.setdefault("table", "df")
+    spec.setdefault("metric", "count")
+    spec.setdefault("filters", [])
+    spec.setdefault("sort", "desc")
+
+    if spec["chart"] not in CHART_TYPES:
+        raise ChartSpecError(f"chart 必須是 {CHART_TYPES} 之一，收到: {spec['chart']!r}")
+    if spec["metric"] not in METRICS:
+        raise ChartSpecError(f"metric 必須是 {METRICS} 之一，收到: {spec['metric']!r}")
+    if spec["table"] not in catalog:
+        raise ChartSpecError(f"table 必須是 {list(catalog)} 之一，收到: {spec['table']!r}")
+    columns = catalog[spec["table"]]
+
+    def fix_column(name, field):
+        if name in columns:
+            return name
+        fixed = closest_match(str(name), columns)
+        if fixed is None:
+            raise ChartSpecError(f"{field} 欄位 '{name}' 不存在於 `{spec['table']}`，可用欄位: {sorted(columns)}")
+        return fixed
+
+    def fix_value(column, value):
+        values = columns.get(column)
+        if not values or not isinstance(value, str) or value in values:
+            return value
+        fixed = closest_match(value, values)
+        if fixed is None:
+            raise ChartSpecError(f"`{column}` 沒有類別值 '{value}'，可用值: {sorted(values)}")
+        return fixed
+
+    if not spec.get("x"):
+        raise ChartSpecError("缺少 x（分組欄位）。")
+    spec["x"] = fix_column(spec["x"], "x")
+    if spec.get("series"):
+        spec["series"] = fix_column(spec["series"], "series")
+    if spec["metric"] not in ("count", "share"):
+        if not spec.get("value_column"):
+            raise ChartSpecError(f"metric '{spec['metric']}' 需要 value_column。")
+        spec["value_column"] = fix_column(spec["value_column"], "value_column")
+
+    filters = []
+    for f in spec["filters"]:
+        if not isinstance(f, dict) or "column" not in f:
+            raise ChartSpecError(f"filters 的每一項都必須包含 column: {f!r}")
+        op = f.get("op", "==")
+        if op not in FILTER_OPS:
+            raise ChartSpecError(f"filter op 必須是 {FILTER_OPS} 之一，收到: {op!r}")
+        column = fix_column(f["column"], "filter")
+        value = f.get("value")
+        if op in ("in", "not_in"):
+            value = [fix_value(column, v) for v in (value if isinstance(value, list) else [value])]
+        else:
+            value = fix_value(column, value)
+        filters.append({"column": column, "op": op, "value": value})
+    spec["filters"] = filters
+
+    if spec.get("top_k") is not None:
+        spec["top_k"] = max(1, min(int(spec["top_k"]), MAX_TOP_K))
+    return spec
+
+
+def _filter_mask(table, filters):
+    """向量化建立篩選遮罩"""
+    mask = np.ones(len(table), dtype=bool)
+    for f in filters:
+        col = table[f["column"]]
+        op, value = f["op"], f["value"]
+        if op == "==":
+            cond = col == value
+        elif op == "!=":
+            cond = col != value
+        elif op == ">":
+            cond = col > value
+        elif op == ">=":
+            cond = col >= value
+        elif op == "<":
+            cond = col < value
+        elif op == "<=":
+            cond = col <= value
+        elif op == "in":
+            cond = col.isin(value)
+        elif op == "not_in":
+            cond = ~col.isin(value)
+        elif op == "notna":
+            cond = col.notna()
+        else:
+            cond = col.isna()
+        mask &= cond.to_numpy(dtype=bool)
+    return mask
+
+
+def execute_chart_spec(spec, frames):
+    """
+    執行（已驗證的）圖表規格
+
+    Args:
+        spec: `validate_chart_spec` 的結果
+        frames: dict，資料表名稱 -> pd.DataFrame
+
+    Returns:
+        pd.DataFrame: index 為 x 的類別，每個欄位為一個系列（無 series 時只有 'value' 一欄）
+    """
+    table = frames[spec["table"]]
+    table = table[_filter_mask(table, spec["filters"])]
+    keys = [spec["x"]] + ([spec["series"]] if spec.get("series") else [])
+    metric = spec["metric"]
+
+    if metric in ("count", "share"):
+        data = table.groupby(keys, sort=False).size()
+    else:
+        data = table.groupby(keys, sort=False)[spec["value_column"]].agg(metric)
+
+    if spec.get("series"):
+        data = data.unstack(spec["series"], fill_value=0)
+    else:
+        data = data.to_frame("value")
+    if metric == "share":
+        data = data / data.to_numpy().sum() if data.to_numpy().sum() else data
+
+    if spec["sort"] in ("desc", "asc"):
+        order = data.sum(axis=1).sort_values(ascending=spec["sort"] == "asc").index
+        data = data.loc[order]
+    elif spec["chart"] == "line":
+        data = data.sort_index()
+    if spec.get("top_k"):
+        data = data.head(spec["top_k"])
+    data.index = data.index.map(str)
+    data.columns = data.columns.map(str)
+    return data
+
+
+def chart_payload(spec, data):
+    """
+    將查詢結果轉成給瀏覽器繪製的 JSON 資料
+
+    Returns:
+        dict: {chart, title, x_label, y_label, labels, series: [{name, values}]}
+    """
+    return {
+        "chart": spec["chart"],
+        "title": spec.get("title", ""),
+        "x_label": spec.get("x_label", spec["x"]),
+        "y_label": spec.get("y_label", spec["metric"]),
+        "labels": list(data.index),
+        "series": [
+            {"name": col, "values": [None if pd.isna(v) else float(v) for v in data[col].to_numpy()]}
+            for col in data.columns
+        ],
+        "colors": PIE_COLORS if spec["chart"] == "pie" else SERIES_COLORS,
+    }
+
+
+def _style(font_path_or_name):
+    """取得（並快取）預先設定好的樣式：字型、字級"""
+    if font_path_or_name not in _STYLE_CACHE:
+        family = resolve_font_family(font_path_or_name)
+        style = {
+            "axes.unicode_minus": False,
+            "axes.titlesize": 16,
+            "axes.titleweight": "bold",
+            "axes.labelsize": 12,
+            "xtick.labelsize": 10,
+            "ytick.labelsize": 10,
+            "legend.fontsize": 10,
+        }
+        if family:
+            style["font.sans-serif"] = [family] + list(matplotlib.rcParams["font.sans-serif"])
+        _STYLE_CACHE[font_path_or_name] = style
+    return _STYLE_CACHE[font_path_or_name]
+
+
+def render_chart(spec, data, font_path_or_name=None):
+    """
+    以預先設定好的樣式模板繪製圖表（使用 Figure 物件，不經過 pyplot 全域狀態）
+
+    Args:
+        spec: 圖表規格
+        data: `execute_chart_spec` 的結果
+        font_path_or_name: 中文字型
+
+    Returns:
+        matplotlib.figure.Figure
+    """
+    with matplotlib.rc_context(_style(font_path_or_name)):
+        fig = Figure(figsize=(12, 7))
+        ax = fig.subplots()
+        chart = spec["chart"]
+        positions = np.arange(len(data))
+
+        if chart == "pie":
+            values = data.iloc[:, 0].to_numpy()
+            wedges, _, autotexts = ax.pie(
+                values, autopct='%1.1f%%', startangle=90, pctdistance=0.85,
+                colors=PIE_COLORS[:len(values)] if len(values) <= len(PIE_COLORS) else None,
+            )
+            for autotext in autotexts:
+                autotext.set_color('white')
+                autotext.set_fontweight('bold')
+            ax.legend(wedges, data.index, loc='center left', bbox_to_anchor=(1, 0, 0.5, 1), fontsize=11)
+        elif chart == "line":
+            for k, col in enumerate(data.columns):
+                ax.plot(positions, data[col].to_numpy(), marker='o',
+                        color=SERIES_COLORS[k % len(SERIES_COLORS)], label=col)
+        elif chart == "barh":
+            width = 0.8 / len(data.columns)
+            for k, col in enumerate(data.columns):
+                ax.barh(positions + k * width, data[col].to_numpy(), width,
+                        color=SERIES_COLORS[k % len(SERIES_COLORS)], alpha=0.8, label=col)
+            ax.set_yticks(positions + width * (len(data.columns) - 1) / 2)
+            ax.set_yticklabels(data.index)
+        else:
+            bottom = np.zeros(len(data))
+            width = 0.8 if chart == "stacked_bar" else 0.8 / len(data.columns)
+            for k, col in enumerate(data.columns):
+                values = data[col].to_numpy(dtype=float)
+                if chart == "stacked_bar":
+                    ax.bar(positions, values, width, bottom=bottom,
+                           color=SERIES_COLORS[k % len(SERIES_COLORS)], alpha=0.8, label=col)
+                    bottom += values
+                else:
+                    bars = ax.bar(positions + k * width, values, width,
+                                  color=SERIES_COLORS[k % len(SERIES_COLORS)] if len(data.columns) > 1 else 'steelblue',
+                                  alpha=0.8, label=col)
+                    if len(data.columns) == 1:
+                        ax.bar_label(bars, fmt='%.3g', fontsize=10)
+
+        if chart in ("bar", "stacked_bar", "line"):
+            offset = 0 if chart != "bar" else 0.8 / len(data.columns) * (len(data.columns) - 1) / 2
+            ax.set_xticks(positions + offset)
+            ax.set_xticklabels(data.index, rotation=45, ha='right')
+        if chart != "pie":
+            ax.set_xlabel(spec.get("x_label", spec["x"]))
+            ax.set_ylabel(spec.get("y_label", spec["metric"]))
+            ax.grid(True, alpha=0.3, linestyle='--', axis='x' if chart == "barh" else 'y')
+            if len(data.columns) > 1:
+                ax.legend(loc='best')
+        ax.set_title(spec.get("title", ""), pad=20)
+        fig.tight_layout()
+    return fig
@@ -0,0 +1,409 @@
+"""
+AI 生成程式碼的靜態檢查與本地修正
+AST pre-validation and local auto-repair of generated code before exec
+
+在 exec 之前先用 `ast` 解析 AI 生成的程式碼：
+- 可以機械式修正的問題（重新讀取資料集的 `pd.read_csv`、`plt.show()`、缺少 `fig`、缺少 import、
+  欄位名稱 / 類別值只差大小寫或空白）直接在本地修正，不必再呼叫一次 LLM；
+- 無法修正的問題（語法錯誤、讀取其他檔案、不存在的欄位或類別值）回報為錯誤，交給 LLM 的修正提示處理。
+  相近但不同的名稱（例如 '發球' 與 '發短球'）可能代表不同的東西，只列為建議，不自動替換。
+  函式參數、lambda 與 comprehension 中重新綁定的名稱（例如 `def f(df): ...`）不是已載入的資料表，不檢查。
+"""
+import ast
+import difflib
+import os
+
+import pandas as pd
+
+from utils.data_loader import DATA_FILE
+
+
+# 類別欄位：唯一值數量不超過此值的字串欄位才會檢查類別值
+MAX_CATEGORY_VALUES = 60
+# 錯誤訊息中「是否為 ...」建議的相似度門檻（只用於提示，不會自動替換）
+SUGGEST_CUTOFF = 0.6
+
+# 常見模組別名 -> 自動補上的 import
+AUTO_IMPORTS = {
+    "np": "import numpy as np",
+    "plt": "import matplotlib.pyplot as plt",
+    "fm": "import matplotlib.font_manager as fm",
+    "sns": "import seaborn as sns",
+}
+
+# 巢狀作用域：其中的參數、迴圈變數與區域變數會遮蔽同名的資料表
+_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+# 只篩選 / 排序列、不改變欄位的方法（`df = df.dropna(...)` 之後仍可檢查欄位）
+ROW_METHODS = {"copy", "dropna", "fillna", "query", "sort_values", "sort_index", "head", "tail", "sample",
+               "drop_duplicates", "nlargest", "nsmallest"}
+
+
+class CodeValidationError(Exception):
+    """靜態檢查發現無法在本地修正的問題"""
+
+
+def build_column_catalog(frames):
+    """
+    建立欄位與類別值目錄
+
+    Args:
+        frames: dict，變數名稱 -> pd.DataFrame（例如 {'df': df, 'rallies': rallies}）
+
+    Returns:
+        dict: 變數名稱 -> {欄位名稱: 類別值集合 或 None（非類別欄位）}
+    """
+    catalog = {}
+    for name, frame in frames.items():
+        if frame is None:
+            continue
+        columns = {}
+        for col in frame.columns:
+            values = None
+            if pd.api.types.is_object_dtype(frame[col]) or pd.api.types.is_string_dtype(frame[col]):
+                uniques = frame[col].dropna().unique()
+                if len(uniques) <= MAX_CATEGORY_VALUES:
+                    values = frozenset(str(v) for v in uniques)
+            columns[str(col)] = values
+        catalog[name] = columns
+    return catalog
+
+
+def _normalize(value):
+    """去除所有空白並轉為小寫"""
+    return "".join(value.split()).lower()
+
+
+def closest_match(value, candidates):
+    """
+    找出只差大小寫或空白的候選值（唯一符合時才回傳）
+
+    其他差異（少字、多字、近似詞）可能是不同的類別，交給 `suggest_match` 提示即可。
+    """
+    key = _normalize(value)
+    matches = [c for c in candidates if _normalize(c) == key]
+    return matches[0] if len(matches) == 1 else None
+
+
+def suggest_match(value, candidates):
+    """錯誤訊息用的相近候選值（difflib 模糊比對），找不到時回傳 None"""
+    matches = difflib.get_close_matches(value, sorted(candidates), n=1, cutoff=SUGGEST_CUTOFF)
+    return matches[0] if matches else None
+
+
+def _hint(value, candidates):
+    suggestion = suggest_match(value, candidates)
+    return f"（是否為 '{suggestion}'？）" if suggestion else ""
+
+
+def _reads_dataset(call):
+    """`pd.read_csv(...)` 的路徑是否為資料集檔案（只有這種情況可以改用已載入的 df）"""
+    path = call.args[0] if call.args else next(
+        (kw.value for kw in call.keywords if kw.arg == "filepath_or_buffer"), None)
+    return (isinstance(path, ast.Constant) and isinstance(path.value, str)
+            and os.path.basename(path.value) == DATA_FILE)
+
+
+def _is_read_csv(node):
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "read_csv"
+            and isinstance(node.func.value, ast.Name) and node.func.value.id == "pd")
+
+
+def _local_names(scope):
+    """巢狀作用域中重新綁定的名稱：函式 / lambda 的參數與區域變數、comprehension 的迴圈變數"""
+    if isinstance(scope, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        return {n.id for gen in scope.generators for n in ast.walk(gen.target) if isinstance(n, ast.Name)}
+    args = scope.args
+    names = {arg.arg for arg in args.posonlyargs + args.args + args.kwonlyargs}
+    names.update(arg.arg for arg in (args.vararg, args.kwarg) if arg is not None)
+    if not isinstance(scope, ast.Lambda):
+        declared = {name for node in ast.walk(scope) if isinstance(node, (ast.Global, ast.Nonlocal))
+                    for name in node.names}
+        names.update(node.id for stmt in scope.body for node in ast.walk(stmt)
+                     if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store) and node.id not in declared)
+    return names
+
+
+def _module_level_nodes(tree):
+    """走訪模組層級的節點（不進入函式、lambda、comprehension 等巢狀作用域）"""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(child for child in ast.iter_child_nodes(node) if not isinstance(child, _SCOPES))
+
+
+def _string_constants(node):
+    """取出 node 中（單一字串或字串 list / tuple / set）的字串常數節點"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node]
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return [elt for elt in node.elts if isinstance(elt, ast.Constant) and isinstance(elt.value, str)]
+    return []
+
+
+class _Repairer(ast.NodeTransformer):
+    """走訪 AST，修正可機械式處理的問題並記錄無法修正的問題"""
+
+    def __init__(self, catalog, created_columns):
+        self.catalog = catalog
+        self.created_columns = created_columns
+        self.repairs = []
+        self.errors = []
+        self.shadowed = []
+
+    # --- 巢狀作用域：遮蔽資料表名稱的參數 / 區域變數不檢查 ---
+    def _visit_scope(self, node):
+        self.shadowed.append(_local_names(node))
+        self.generic_visit(node)
+        self.shadowed.pop()
+        return node
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_Lambda = _visit_scope
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_scope
+
+    # --- 欄位參照：df['col'] / df[['a', 'b']] ---
+    def _column_ref(self, node):
+        """若 node 為 <已知資料表>[...]，回傳 (資料表名稱, 欄位字串節點 list)"""
+        if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+                and node.value.id in self.catalog
+                and not any(node.value.id in names for names in self.shadowed)):
+            return node.value.id, _string_constants(node.slice)
+        return None, []
+
+    def _fix_column(self, frame, const):
+        columns = self.catalog[frame]
+        name = const.value
+        if name in columns or name in self.created_columns.get(frame, ()):
+            return name
+        fixed = closest_match(name, columns)
+        if fixed is not None:
+            self.repairs.append(f"欄位 `{frame}['{name}']` 不存在，已改為 `{fixed}`")
+            const.value = fixed
+            return fixed
+        self.errors.append(f"欄位 `{frame}['{name}']` 不存在{_hint(name, columns)}，可用欄位: {sorted(columns)}")
+        return None
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        frame, consts = self._column_ref(node)
+        if frame and isinstance(node.ctx, ast.Load):
+            for const in consts:
+                self._fix_column(frame, const)
+        return node
+
+    # --- 類別值：df['type'] == '殺球' / df['type'].isin([...]) ---
+    def _fix_category(self, frame, column, consts):
+        values = self.catalog.get(frame, {}).get(column)
+        if not values:
+            return
+        for const in consts:
+            if const.value in values:
+                continue
+            fixed = closest_match(const.value, values)
+            if fixed is not None:
+                self.repairs.append(f"`{column}` 的類別值 '{const.value}' 不存在，已改為 '{fixed}'")
+                const.value = fixed
+            else:
+                self.errors.append(
+                    f"`{column}` 沒有類別值 '{const.value}'{_hint(const.value, values)}，可用值: {sorted(values)}"
+                )
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        operands = [node.left] + node.comparators
+        for left, right in zip(operands, operands[1:]):
+            for col_node, value_node in ((left, right), (right, left)):
+                frame, consts = self._column_ref(col_node)
+                if frame and len(consts) == 1:
+                    self._fix_category(frame, consts[0].value, _string_constants(value_node))
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        # pd.read_csv('all_dataset.csv') -> df.copy()（df 已存在於執行環境）；其他檔案不允許讀取
+        if _is_read_csv(node):
+            if not _reads_dataset(node):
+                self.errors.append(f"不可讀取其他檔案 `{ast.unparse(node)}`，請直接使用已載入的 `df` 等資料表")
+                return node
+            self.repairs.append(f"移除 `pd.read_csv('{DATA_FILE}')`，改用已載入的 `df`")
+            return ast.copy_location(
+                ast.Call(func=ast.Attribute(value=ast.Name(id="df", ctx=ast.Load()), attr="copy", ctx=ast.Load()),
+                         args=[], keywords=[]),
+                node,
+            )
+        # df['type'].isin([...])
+        if isinstance(func, ast.Attribute) and func.attr == "isin" and node.args:
+            frame, consts = self._column_ref(func.value)
+            if frame and len(consts) == 1:
+                self._fix_category(frame, consts[0].value, _string_constants(node.args[0]))
+        return node
+
+    def visit_Expr(self, node):
+        self.generic_visit(node)
+        call = node.value
+        # plt.show() 在伺服器端沒有意義，直接移除
+        if (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute)
+                and call.func.attr == "show" and isinstance(call.func.value, ast.Name)
+                and call.func.value.id == "plt"):
+            self.repairs.append("移除 `plt.show()`")
+            return None
+        return node
+
+
+def _keeps_columns(value, name):
+    """
+    賦值右側是否保留 `name` 原本的欄位：
+    `pd.read_csv('all_dataset.csv')`（只對 df）、`name` 本身、只篩選列的 `name[mask]` / `name.loc[mask]` /
+    `name.loc[mask, :]`，以及鏈接在這些之後的 ROW_METHODS（例如 `df[df['set'] == 1].sort_values('rally')`）
+    """
+    if isinstance(value, ast.Name):
+        return value.id == name
+    if _is_read_csv(value):
+        return name == "df" and _reads_dataset(value)
+    if isinstance(value, ast.Subscript):
+        rows = value.slice
+        if isinstance(value.value, ast.Attribute) and value.value.attr in ("loc", "iloc"):
+            # name.loc[rows] / name.loc[rows, :]；指定欄位 (name.loc[rows, cols]) 則不算
+            if isinstance(rows, ast.Tuple):
+                columns = rows.elts[1] if len(rows.elts) == 2 else None
+                if not (isinstance(columns, ast.Slice) and columns.lower is None
+                        and columns.upper is None and columns.step is None):
+                    return False
+            return _keeps_columns(value.value.value, name)
+        # 布林遮罩 (name[name['set'] == 1]、name[~mask]、name[name['type'].isin(...)]) 或列切片只篩選列；
+        # 字串、list 或變數 (可能是欄位名稱) 則視為選取欄位
+        if isinstance(rows, (ast.Compare, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Call, ast.Slice)):
+            return _keeps_columns(value.value, name)
+        return False
+    if isinstance(value, ast.Call) and isinstance(value.func, ast.Attribute):
+        keywords = {kw.arg: kw.value for kw in value.keywords if kw.arg}
+        if _is_true(keywords.get("inplace")):
+            return False
+        if value.func.attr in ROW_METHODS or (value.func.attr == "reset_index" and _is_true(keywords.get("drop"))):
+            return _keeps_columns(value.func.value, name)
+    return False
+
+
+def _reassigned_frames(tree, catalog):
+    """
+    程式碼中（模組層級）被重新賦值、欄位無法靜態得知的資料表名稱（例如 df = df.groupby(...)）；
+    只篩選列的賦值（例如 df = df[df['set'] == 1]）不算，函式內以 global 宣告的資料表一律算
+    """
+    harmless = set()
+    for node in _module_level_nodes(tree):
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and _keeps_columns(node.value, target.id):
+                    harmless.add(id(target))
+    reassigned = {
+        node.id for node in _module_level_nodes(tree)
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+        and node.id in catalog and id(node) not in harmless
+    }
+    reassigned.update(name for node in ast.walk(tree) if isinstance(node, (ast.Global, ast.Nonlocal))
+                      for name in node.names if name in catalog)
+    return reassigned
+
+
+def _is_true(node):
+    return isinstance(node, ast.Constant) and node.value is True
+
+
+def _created_columns(tree, catalog):
+    """
+    收集程式碼中新增的欄位，這些欄位不算錯誤：
+    df['new'] = ... / df.loc[:, 'new'] = ... / df.assign(new=...) /
+    df.insert(loc, 'new', ...) / df.rename(columns={...}, inplace=True)
+    """
+    created = {}
+
+    def add(frame, consts):
+        created.setdefault(frame, set()).update(const.value for const in consts)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.ctx, ast.Store):
+            # df['new'] = ...
+            if isinstance(node.value, ast.Name) and node.value.id in catalog:
+                add(node.value.id, _string_constants(node.slice))
+            # df.loc[:, 'new'] = ... / df.at[0, 'new'] = ...
+            elif (isinstance(node.value, ast.Attribute) and node.value.attr in ("loc", "at")
+                    and isinstance(node.value.value, ast.Name) and node.value.value.id in catalog
+                    and isinstance(node.slice, ast.Tuple) and len(node.slice.elts) == 2):
+                add(node.value.value.id, _string_constants(node.slice.elts[1]))
+
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and isinstance(node.func.value, ast.Name) and node.func.value.id in catalog):
+            continue
+        frame, method = node.func.value.id, node.func.attr
+        keywords = {kw.arg: kw.value for kw in node.keywords if kw.arg}
+        if method == "assign":
+            created.setdefault(frame, set()).update(keywords)
+        elif method == "insert":
+            column = node.args[1] if len(node.args) > 1 else keywords.get("column")
+            add(frame, _string_constants(column) if column is not None else [])
+        elif method == "rename" and _is_true(keywords.get("inplace")):
+            mapping = keywords.get("columns")
+            if isinstance(mapping, ast.Dict):
+                add(frame, [v for v in mapping.values
+                            if isinstance(v, ast.Constant) and isinstance(v.value, str)])
+    return created
+
+
+def validate_and_repair(code, catalog, predefined_names=()):
+    """
+    靜態檢查並修正 AI 生成的程式碼
+
+    Args:
+        code: AI 生成的 Python 程式碼
+        catalog: `build_column_catalog` 的結果
+        predefined_names: 執行環境中已存在的變數名稱（不需要 import）
+
+    Returns:
+        dict: {
+            "code": 修正後的程式碼（沒有修正時與原本相同）,
+            "repairs": 已在本地修正的項目 (list of str),
+            "errors": 無法在本地修正、需要 LLM 處理的問題 (list of str)
+        }
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return {"code": code, "repairs": [], "errors": [f"語法錯誤 (第 {e.lineno} 行): {e.msg}"]}
+
+    reassigned = _reassigned_frames(tree, catalog)
+    checked_catalog = {name: cols for name, cols in catalog.items() if name not in reassigned}
+    repairer = _Repairer(checked_catalog, _created_columns(tree, checked_catalog))
+    # 移除敘述後若區塊變成空的（例如 if / else / finally 內只有 plt.show()），補上 pass
+    blocks = [(node, field) for node in ast.walk(tree) if not isinstance(node, ast.Module)
+              for field in ("body", "orelse", "finalbody") if getattr(node, field, None)]
+    tree = repairer.visit(tree)
+    for node, field in blocks:
+        if getattr(node, field) == []:
+            setattr(node, field, [ast.Pass()])
+
+    # 補上缺少的 import
+    imported = set(predefined_names)
+    assigned = set()
+    used = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imported.update((alias.asname or alias.name).split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.Name):
+            (assigned if isinstance(node.ctx, ast.Store) else used).add(node.id)
+    missing_imports = [
+        AUTO_IMPORTS[name] for name in AUTO_IMPORTS
+        if name in used and name not in imported and name not in assigned
+    ]
+    if missing_imports:
+        tree.body[0:0] = ast.parse("\n".join(missing_imports)).body
+        repairer.repairs.extend(f"補上 `{line}`" for line in missing_imports)
+
+    # 有畫圖但沒有指定 fig
+    if "plt" in used and "fig" not in assigned:
+        tree.body.extend(ast.parse("fig = plt.gcf()").body)
+        repairer.repairs.append("補上 `fig = plt.gcf()`")
+
+    if repairer.repairs:
+        code = ast.unparse(ast.fix_missing_locations(tree))
+    return {"code": code, "repairs": repairer.repairs, "errors": repairer.errors}
@@ -0,0 +1,220 @@
+"""
+對話記憶：伺服器端 session 儲存與歷史壓縮
+Server-side conversation sessions (LRU + TTL) and bounded history compaction
+
+每一輪只保留「問題、程式碼摘要、關鍵結果、洞察開頭」，而不是完整的程式碼區塊與洞察；
+組合歷史時由新到舊放入，直到用完 token 預算，所以追問的成本與第一個問題差不多，
+不會隨著輪數線性增加。
+"""
+import ast
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from utils.result_summary import estimate_tokens
+
+
+HISTORY_TOKEN_BUDGET = 800
+MAX_CODE_DIGEST_CHARS = 200
+MAX_INSIGHT_CHARS = 200
+MAX_KEY_RESULT_CHARS = 400
+MAX_SESSIONS = 256
+SESSION_TTL_SECONDS = 60 * 60
+MAX_TURNS_PER_SESSION = 20
+
+# 壓縮後的模型回合開頭（用來辨識已壓縮的歷史）
+COMPACT_MARKER = "[前次分析摘要]"
+
+
+def code_digest(code, max_chars=MAX_CODE_DIGEST_CHARS):
+    """
+    程式碼的簡短摘要：使用的資料表、欄位、分組鍵與圖表種類
+
+    Args:
+        code: 執行的程式碼
+        max_chars: 摘要長度上限
+
+    Returns:
+        str
+    """
+    if not code:
+        return ""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code.strip().splitlines()[0][:max_chars] if code.strip() else ""
+
+    tables, columns, groupby, charts = [], [], [], []
+
+    def add(items, value):
+        if value not in items:
+            items.append(value)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+            add(tables, node.value.id)
+            if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+                add(columns, node.slice.value)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            method = node.func.attr
+            if method == "groupby" and node.args:
+                arg = node.args[0]
+                keys = arg.elts if isinstance(arg, (ast.List, ast.Tuple)) else [arg]
+                for key in keys:
+                    if isinstance(key, ast.Constant):
+                        add(groupby, str(key.value))
+            elif method in ("bar", "barh", "pie", "plot", "scatter", "hist", "imshow") or method == "draw_court_heatmap":
+                add(charts, method)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "draw_court_heatmap":
+            add(charts, "draw_court_heatmap")
+
+    parts = []
+    if tables:
+        parts.append("資料: " + ", ".join(tables[:4]))
+    if columns:
+        parts.append("欄位: " + ", ".join(columns[:8]))
+    if groupby:
+        parts.append("分組: " + ", ".join(groupby[:4]))
+    if charts:
+        parts.append("圖表: " + ", ".join(charts[:3]))
+    digest = "；".join(parts)
+    return digest[:max_chars]
+
+
+def _clip(text, max_chars):
+    text = (text or "").strip()
+    return text if len(text) <= max_chars else text[:max_chars] + "…"
+
+
+def compact_model_turn(code=None, key_results=None, insight=None):
+    """
+    組合壓縮後的模型回合文字
+
+    Args:
+        code: 執行的程式碼（只保留摘要）
+        key_results: 關鍵結果摘要文字
+        insight: 洞察文字（只保留開頭）
+
+    Returns:
+        str
+    """
+    lines = [COMPACT_MARKER]
+    digest = code_digest(code)
+    if digest:
+        lines.append(f"程式碼摘要: {digest}")
+    if key_results:
+        lines.append(f"關鍵結果:\n{_clip(key_results, MAX_KEY_RESULT_CHARS)}")
+    if insight:
+        lines.append(f"結論: {_clip(insight, MAX_INSIGHT_CHARS)}")
+    return "\n".join(lines)
+
+
+def _message_text(message):
+    """取出 {'role', 'parts'} 訊息中的文字"""
+    return "\n".join(part for part in message.get("parts", []) if isinstance(part, str))
+
+
+def compact_history(history, token_budget=HISTORY_TOKEN_BUDGET):
+    """
+    將歷史訊息壓縮到 token 預算內：由新到舊保留完整的「問題 / 回答」配對，
+    尚未壓縮的模型回答（完整程式碼 + 洞察）會先截斷。
+
+    Args:
+        history: [{'role': 'user'|'model', 'parts': [str]}, ...]
+        token_budget: 歷史的 token 上限（估計值）
+
+    Returns:
+        list: 壓縮後的歷史（仍為 user / model 交替）
+    """
+    if not history:
+        return []
+    pairs = []
+    pending_user = None
+    for message in history:
+        if message.get("role") == "user":
+            pending_user = message
+        elif message.get("role") == "model" and pending_user is not None:
+            pairs.append((pending_user, message))
+            pending_user = None
+
+    kept, remaining = [], token_budget
+    for user, model in reversed(pairs):
+        question = _clip(_message_text(user), MAX_INSIGHT_CHARS)
+        answer = _message_text(model)
+        if not answer.startswith(COMPACT_MARKER):
+            answer = _clip(answer, MAX_KEY_RESULT_CHARS)
+        cost = estimate_tokens(question) + estimate_tokens(answer)
+        if cost > remaining:
+            break
+        kept.append(({"role": "user", "parts": [question]}, {"role": "model", "parts": [answer]}))
+        remaining -= cost
+
+    compacted = []
+    for user, model in reversed(kept):
+        compacted.extend([user, model])
+    return compacted
+
+
+class ConversationStore:
+    """
+    教練對話 session 的記憶體儲存：最多 max_sessions 個 (LRU)，閒置超過 ttl_seconds 即過期
+
+    每個 session 保存壓縮後的歷史訊息（最多 MAX_TURNS_PER_SESSION 輪）。
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl_seconds=SESSION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions = OrderedDict()  # session_id -> {"history": [...], "last_access": float}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def _evict(self, now):
+        """移除過期的 session，並在超過上限時移除最久未使用的"""
+        expired = [sid for sid, s in self._sessions.items() if now - s["last_access"] > self.ttl_seconds]
+        for sid in expired:
+            del self._sessions[sid]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def get_history(self, session_id):
+        """
+        取得 session 的歷史（不存在或已過期時回傳空 list）
+
+        Returns:
+            list: 歷史訊息的副本
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                return []
+            session["last_access"] = now
+            self._sessions.move_to_end(session_id)
+            return list(session["history"])
+
+    def append_turn(self, session_id, user_message, model_message):
+        """新增一輪對話（只保留最近 MAX_TURNS_PER_SESSION 輪；與上一輪完全相同時不重複加入）"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.setdefault(session_id, {"history": [], "last_access": now})
+            # 合併的請求（例如連點兩下）會帶回相同的一輪，只保留一次
+            if session["history"][-2:] != [user_message, model_message]:
+                session["history"].extend([user_message, model_message])
+            session["history"] = session["history"][-2 * MAX_TURNS_PER_SESSION:]
+            session["last_access"] = now
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+
+    def reset(self, session_id):
+        """清除 session 的歷史"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
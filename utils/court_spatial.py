@@ -0,0 +1,191 @@
+"""
+球場空間分析模組
+Court spatial engine: cached 2D heatmaps for hit, landing and player positions
+
+將擊球點、落點與球員站位座標以 NumPy `histogram2d` 分箱成固定的球場網格，
+並以 `*_area` 欄位統計區域次數。結果依 (資料集版本, 條件) 快取，
+資料集版本在載入時計算一次（`cached_dataset_version`），同一張熱區圖第二次查詢只是一次字典查找。
+"""
+import numpy as np
+import pandas as pd
+
+from utils.data_loader import cached_dataset_version
+
+
+# 座標種類 -> (x 欄位, y 欄位, 區域欄位)
+SPATIAL_KINDS = {
+    "hit": ("hit_x", "hit_y", "hit_area"),
+    "landing": ("landing_x", "landing_y", "landing_area"),
+    "player": ("player_location_x", "player_location_y", "player_location_area"),
+    "opponent": ("opponent_location_x", "opponent_location_y", "opponent_location_area"),
+}
+
+# 固定球場網格（資料座標已正規化；超出範圍的點會歸入最外圈的格子）
+COURT_X_RANGE = (-1.0, 1.0)
+COURT_Y_RANGE = (-0.5, 1.0)
+GRID_SHAPE = (15, 10)  # (y 方向格數, x 方向格數)
+NUM_AREAS = 33
+
+_GRID_CACHE = {}
+_AREA_CACHE = {}
+_MAX_CACHE_ENTRIES = 512
+
+# 給 LLM 的說明（注入到系統指令中）
+COURT_SPATIAL_DESCRIPTION = """- 球場熱區函數（已快取，畫落點 / 擊球點 / 站位分布時請優先使用）：
+  - `court_grid(df, kind, match_id=None, player=None, shot_type=None, outcome=None, normalize=False)`：
+    回傳 shape 為 (15, 10) 的 np.ndarray 次數網格。`kind` 為 'hit' / 'landing' / 'player' / 'opponent'；
+    `outcome` 為 'win'（該拍直接得分）或 'lose'（該拍直接失分），None 代表所有擊球。
+  - `area_counts(df, kind, ...)`：同樣的篩選條件，回傳各 `*_area` 區域的次數 (pd.Series)。
+  - `composite_grids(grid_a, grid_b, normalize=True)`：回傳 A 減 B 的差異網格（預設先轉為比例）。
+  - `draw_court_heatmap(ax, grid, title=None, cmap='YlOrRd')`：把網格畫在 matplotlib 的 ax 上。"""
+
+
+def grid_edges():
+    """
+    取得固定球場網格的邊界
+
+    Returns:
+        tuple: (x_edges, y_edges) 兩個 np.ndarray
+    """
+    ny, nx = GRID_SHAPE
+    x_edges = np.linspace(COURT_X_RANGE[0], COURT_X_RANGE[1], nx + 1)
+    y_edges = np.linspace(COURT_Y_RANGE[0], COURT_Y_RANGE[1], ny + 1)
+    return x_edges, y_edges
+
+
+def _filter_mask(df, match_id=None, player=None, shot_type=None, outcome=None):
+    """依條件建立布林遮罩（向量化）"""
+    mask = np.ones(len(df), dtype=bool)
+    if match_id is not None:
+        mask &= df["match_id"].to_numpy() == match_id
+    if player is not None:
+        mask &= (df["player"] == player).to_numpy()
+    if shot_type is not None:
+        mask &= (df["type"] == shot_type).to_numpy()
+    if outcome is not None:
+        # 只有結束回合的那一拍才有 win_reason / lose_reason
+        ends_rally = df["lose_reason"].notna().to_numpy()
+        hitter_won = (df["getpoint_player"] == df["player"]).to_numpy()
+        if outcome == "win":
+            mask &= ends_rally & hitter_won
+        elif outcome == "lose":
+            mask &= ends_rally & ~hitter_won
+        else:
+            raise ValueError(f"outcome 必須是 'win'、'lose' 或 None，收到: {outcome!r}")
+    return mask
+
+
+def _cache_put(cache, key, value):
+    """寫入快取，超過上限時丟棄最舊的項目"""
+    if len(cache) >= _MAX_CACHE_ENTRIES:
+        cache.pop(next(iter(cache)))
+    cache[key] = value
+
+
+def court_grid(df, kind, match_id=None, player=None, shot_type=None, outcome=None, normalize=False):
+    """
+    取得（並快取）指定條件下的球場熱區網格
+
+    Args:
+        df: 逐拍資料 DataFrame
+        kind: 座標種類 ('hit', 'landing', 'player', 'opponent')
+        match_id: 篩選場次 (可選)
+        player: 篩選擊球者 (可選)
+        shot_type: 篩選球種，對應 `type` 欄位 (可選)
+        outcome: 'win' / 'lose' / None，見 `_filter_mask`
+        normalize: True 時回傳比例（總和為 1）而非次數
+
+    Returns:
+        np.ndarray: shape 為 GRID_SHAPE 的網格，[row, col] = [y 格, x 格]
+    """
+    if kind not in SPATIAL_KINDS:
+        raise ValueError(f"未知的座標種類: {kind!r}，可用: {list(SPATIAL_KINDS)}")
+
+    key = (cached_dataset_version(df), kind, match_id, player, shot_type, outcome)
+    grid = _GRID_CACHE.get(key)
+    if grid is None:
+        x_col, y_col, _ = SPATIAL_KINDS[kind]
+        mask = _filter_mask(df, match_id, player, shot_type, outcome)
+        x = df[x_col].to_numpy(dtype=float)[mask]
+        y = df[y_col].to_numpy(dtype=float)[mask]
+        valid = ~(np.isnan(x) | np.isnan(y))
+        x_edges, y_edges = grid_edges()
+        # 超出範圍的點歸入最外圈的格子，避免被 histogram2d 丟棄
+        x = np.clip(x[valid], x_edges[0], x_edges[-1])
+        y = np.clip(y[valid], y_edges[0], y_edges[-1])
+        grid, _, _ = np.histogram2d(y, x, bins=[y_edges, x_edges])
+        grid.setflags(write=False)
+        _cache_put(_GRID_CACHE, key, grid)
+
+    if normalize:
+        total = grid.sum()
+        return grid / total if total else grid.copy()
+    return grid
+
+
+def area_counts(df, kind, match_id=None, player=None, shot_type=None, outcome=None):
+    """
+    取得（並快取）指定條件下各 `*_area` 區域的次數
+
+    Args:
+        df: 逐拍資料 DataFrame
+        kind: 座標種類 ('hit', 'landing', 'player', 'opponent')
+        其餘參數同 `court_grid`
+
+    Returns:
+        pd.Series: index 為區域編號 (1 ~ NUM_AREAS)，值為次數
+    """
+    if kind not in SPATIAL_KINDS:
+        raise ValueError(f"未知的座標種類: {kind!r}，可用: {list(SPATIAL_KINDS)}")
+
+    key = (cached_dataset_version(df), kind, match_id, player, shot_type, outcome)
+    counts = _AREA_CACHE.get(key)
+    if counts is None:
+        _, _, area_col = SPATIAL_KINDS[kind]
+        mask = _filter_mask(df, match_id, player, shot_type, outcome)
+        areas = df[area_col].to_numpy(dtype=float)[mask]
+        areas = areas[~np.isnan(areas)].astype(np.int64)
+        binned = np.bincount(areas, minlength=NUM_AREAS + 1)
+        counts = pd.Series(binned[1:], index=pd.RangeIndex(1, len(binned), name=area_col), name="count")
+        _cache_put(_AREA_CACHE, key, counts)
+    return counts.copy()
+
+
+def composite_grids(grid_a, grid_b, normalize=True):
+    """
+    組合兩張網格：回傳 A - B（例如球員 A 的落點減去球員 B 的落點）
+
+    Args:
+        grid_a: 網格 A
+        grid_b: 網格 B
+        normalize: True 時先各自轉為比例再相減，避免樣本數不同造成偏差
+
+    Returns:
+        np.ndarray: 差異網格
+    """
+    a = np.asarray(grid_a, dtype=float)
+    b = np.asarray(grid_b, dtype=float)
+    if normalize:
+        a = a / a.sum() if a.sum() else a
+        b = b / b.sum() if b.sum() else b
+    return a - b
+
+
+def draw_court_heatmap(ax, grid, title=None, cmap="YlOrRd"):
+    """
+    在 matplotlib 的 ax 上畫出球場熱區網格
+
+    Args:
+        ax: matplotlib Axes
+        grid: `court_grid` 或 `composite_grids` 的結果
+        title: 圖表標題 (可選)
+        cmap: 色彩對應表；差異網格建議使用 'RdBu_r'
+
+    Returns:
+        matplotlib.image.AxesImage: 可用於 `fig.colorbar(...)`
+    """
+    extent = [COURT_X_RANGE[0], COURT_X_RANGE[1], COURT_Y_RANGE[0], COURT_Y_RANGE[1]]
+    image = ax.imshow(grid, origin="lower", extent=extent, cmap=cmap, aspect="auto")
+    if title:
+        ax.set_title(title, fontsize=16, fontweight="bold")
+    return image
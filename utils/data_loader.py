@@ -6,6 +6,7 @@ import os
 import pandas as pd
 import json
 import io
+import weakref
 import streamlit as st
 
 
@@ -13,6 +14,9 @@ import streamlit as st
 DATA_FILE = "all_dataset.csv"
 COLUMN_DEFINITION_FILE = "column_definition.json"
 
+# id(df) -> (weakref, shape, version)：已計算過版本的 DataFrame
+_VERSION_STAMPS = {}
+
 
 @st.cache_data
 def load_data(filepath):
@@ -46,6 +50,61 @@ def get_data_schema(df):
     return buffer.getvalue()
 
 
+def get_dataset_version(df):
+    """
+    計算資料集的版本指紋（內容雜湊），作為各種預先計算結果的快取鍵
+
+    Args:
+        df: pandas DataFrame
+
+    Returns:
+        str: 16 碼十六進位字串；資料內容有任何變動時會改變
+    """
+    if df is None:
+        return "none"
+    row_hashes = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    digest = int(row_hashes.sum(dtype="uint64")) ^ (len(df) << 32) ^ df.shape[1]
+    return f"{digest & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def stamp_dataset_version(df, version=None):
+    """
+    在唯讀的 DataFrame 上記錄版本指紋（載入時計算一次），之後 `cached_dataset_version(df)` 只是一次查找；
+    只對不會被修改的資料表使用（例如模組層級載入的資料），交給 AI 程式碼修改的副本不要記錄
+
+    Args:
+        df: pandas DataFrame
+        version: 已知的版本；省略時重新計算
+
+    Returns:
+        str: 版本指紋
+    """
+    version = version or get_dataset_version(df)
+    key = id(df)
+    ref = weakref.ref(df, lambda _, key=key: _VERSION_STAMPS.pop(key, None))
+    _VERSION_STAMPS[key] = (ref, df.shape, version)
+    return version
+
+
+def cached_dataset_version(df):
+    """
+    取得 DataFrame 的版本指紋：以 `stamp_dataset_version` 記錄過且形狀未變時直接回傳，
+    否則每次重新計算（不記錄；未記錄的資料表可能在原地被修改，沿用舊版本會讀到過期的快取）
+
+    Args:
+        df: pandas DataFrame
+
+    Returns:
+        str: 版本指紋
+    """
+    if df is None:
+        return "none"
+    stamp = _VERSION_STAMPS.get(id(df))
+    if stamp is not None and stamp[0]() is df and stamp[1] == df.shape:
+        return stamp[2]
+    return get_dataset_version(df)
+
+
 @st.cache_data
 def load_column_definitions(filepath):
     """
@@ -0,0 +1,23 @@
+"""
+字型相關函數
+Font helpers shared by the chart renderers
+"""
+import matplotlib.font_manager as fm
+
+
+def resolve_font_family(font_path_or_name):
+    """
+    與 llm_core 相同：可接受字型檔路徑或字型名稱，回傳字型名稱
+
+    Args:
+        font_path_or_name: 字型檔路徑、字型名稱，或 None
+
+    Returns:
+        str or None: 字型名稱；讀不到字型檔時原樣回傳
+    """
+    if not font_path_or_name:
+        return None
+    try:
+        return fm.FontProperties(fname=font_path_or_name).get_name()
+    except Exception:
+        return font_path_or_name
@@ -0,0 +1,321 @@
+"""
+球員對戰矩陣
+Batch head-to-head comparison matrix across all players
+
+以一次分組運算計算資料集中「每一組」球員對戰的統計（得失分原因、球種比例、
+失誤率、落點區域），存成以 (player, opponent) 為索引的矩陣。
+任何對戰組合的報告 (`/report/H2H-<雙方名稱的雜湊>`) 都直接由矩陣組成，不需要再呼叫 LLM 生成程式碼。
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+from utils.data_loader import get_dataset_version
+from utils.rally_features import get_rally_table, NO_RETURN_TYPE
+from utils.fonts import resolve_font_family
+
+
+# 屬於自身失誤的失分原因
+ERROR_REASONS = ["出界", "掛網", "未過網", "落點判斷失誤", "犯規"]
+
+PAIR_KEYS = ["player", "opponent"]
+REPORT_ID_PREFIX = "H2H"
+REPORT_ID_HASH_LENGTH = 10
+
+# 報告圖表：檔名 -> (標題, 說明)
+PAIR_CHARTS = {
+    "win_reasons": ("得分方式比較", "雙方各自的得分方式次數。"),
+    "lose_reasons": ("失分原因比較", "雙方各自的失分原因次數。"),
+    "shot_mix": ("球種比例比較", "雙方在這組對戰中的球種使用比例。"),
+    "landing_zones": ("落點區域比較", "雙方擊球落點在各區域的比例。"),
+}
+
+_H2H_CACHE = {}
+
+# 給 LLM 的說明（注入到系統指令中）
+HEAD_TO_HEAD_DESCRIPTION = """- `head_to_head` (HeadToHeadMatrix)：所有球員對戰組合的預先計算統計，球員之間的比較問題請優先使用。
+  屬性皆為 index 為 (`player`, `opponent`) 的 pd.DataFrame：`summary` (rallies_won, rallies_lost, rallies, win_rate, errors, error_rate, strokes)、
+  `win_reasons`、`lose_reasons` (次數)、`shot_mix`、`landing_zones` (比例)。
+  `head_to_head.pair_stats(player, opponent)` 回傳上述各表中雙方兩列的 dict。"""
+
+
+class HeadToHeadMatrix:
+    """
+    所有球員對戰組合的統計矩陣（每張表的 index 皆為 (player, opponent)）
+
+    Attributes:
+        players: 排序後的球員名單
+        summary: 回合數、得失分、勝率、失誤數、失誤率、擊球數
+        win_reasons: 各得分方式次數（寬表）
+        lose_reasons: 各失分原因次數（寬表）
+        shot_mix: 各球種使用比例（寬表）
+        landing_zones: 各落點區域比例（寬表）
+    """
+
+    def __init__(self, players, summary, win_reasons, lose_reasons, shot_mix, landing_zones):
+        self.players = players
+        self.summary = summary
+        self.win_reasons = win_reasons
+        self.lose_reasons = lose_reasons
+        self.shot_mix = shot_mix
+        self.landing_zones = landing_zones
+        self._pairs_by_report_id = None
+
+    def copy(self):
+        """回傳各表皆為副本的 HeadToHeadMatrix（交給生成的程式碼，避免改動到快取）"""
+        return HeadToHeadMatrix(list(self.players), self.summary.copy(), self.win_reasons.copy(),
+                                self.lose_reasons.copy(), self.shot_mix.copy(), self.landing_zones.copy())
+
+    def pairs(self):
+        """回傳所有有對戰紀錄的 (player, opponent) 組合（每組只出現一次）"""
+        return [(a, b) for a, b in self.summary.index if a < b]
+
+    def pair_stats(self, player, opponent):
+        """
+        取得單一對戰組合的雙方統計
+
+        Args:
+            player: 球員 A
+            opponent: 球員 B
+
+        Returns:
+            dict: 表名 -> pd.DataFrame（兩列，分別為 A 與 B 的視角）
+        """
+        keys = [(player, opponent), (opponent, player)]
+        if keys[0] not in self.summary.index:
+            raise KeyError(f"找不到對戰組合: {player} vs {opponent}")
+        result = {}
+        for name in ["summary", "win_reasons", "lose_reasons", "shot_mix", "landing_zones"]:
+            table = getattr(self, name).reindex(keys).fillna(0)
+            table.index = [player, opponent]
+            result[name] = table
+        return result
+
+    def report_id(self, player, opponent):
+        """對戰組合 -> 報告 ID（見 `pair_report_id`）"""
+        return pair_report_id(player, opponent)
+
+    def parse_report_id(self, report_id):
+        """
+        報告 ID -> 對戰組合
+
+        Returns:
+            tuple or None: (player, opponent)；格式不符或矩陣中沒有這組對戰時回傳 None
+        """
+        if not report_id.startswith(f"{REPORT_ID_PREFIX}-"):
+            return None
+        if self._pairs_by_report_id is None:
+            self._pairs_by_report_id = {
+                pair_report_id(player, opponent): (player, opponent)
+                for player, opponent in self.summary.index if player != opponent
+            }
+        return self._pairs_by_report_id.get(report_id)
+
+
+def pair_report_id(player, opponent):
+    """
+    對戰組合 -> 報告 ID（例如 'H2H-1f3a5c7e9b'）
+
+    以雙方名稱的雜湊組成，資料集新增或移除球員時，既有報告的 ID（連結、快照檔名）不會改變
+    """
+    digest = hashlib.sha1(f"{player}\n{opponent}".encode("utf-8")).hexdigest()
+    return f"{REPORT_ID_PREFIX}-{digest[:REPORT_ID_HASH_LENGTH]}"
+
+
+def _match_opponents(df):
+    """每一拍的對手 = 同場比賽的另一位球員（向量化）"""
+    match_players = df.groupby("match_id")["player"].agg(["min", "max"])
+    players = match_players.reindex(df["match_id"].to_numpy())
+    p_min = players["min"].to_numpy()
+    p_max = players["max"].to_numpy()
+    return pd.Series(np.where(df["player"].to_numpy() == p_min, p_max, p_min), index=df.index)
+
+
+def _shares(counts):
+    """寬表每列轉為比例"""
+    totals = counts.sum(axis=1).replace(0, np.nan)
+    return counts.div(totals, axis=0).fillna(0.0)
+
+
+def _top_label(row):
+    """列中數值最大的欄位名稱；空列或全為 0（沒有任何紀錄）時回傳 None"""
+    if row.empty or not row.max() > 0:
+        return None
+    return row.idxmax()
+
+
+def build_head_to_head(df, rallies=None):
+    """
+    建立所有球員對戰組合的統計矩陣（每種統計只做一次 groupby）
+
+    Args:
+        df: 逐拍資料 DataFrame
+        rallies: 回合特徵表；省略時自動建立
+
+    Returns:
+        HeadToHeadMatrix: 對戰矩陣
+    """
+    if rallies is None:
+        rallies = get_rally_table(df)
+
+    rally_view = pd.DataFrame({
+        "winner": rallies["winner"], "loser": rallies["loser"],
+        "win_reason": rallies["win_reason"], "lose_reason": rallies["lose_reason"],
+    }).dropna(subset=["winner", "loser"])
+
+    # 回合層級：以「得分者」與「失分者」兩個視角各分組一次
+    won = rally_view.groupby(["winner", "loser"]).size()
+    lost = rally_view.groupby(["loser", "winner"]).size()
+    is_error = rally_view["lose_reason"].isin(ERROR_REASONS)
+    errors = rally_view[is_error].groupby(["loser", "winner"]).size()
+    won.index.names = lost.index.names = errors.index.names = PAIR_KEYS
+
+    win_reasons = rally_view.groupby(["winner", "loser", "win_reason"]).size().unstack(fill_value=0)
+    lose_reasons = rally_view.groupby(["loser", "winner", "lose_reason"]).size().unstack(fill_value=0)
+    win_reasons.index.names = lose_reasons.index.names = PAIR_KEYS
+    win_reasons.columns.name = lose_reasons.columns.name = None
+
+    # 擊球層級：球種與落點區域
+    strokes = df[df["type"].ne(NO_RETURN_TYPE) & df["type"].notna()]
+    strokes = strokes.assign(opponent=_match_opponents(strokes))
+    shot_counts = strokes.groupby(PAIR_KEYS + ["type"]).size().unstack(fill_value=0)
+    landing_counts = (
+        strokes.dropna(subset=["landing_area"])
+        .assign(landing_area=lambda s: s["landing_area"].astype(np.int64))
+        .groupby(PAIR_KEYS + ["landing_area"]).size().unstack(fill_value=0)
+    )
+    shot_counts.columns.name = landing_counts.columns.name = None
+
+    index = won.index.union(lost.index).union(shot_counts.index)
+    summary = pd.DataFrame(index=index)
+    summary["rallies_won"] = won.reindex(index, fill_value=0)
+    summary["rallies_lost"] = lost.reindex(index, fill_value=0)
+    summary["rallies"] = summary["rallies_won"] + summary["rallies_lost"]
+    summary["win_rate"] = summary["rallies_won"] / summary["rallies"].replace(0, np.nan)
+    summary["errors"] = errors.reindex(index, fill_value=0)
+    summary["error_rate"] = summary["errors"] / summary["rallies"].replace(0, np.nan)
+    summary["strokes"] = shot_counts.sum(axis=1).reindex(index, fill_value=0)
+
+    players = sorted(set(index.get_level_values(0)) | set(index.get_level_values(1)))
+    return HeadToHeadMatrix(
+        players=players,
+        summary=summary,
+        win_reasons=win_reasons.reindex(index, fill_value=0),
+        lose_reasons=lose_reasons.reindex(index, fill_value=0),
+        shot_mix=_shares(shot_counts).reindex(index, fill_value=0.0),
+        landing_zones=_shares(landing_counts).reindex(index, fill_value=0.0),
+    )
+
+
+def get_head_to_head(df):
+    """
+    取得（並快取）對戰矩陣；資料集內容不變時直接回傳快取結果
+
+    Args:
+        df: 逐拍資料 DataFrame
+
+    Returns:
+        HeadToHeadMatrix or None: 若 df 為 None 則回傳 None
+    """
+    if df is None:
+        return None
+    version = get_dataset_version(df)
+    if version not in _H2H_CACHE:
+        _H2H_CACHE[version] = build_head_to_head(df, get_rally_table(df))
+    return _H2H_CACHE[version]
+
+
+def describe_pair(matrix, player, opponent):
+    """
+    由對戰矩陣組成報告摘要文字（不呼叫 LLM）
+
+    Returns:
+        str: 摘要文字
+    """
+    stats = matrix.pair_stats(player, opponent)
+    summary = stats["summary"]
+    lines = [f"{player} 對 {opponent}：共 {int(summary.loc[player, 'rallies'])} 個回合。"]
+    for name in [player, opponent]:
+        row = summary.loc[name]
+        top_win = _top_label(stats["win_reasons"].loc[name])
+        top_lose = _top_label(stats["lose_reasons"].loc[name])
+        shot_mix = stats["shot_mix"].loc[name]
+        top_shot = _top_label(shot_mix)
+        lines.append(
+            f"{name}：得分 {int(row['rallies_won'])} 分（勝率 {row['win_rate']:.1%}），"
+            f"失誤 {int(row['errors'])} 次（失誤率 {row['error_rate']:.1%}）。"
+            + (f"主要得分方式為「{top_win}」，" if top_win is not None else "沒有得分方式的紀錄，")
+            + (f"主要失分原因為「{top_lose}」，" if top_lose is not None else "沒有失分原因的紀錄，")
+            + (f"最常使用的球種為「{top_shot}」（{shot_mix.max():.1%}）。" if top_shot is not None else "沒有球種紀錄。")
+        )
+    return "\n".join(lines)
+
+
+def render_pair_chart(matrix, player, opponent, chart, font_path_or_name=None):
+    """
+    以對戰矩陣繪製比較圖（使用 Figure 物件，不經過 pyplot 全域狀態）
+
+    Args:
+        matrix: HeadToHeadMatrix
+        player, opponent: 對戰雙方
+        chart: PAIR_CHARTS 的鍵
+        font_path_or_name: 中文字型
+
+    Returns:
+        matplotlib.figure.Figure
+    """
+    if chart not in PAIR_CHARTS:
+        raise ValueError(f"未知的圖表: {chart!r}，可用: {list(PAIR_CHARTS)}")
+    title, _ = PAIR_CHARTS[chart]
+    table = matrix.pair_stats(player, opponent)[chart].T
+    table = table.loc[(table != 0).any(axis=1)]
+
+    family = resolve_font_family(font_path_or_name)
+    fig = Figure(figsize=(12, 7))
+    ax = fig.subplots()
+    positions = np.arange(len(table))
+    width = 0.4
+    colors = ['#FF6B6B', '#4ECDC4']
+    for k, name in enumerate([player, opponent]):
+        ax.bar(positions + (k - 0.5) * width, table[name].to_numpy(), width,
+               label=name, color=colors[k], alpha=0.85)
+
+    font_kwargs = {"fontfamily": family} if family else {}
+    ax.set_title(f"{player} vs {opponent} - {title}", fontsize=16, fontweight='bold', pad=20, **font_kwargs)
+    ax.set_xticks(positions)
+    ax.set_xticklabels([str(c) for c in table.index], rotation=45, ha='right', fontsize=10, **font_kwargs)
+    ax.grid(True, alpha=0.3, linestyle='--', axis='y')
+    legend = ax.legend(fontsize=10, loc='best')
+    if family:
+        for text in legend.get_texts():
+            text.set_fontfamily(family)
+    fig.tight_layout()
+    return fig
+
+
+def export_pair_charts(matrix, player, opponent, out_dir, font_path_or_name=None):
+    """
+    將一組對戰的所有比較圖輸出成 PNG（已存在的檔案不重繪）
+
+    Args:
+        matrix: HeadToHeadMatrix
+        player, opponent: 對戰雙方
+        out_dir: 輸出資料夾
+        font_path_or_name: 中文字型
+
+    Returns:
+        list: 輸出的檔名（不含路徑）
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    filenames = []
+    for chart in PAIR_CHARTS:
+        filename = f"{chart}.png"
+        path = os.path.join(out_dir, filename)
+        if not os.path.exists(path):
+            fig = render_pair_chart(matrix, player, opponent, chart, font_path_or_name)
+            fig.savefig(path, dpi=150, bbox_inches='tight')
+        filenames.append(filename)
+    return filenames
@@ -0,0 +1,499 @@
+"""
+具備容錯能力的 LLM 呼叫層
+Resilient LLM call layer: timeouts, backoff on 429, hedged requests and a circuit breaker
+
+所有 `generate_content` 呼叫都經過 `ResilientLLM.generate`：
+- 每次呼叫有逾時上限（不會讓 /api/analyze 無限期卡住），並以 `request_options` 傳給 SDK，
+  逾時的請求在供應商端也會結束，不會佔住背景執行緒；
+- 429 / 5xx / 逾時會以 jitter 指數退避重試，並遵守伺服器回傳的重試等待時間；
+- （可選）呼叫超過近期延遲的 p95 時，再送出一個相同的請求 (hedge)，採用先回來的結果；
+- 用 semaphore 限制同時進行的呼叫數（名額在呼叫真正結束時才歸還，逾時後仍在背景執行的呼叫也佔用名額）；
+- 連續失敗時斷路器開啟，期間不再呼叫供應商，改用快取的回應或由呼叫端提供的備援答案。
+"""
+import hashlib
+import inspect
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+DEFAULT_TIMEOUT_SECONDS = 60.0
+DEFAULT_MAX_ATTEMPTS = 3
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+# 伺服器要求的等待時間超過此值時不再等待，直接失敗
+MAX_RETRY_AFTER_SECONDS = 60.0
+DEFAULT_MAX_CONCURRENCY = 4
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30.0
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+RESPONSE_CACHE_SIZE = 128
+
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+_RETRYABLE_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+                    "DeadlineExceeded", "GatewayTimeout", "BadGateway", "TimeoutError", "ConnectionError"}
+_RETRY_IN = re.compile(r"retry(?:_delay)?[^0-9]{0,20}?(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+
+class LLMUnavailableError(Exception):
+    """供應商暫時無法使用（斷路器開啟、重試用盡或逾時），呼叫端應改用備援答案"""
+
+
+class LLMCallTimeout(TimeoutError):
+    """單次呼叫超過逾時上限"""
+
+
+def error_status(exc):
+    """取出例外中的 HTTP 狀態碼（google.api_core 例外的 code、requests / urllib 的 status）"""
+    for attr in ("code", "status_code", "status"):
+        value = getattr(exc, attr, None)
+        value = getattr(value, "value", value)  # grpc StatusCode / IntEnum
+        if isinstance(value, int):
+            return value
+        if isinstance(value, tuple) and value and isinstance(value[0], int):
+            return value[0]
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(response, "status", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(exc):
+    """429、5xx、逾時與連線錯誤可以重試；其他錯誤（例如 400、權限）直接失敗"""
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    status = error_status(exc)
+    if status is not None:
+        return status in _RETRYABLE_STATUS
+    return type(exc).__name__ in _RETRYABLE_NAMES
+
+
+def retry_after_seconds(exc):
+    """
+    取出伺服器建議的重試等待秒數（Retry-After 標頭、retry_delay 或錯誤訊息中的 "retry in Ns"）
+
+    Returns:
+        float or None
+    """
+    value = getattr(exc, "retry_after", None)
+    if isinstance(value, (int, float)):
+        return float(value)
+    headers = getattr(getattr(exc, "response", None), "headers", None) or getattr(exc, "headers", None)
+    if headers:
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            pass
+    match = _RETRY_IN.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+def backoff_delay(attempt, retry_after=None, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """full-jitter 指數退避；有伺服器提示時至少等待提示的秒數"""
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class CircuitBreaker:
+    """
+    斷路器：連續失敗 failure_threshold 次後開啟，reset_seconds 後進入半開狀態，
+    半開時只放行一個試探呼叫，成功則關閉、失敗則重新開啟。
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if now - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self):
+        """是否可以呼叫供應商"""
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_neutral(self):
+        """呼叫結束但無法判斷供應商是否正常（例如 400）：不改變狀態，只結束試探"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def retry_in(self):
+        """斷路器開啟時，距離可以試探的秒數"""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+
+class ResilientLLM:
+    """
+    `model.generate_content` 的容錯包裝
+
+    Args:
+        timeout: 單次呼叫逾時秒數
+        max_attempts: 最多嘗試次數（含第一次）
+        max_concurrency: 同時進行的呼叫上限
+        hedge: 是否在超過 p95 延遲時送出 hedge 請求
+        breaker: CircuitBreaker（省略時建立預設的）
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, hedge=False, breaker=None):
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.hedge = hedge
+        self.breaker = breaker or CircuitBreaker()
+        self._limiter = threading.BoundedSemaphore(max_concurrency)
+        # 逾時的呼叫無法被中斷，會在背景執行完畢；每個執行中的呼叫 (含 hedge) 都持有一個名額，執行緒數等於上限即可
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm-call")
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "timeouts": 0,
+                      "failures": 0, "short_circuits": 0, "cache_fallbacks": 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def p95_latency(self):
+        """近期成功呼叫的 p95 延遲（樣本不足時回傳 None）"""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def _with_request_timeout(self, model, kwargs):
+        """SDK 支援 request_options 時帶入逾時，讓卡住的請求在供應商端也會結束"""
+        if "request_options" in kwargs:
+            return kwargs
+        try:
+            params = inspect.signature(model.generate_content).parameters
+        except (TypeError, ValueError):
+            return kwargs
+        if "request_options" not in params:
+            return kwargs
+        return {**kwargs, "request_options": {"timeout": self.timeout}}
+
+    @staticmethod
+    def _cache_key(model, contents, generation_config):
+        raw = repr((getattr(model, "model_name", type(model).__name__), contents, generation_config))
+        return hashlib.sha1(raw.encode("utf-8", "replace")).hexdigest()
+
+    def _remember(self, key, response):
+        with self._lock:
+            self._cache[key] = response
+            self._cache.move_to_end(key)
+            while len(self._cache) > RESPONSE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def _cached(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def _submit(self, model, contents, kwargs):
+        """
+        送出一個呼叫（呼叫端已取得名額）；名額在呼叫真正結束時才歸還，
+        逾時後被放棄、仍在背景執行的呼叫也繼續佔用名額，max_concurrency 才是實際的上限
+        """
+        try:
+            future = self._executor.submit(model.generate_content, contents, **kwargs)
+        except BaseException:
+            self._limiter.release()
+            raise
+        future.add_done_callback(lambda _: self._limiter.release())
+        return future
+
+    def _call_once(self, model, contents, kwargs):
+        """一次呼叫（含可選的 hedge 請求），超過 timeout 時拋出 LLMCallTimeout"""
+        if not self._limiter.acquire(timeout=self.timeout):
+            raise LLMCallTimeout(f"等待 LLM 呼叫名額超過 {self.timeout:.0f} 秒")
+        start = time.monotonic()
+        futures = [self._submit(model, contents, kwargs)]
+        hedge_after = self.p95_latency() if self.hedge else None
+        if hedge_after is not None and hedge_after < self.timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            # hedge 請求不等待名額：沒有空閒名額時就不送
+            if not done and self._limiter.acquire(blocking=False):
+                self._count("hedges")
+                futures.append(self._submit(model, contents, kwargs))
+
+        remaining = self.timeout - (time.monotonic() - start)
+        pending = list(futures)
+        while pending:
+            done, _ = wait(pending, timeout=max(remaining, 0), return_when=FIRST_COMPLETED)
+            if not done:
+                self._count("timeouts")
+                raise LLMCallTimeout(f"LLM 呼叫超過 {self.timeout:.0f} 秒")
+            for future in done:
+                pending.remove(future)
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        self._count("hedge_wins")
+                    with self._lock:
+                        self._latencies.append(time.monotonic() - start)
+                    return future.result()
+                if not pending:
+                    raise future.exception()
+            remaining = self.timeout - (time.monotonic() - start)
+
+    def generate(self, model, contents, **kwargs):
+        """
+        以重試、逾時、hedge 與斷路器保護呼叫 `model.generate_content(contents, **kwargs)`
+
+        Args:
+            model: 具有 generate_content 方法的模型物件
+            contents: 傳給 generate_content 的內容
+            **kwargs: 其他參數（例如 generation_config）
+
+        Returns:
+            模型的回應物件
+
+        Raises:
+            LLMUnavailableError: 斷路器開啟且沒有快取、重試用盡或逾時
+            Exception: 不可重試的錯誤（例如 400）會直接拋出
+        """
+        key = self._cache_key(model, contents, kwargs.get("generation_config"))
+        kwargs = self._with_request_timeout(model, kwargs)
+        last_error = None
+        for attempt in range(self.max_attempts):
+            if not self.breaker.allow():
+                self._count("short_circuits")
+                cached = self._cached(key)
+                if cached is not None:
+                    self._count("cache_fallbacks")
+                    return cached
+                raise LLMUnavailableError(
+                    f"AI 服務暫時無法使用（斷路器開啟，約 {self.breaker.retry_in():.0f} 秒後重試）。"
+                )
+
+            self._count("calls")
+            try:
+                response = self._call_once(model, contents, kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # 請求本身的問題（例如 400）不代表供應商異常，不計入斷路器（但要結束半開的試探）
+                    self.breaker.record_neutral()
+                    raise
+                self.breaker.record_failure()
+                last_error = e
+                hint = retry_after_seconds(e)
+                if attempt == self.max_attempts - 1 or (hint is not None and hint > MAX_RETRY_AFTER_SECONDS):
+                    break
+                delay = backoff_delay(attempt, hint)
+                print(f"[llm_client] 呼叫失敗 ({type(e).__name__}: {e})，{delay:.1f} 秒後重試 "
+                      f"(第 {attempt + 2}/{self.max_attempts} 次)")
+                self._count("retries")
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # KeyboardInterrupt 等：同樣要結束試探，否則斷路器會永遠停在半開
+                self.breaker.record_neutral()
+                raise
+
+            self.breaker.record_success()
+            self._remember(key, response)
+            return response
+
+        self._count("failures")
+        cached = self._cached(key)
+        if cached is not None:
+            self._count("cache_fallbacks")
+            return cached
+        raise LLMUnavailableError(f"AI 服務暫時無法使用: {type(last_error).__name__}: {last_error}")
+
+
+# --- 本地假伺服器檢查 (python -m utils.llm_client) ---
+def run_fake_server_checks():
+    """
+    啟動一個會注入延遲與 429 / 503 / 400 錯誤的本地 HTTP 假伺服器，檢查重試、hedge、斷路器與快取備援
+
+    Raises:
+        AssertionError: 任何一項行為與預期不同
+    """
+    import json
+    import urllib.error
+    import urllib.request
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    behaviour = {"mode": "flaky"}
+    counter = {"n": 0, "errors": 0}
+    counter_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _fail(self, status, retry_after=None):
+            with counter_lock:
+                counter["errors"] += 1
+            self.send_response(status)
+            if retry_after is not None:
+                self.send_header("Retry-After", retry_after)
+            self.end_headers()
+
+        def do_POST(self):
+            with counter_lock:
+                counter["n"] += 1
+                n = counter["n"]
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            mode = behaviour["mode"]
+            if mode == "bad":
+                return self._fail(400)
+            if mode == "down" or (mode == "flaky" and n % 4 == 0):
+                return self._fail(503)
+            if mode == "flaky" and n % 4 == 1:
+                return self._fail(429, "0.2")
+            if mode == "stall":
+                time.sleep(1.0)
+            # 大多數請求 20 ms，偶爾出現 1.5 秒的長尾延遲
+            time.sleep(1.5 if mode == "slow_tail" and n % 10 == 0 else 0.02)
+            body = json.dumps({"text": f"answer #{n}"}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+    class HTTPStatusError(Exception):
+        def __init__(self, err):
+            super().__init__(f"HTTP {err.code}")
+            self.code = err.code
+            self.headers = err.headers
+
+    class Response:
+        def __init__(self, text):
+            self.text = text
+
+    class FakeServerModel:
+        """透過 HTTP 呼叫本地假伺服器的模型（不支援 request_options，檢查不會被多傳參數）"""
+        model_name = "fake-server"
+
+        def __init__(self, url):
+            self.url = url
+
+        def generate_content(self, contents, generation_config=None):
+            request = urllib.request.Request(self.url, data=json.dumps(contents).encode("utf-8"), method="POST")
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    return Response(json.loads(response.read())["text"])
+            except urllib.error.HTTPError as e:
+                raise HTTPStatusError(e)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    model = FakeServerModel(f"http://127.0.0.1:{server.server_address[1]}/generate")
+
+    def run(title, client, prompts, mode):
+        behaviour["mode"] = mode
+        with counter_lock:
+            counter["n"] = counter["errors"] = 0
+        start = time.monotonic()
+        results = []
+        for prompt in prompts:
+            try:
+                results.append(client.generate(model, prompt).text)
+            except LLMUnavailableError:
+                results.append(None)
+        ok = sum(1 for r in results if r is not None)
+        print(f"\n== {title} ==")
+        print(f"成功 {ok}/{len(prompts)}，耗時 {time.monotonic() - start:.2f} 秒，斷路器: {client.breaker.state}")
+        print(f"統計: {client.stats}")
+        return results, dict(counter)
+
+    try:
+        # 1. 每 4 個請求有 1 個 429 (Retry-After 0.2 秒) 與 1 個 503：全部靠重試成功，每個錯誤剛好重試一次
+        client = ResilientLLM(timeout=2, max_attempts=4)
+        results, hits = run("429 / 503 注入", client, [f"q{i}" for i in range(12)], "flaky")
+        assert all(r is not None for r in results), results
+        assert hits["errors"] > 0 and client.stats["retries"] == hits["errors"], (hits, client.stats)
+        assert client.stats["calls"] == hits["n"] and client.stats["failures"] == 0, (hits, client.stats)
+        assert client.breaker.state == "closed"
+
+        # 2. 每 10 個請求有 1 個 1.5 秒的長尾：hedge 請求在 p95 後送出，並由 hedge 先回來
+        for hedge in (False, True):
+            client = ResilientLLM(timeout=3, hedge=hedge)
+            results, _ = run(f"長尾延遲 (hedge={hedge})", client, [f"t{i}" for i in range(60)], "slow_tail")
+            assert all(r is not None for r in results), results
+            if hedge:
+                assert client.stats["hedges"] > 0 and client.stats["hedge_wins"] > 0, client.stats
+            else:
+                assert client.stats["hedges"] == 0, client.stats
+
+        # 3. 供應商完全故障：連續 3 次失敗後斷路器開啟，不再呼叫供應商；已快取的問題回傳快取
+        client = ResilientLLM(timeout=2, max_attempts=2,
+                              breaker=CircuitBreaker(failure_threshold=3, reset_seconds=2))
+        results, _ = run("暖身 (快取回應)", client, ["cached-1", "cached-2"], "ok")
+        warm = list(results)
+        results, hits = run("供應商故障", client, ["new-1", "new-2", "new-3", "cached-1", "cached-2", "new-4"], "down")
+        assert results == [None, None, None] + warm + [None], results
+        assert hits["n"] == 3, f"斷路器開啟後仍呼叫了供應商: {hits}"
+        assert client.breaker.state == "open"
+        assert client.stats["cache_fallbacks"] == 2 and client.stats["short_circuits"] >= 4, client.stats
+
+        # 4. 半開試探：400 不計入斷路器但會結束試探；之後的試探失敗重新開啟、成功則關閉
+        time.sleep(client.breaker.retry_in() + 0.05)
+        assert client.breaker.state == "half_open"
+        behaviour["mode"] = "bad"
+        try:
+            client.generate(model, "probe-400")
+            raise AssertionError("400 應直接拋出")
+        except HTTPStatusError:
+            pass
+        assert not client.breaker._probing and client.breaker.state == "half_open", "400 試探後斷路器卡在試探中"
+        results, _ = run("試探失敗", client, ["probe-down"], "down")
+        assert results == [None] and client.breaker.state == "open"
+        time.sleep(client.breaker.retry_in() + 0.05)
+        results, _ = run("試探成功", client, ["probe-ok"], "ok")
+        assert results[0] is not None and client.breaker.state == "closed"
+
+        # 5. 逾時後被放棄的呼叫仍佔用名額，直到它真正結束：同時進行的呼叫不會超過 max_concurrency
+        client = ResilientLLM(timeout=0.3, max_attempts=1, max_concurrency=1)
+        results, _ = run("逾時 (名額上限 1)", client, ["stall-1"], "stall")
+        assert results == [None] and client.stats["timeouts"] == 1, client.stats
+        assert not client._limiter.acquire(blocking=False), "逾時後名額已歸還，但呼叫仍在背景執行"
+        time.sleep(1.0)
+        assert client._limiter.acquire(blocking=False), "背景呼叫結束後名額沒有歸還"
+        client._limiter.release()
+    finally:
+        server.shutdown()
+    print("\n[llm_client] 全部檢查通過。")
+
+
+if __name__ == "__main__":
+    run_fake_server_checks()
@@ -0,0 +1,266 @@
+"""
+比賽走勢與勝率模型
+Momentum and win-probability engine over rally outcomes
+
+以回合特徵表 (`rallies`) 為基礎，一次向量化計算所有場次每個回合的：
+- 比分與局數（回合前比分取自資料中記錄的 `player_score` / `opponent_score`，回合後比分 = 回合前 + 該回合得分；
+  資料會跳過部分回合，不能以回合得分者累加重建比分。局數只在比分達到 21 分且領先 2 分、或 30 分時才算分出勝負，
+  資料在局中斷掉的局不算任何一方贏）
+- 本局勝率 / 整場勝率（回合前與回合後）
+- 連續得分 (run) 長度（回合編號不連續時重新計算）
+- 指數加權的走勢指標 (momentum)
+
+局內勝率使用羽球 21 分制（需領先 2 分，30 分封頂）的動態規劃表，
+該表對一組離散的單回合勝率只建立一次，之後所有回合都只是陣列索引。
+"""
+import numpy as np
+import pandas as pd
+
+from utils.data_loader import get_dataset_version
+from utils.rally_features import get_rally_table
+
+
+POINTS_TO_WIN = 21
+POINTS_CAP = 30
+SETS_TO_WIN = 2
+
+# 單回合勝率的離散格點與先驗強度（以「虛擬回合數」表示，向 0.5 收斂）
+P_GRID_SIZE = 101
+PRIOR_RALLIES = 20
+# 走勢指標的指數衰減（每回合保留的權重）
+MOMENTUM_DECAY = 0.7
+
+_SET_WIN_TABLE = None
+_MOMENTUM_CACHE = {}
+
+# 給 LLM 的說明（注入到系統指令中）
+MOMENTUM_DESCRIPTION = """- `momentum` (pd.DataFrame)：每個回合一列的比賽走勢與勝率（以每場的 `player_a` 視角），比賽走勢 / 關鍵分 / 逆轉問題請優先使用。
+  欄位：`match_id`, `set`, `rally`, `player_a`, `player_b`, `winner`, `a_score_before`, `b_score_before`, `a_score_after`, `b_score_after`,
+  `a_sets_before`, `b_sets_before`, `set_decided` (局末回合且比分已分出勝負), `p_rally_a` (至此為止估計的 A 單回合勝率), `set_win_prob_before`, `set_win_prob_after`,
+  `match_win_prob_before`, `match_win_prob_after`, `win_prob_swing` (該回合造成的整場勝率變化),
+  `run_player`, `run_length` (目前連續得分者與連續分數；資料跳過回合時重新計算), `momentum_a` (-1 ~ 1，正值代表 A 佔上風)。"""
+
+
+def _build_set_win_table():
+    """
+    建立局內勝率表：table[k, a, b] = 單回合勝率為 p_k 時，A 在比分 a:b 下贏得本局的機率
+    （只對 POINTS_CAP^2 個比分狀態迴圈一次，每個狀態同時處理所有 p）
+    """
+    p = np.linspace(0.0, 1.0, P_GRID_SIZE)
+    size = POINTS_CAP + 2
+    table = np.zeros((P_GRID_SIZE, size, size))
+    for a in range(POINTS_CAP, -1, -1):
+        for b in range(POINTS_CAP, -1, -1):
+            if a == POINTS_CAP or (a >= POINTS_TO_WIN and a - b >= 2):
+                table[:, a, b] = 1.0
+            elif b == POINTS_CAP or (b >= POINTS_TO_WIN and b - a >= 2):
+                table[:, a, b] = 0.0
+            else:
+                table[:, a, b] = p * table[:, a + 1, b] + (1 - p) * table[:, a, b + 1]
+    return table
+
+
+def set_win_table():
+    """取得（並快取）局內勝率表"""
+    global _SET_WIN_TABLE
+    if _SET_WIN_TABLE is None:
+        _SET_WIN_TABLE = _build_set_win_table()
+    return _SET_WIN_TABLE
+
+
+def _sets_to_match_prob(sets_a, sets_b, fresh_set_prob):
+    """
+    三局兩勝：在局數 sets_a:sets_b（新局開始前）時 A 贏得整場的機率（向量運算）
+
+    Args:
+        sets_a, sets_b: 目前局數 (np.ndarray)
+        fresh_set_prob: A 從 0:0 開始贏得一局的機率
+    """
+    s = fresh_set_prob
+    return np.select(
+        [sets_a >= SETS_TO_WIN, sets_b >= SETS_TO_WIN,
+         (sets_a == 1) & (sets_b == 1), sets_a == 1, sets_b == 1],
+        [1.0, 0.0, s, s + (1 - s) * s, s * s],
+        default=s * (s + (1 - s) * s) + (1 - s) * s * s,
+    )
+
+
+def _match_win_prob(current_set_prob, fresh_set_prob, sets_a, sets_b):
+    """
+    整場勝率 = 贏下本局 / 輸掉本局兩種情況的加權
+
+    Args:
+        current_set_prob: A 贏得目前這局的機率
+        fresh_set_prob: A 從 0:0 開始贏得一局的機率（用於後續局數）
+        sets_a, sets_b: 本局開始前的局數
+    """
+    after_win = _sets_to_match_prob(sets_a + 1, sets_b, fresh_set_prob)
+    after_loss = _sets_to_match_prob(sets_a, sets_b + 1, fresh_set_prob)
+    return current_set_prob * after_win + (1 - current_set_prob) * after_loss
+
+
+def is_set_over(a, b):
+    """比分 a:b 是否已分出勝負（21 分且領先 2 分，或 30 分）"""
+    a = np.asarray(a)
+    b = np.asarray(b)
+    return ((np.maximum(a, b) >= POINTS_TO_WIN) & (np.abs(a - b) >= 2)) | (np.maximum(a, b) >= POINTS_CAP)
+
+
+def build_momentum_table(rallies):
+    """
+    由回合特徵表計算所有場次的勝率與走勢（一次向量化計算，不對場次迴圈）
+
+    Args:
+        rallies: `utils.rally_features.build_rally_table` 的結果
+
+    Returns:
+        pd.DataFrame: 每回合一列，欄位見 MOMENTUM_DESCRIPTION
+    """
+    r = rallies.sort_values(["match_id", "set", "rally"], kind="mergesort").reset_index(drop=True)
+
+    # 每場的兩位球員（與回合表相同：依名稱排序，A 為較小者）
+    pair = pd.DataFrame({"p1": r["winner"], "p2": r["loser"]})
+    player_a = pair.min(axis=1).groupby(r["match_id"]).transform("min")
+    player_b = pair.max(axis=1).groupby(r["match_id"]).transform("max")
+    a_won = (r["winner"] == player_a).to_numpy()
+
+    # 比分：回合表的記錄比分（回合後 = 回合前 + 該回合得分），轉為 A 的視角
+    set_keys = [r["match_id"], r["set"]]
+    is_set_end = ~r.duplicated(["match_id", "set"], keep="last").to_numpy()
+    a_owns_score = (r["score_owner"] == player_a).to_numpy()
+
+    def to_a_view(player_col, opponent_col):
+        player_score = np.nan_to_num(r[player_col].to_numpy(dtype=float)).astype(np.int64)
+        opponent_score = np.nan_to_num(r[opponent_col].to_numpy(dtype=float)).astype(np.int64)
+        return np.where(a_owns_score, player_score, opponent_score), np.where(a_owns_score, opponent_score, player_score)
+
+    a_before, b_before = to_a_view("player_score_before", "opponent_score_before")
+    a_after, b_after = to_a_view("player_score_after", "opponent_score_after")
+
+    # 局數：只有局末比分已分出勝負時才算（資料在局中斷掉的局不算任何一方贏）
+    set_decided = is_set_end & is_set_over(a_after, b_after)
+    a_set = (set_decided & (a_after > b_after)).astype(np.int64)
+    b_set = (set_decided & (b_after > a_after)).astype(np.int64)
+    match_keys = r["match_id"]
+    a_sets_before = pd.Series(a_set).groupby(match_keys).cumsum().to_numpy() - a_set
+    b_sets_before = pd.Series(b_set).groupby(match_keys).cumsum().to_numpy() - b_set
+    # 同一局內局數固定為該局開始時的值
+    a_sets_before = pd.Series(a_sets_before).groupby(set_keys).transform("first").to_numpy()
+    b_sets_before = pd.Series(b_sets_before).groupby(set_keys).transform("first").to_numpy()
+
+    # 至此為止的單回合勝率估計（以記錄的比分計算已打的分數，含資料中缺漏的回合；向 0.5 收斂）
+    a_prior_sets = pd.Series(np.where(is_set_end, a_after, 0)).groupby(match_keys).cumsum().to_numpy()
+    b_prior_sets = pd.Series(np.where(is_set_end, b_after, 0)).groupby(match_keys).cumsum().to_numpy()
+    a_prior_sets = pd.Series(a_prior_sets - np.where(is_set_end, a_after, 0)).groupby(set_keys).transform("first").to_numpy()
+    b_prior_sets = pd.Series(b_prior_sets - np.where(is_set_end, b_after, 0)).groupby(set_keys).transform("first").to_numpy()
+    a_wins_before = a_prior_sets + a_before
+    played_before = a_prior_sets + b_prior_sets + a_before + b_before
+    a_wins_after = a_prior_sets + a_after
+    played_after = a_prior_sets + b_prior_sets + a_after + b_after
+    p_rally = (a_wins_before + 0.5 * PRIOR_RALLIES) / (played_before + PRIOR_RALLIES)
+    p_rally_after = (a_wins_after + 0.5 * PRIOR_RALLIES) / (played_after + PRIOR_RALLIES)
+
+    table = set_win_table()
+    p_idx = np.rint(p_rally * (P_GRID_SIZE - 1)).astype(np.int64)
+    p_idx_after = np.rint(p_rally_after * (P_GRID_SIZE - 1)).astype(np.int64)
+    set_prob_before = table[p_idx, np.minimum(a_before, POINTS_CAP), np.minimum(b_before, POINTS_CAP)]
+    # 已分出勝負的比分在勝率表中為 1 / 0；沒打完的局維持模型估計的勝率
+    set_prob_after = table[p_idx_after, np.minimum(a_after, POINTS_CAP), np.minimum(b_after, POINTS_CAP)]
+
+    fresh_before = table[p_idx, 0, 0]
+    fresh_after = table[p_idx_after, 0, 0]
+    match_prob_before = _match_win_prob(set_prob_before, fresh_before, a_sets_before, b_sets_before)
+    match_prob_after = _match_win_prob(set_prob_after, fresh_after, a_sets_before, b_sets_before)
+
+    # 連續得分：得分者改變、換局或回合編號不連續（資料跳過回合）時開始新的 run
+    winner = r["winner"].to_numpy()
+    rally_no = r["rally"].to_numpy()
+    new_run = np.ones(len(r), dtype=bool)
+    new_run[1:] = (winner[1:] != winner[:-1]) | (rally_no[1:] != rally_no[:-1] + 1)
+    new_run |= ~pd.DataFrame({"m": r["match_id"], "s": r["set"]}).duplicated(keep="first").to_numpy()
+    run_id = np.cumsum(new_run)
+    run_length = pd.Series(np.ones(len(r), dtype=np.int64)).groupby(run_id).cumsum().to_numpy()
+
+    # 走勢指標：局內 +1 / -1 序列的指數加權平均（以局內序號的冪次一次算完）
+    signed = np.where(a_won, 1.0, -1.0)
+    k = pd.Series(np.ones(len(r))).groupby(set_keys).cumsum().to_numpy() - 1
+    inv_weight = MOMENTUM_DECAY ** (-k)
+    weighted_sum = pd.Series(signed * inv_weight).groupby(set_keys).cumsum().to_numpy()
+    weight_total = pd.Series(inv_weight).groupby(set_keys).cumsum().to_numpy()
+    momentum_a = weighted_sum / weight_total
+
+    return pd.DataFrame({
+        "match_id": r["match_id"],
+        "set": r["set"],
+        "rally": r["rally"],
+        "player_a": player_a,
+        "player_b": player_b,
+        "winner": r["winner"],
+        "a_score_before": a_before,
+        "b_score_before": b_before,
+        "a_score_after": a_after,
+        "b_score_after": b_after,
+        "a_sets_before": a_sets_before,
+        "b_sets_before": b_sets_before,
+        "set_decided": set_decided,
+        "p_rally_a": p_rally,
+        "set_win_prob_before": set_prob_before,
+        "set_win_prob_after": set_prob_after,
+        "match_win_prob_before": match_prob_before,
+        "match_win_prob_after": match_prob_after,
+        "win_prob_swing": match_prob_after - match_prob_before,
+        "run_player": r["winner"],
+        "run_length": run_length,
+        "momentum_a": momentum_a,
+    })
+
+
+def get_momentum_table(df):
+    """
+    取得（並快取）比賽走勢表；資料集內容不變時直接回傳快取結果
+
+    Args:
+        df: 逐拍資料 DataFrame
+
+    Returns:
+        pd.DataFrame or None: 若 df 為 None 則回傳 None
+    """
+    if df is None:
+        return None
+    version = get_dataset_version(df)
+    if version not in _MOMENTUM_CACHE:
+        _MOMENTUM_CACHE[version] = build_momentum_table(get_rally_table(df))
+    return _MOMENTUM_CACHE[version]
+
+
+def momentum_chart(momentum, match_id, width=800, height=200):
+    """
+    報告頁面用的整場勝率折線（以 SVG 座標表示，不需要前端程式；靜態快照也能直接顯示）
+
+    Args:
+        momentum: `build_momentum_table` 的結果
+        match_id: 場次 ID
+        width, height: 圖面大小（像素）
+
+    Returns:
+        dict or None: `match_id`, `player_a`, `player_b`, `points` (polyline 座標字串),
+        `set_lines` (換局位置的 x 座標), `width`, `height`, `final_prob` (最後的 A 整場勝率)；找不到場次時回傳 None
+    """
+    series = momentum[momentum["match_id"] == match_id]
+    if series.empty:
+        return None
+    # 第一個點為開賽前 (50%)，之後每個回合一個點
+    probs = np.concatenate([[0.5], series["match_win_prob_after"].to_numpy(dtype=float)])
+    xs = np.linspace(0, width, len(probs))
+    ys = (1 - probs) * height
+    new_set = ~series["set"].duplicated().to_numpy()
+    return {
+        "match_id": match_id,
+        "player_a": series["player_a"].iloc[0],
+        "player_b": series["player_b"].iloc[0],
+        "points": " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs, ys)),
+        "set_lines": [round(float(x), 1) for x in xs[:-1][new_set][1:]],
+        "width": width,
+        "height": height,
+        "final_prob": float(probs[-1]),
+    }
@@ -0,0 +1,154 @@
+"""
+移動負荷分析
+Movement-load analytics from player_move and ball_distance columns
+
+每一拍的移動距離 = 上一拍後移動到擊球點的距離 (`ball_distance_x/y`)
+              + 擊球後回位的距離 (`player_move_x/y`)
+並拆成橫向 (x) 與縱深 (y) 兩個分量。結果彙總成 球員 × 回合 / 局 / 場 三個層級，
+以向量化運算一次算完並依資料集版本快取，體能類問題直接查表。
+"""
+import numpy as np
+import pandas as pd
+
+from utils.data_loader import get_dataset_version
+from utils.rally_features import NO_RETURN_TYPE, RALLY_KEYS
+
+
+SET_KEYS = ["player", "match_id", "set"]
+MATCH_KEYS = ["player", "match_id"]
+DISTANCE_COLUMNS = ["total_distance", "lateral_distance", "depth_distance", "reach_distance", "recovery_distance"]
+
+# 局內前段 / 後段的分界（以回合在該局的相對位置計）
+EARLY_PHASE_END = 1 / 3
+LATE_PHASE_START = 2 / 3
+
+_MOVEMENT_CACHE = {}
+
+# 給 LLM 的說明（注入到系統指令中）
+MOVEMENT_DESCRIPTION = """- `movement` (MovementLoad)：預先計算的移動負荷（座標為正規化球場單位），體能 / 跑動問題請優先使用，不要重新掃描 `df`。
+  - `movement.by_rally`：球員 × 回合 (`player`, `match_id`, `set`, `rally`)。
+  - `movement.by_set`：球員 × 局，另有 `early_distance_per_shot`, `late_distance_per_shot`, `fatigue_delta` (局末段減前段，正值代表後段跑動增加)。
+  - `movement.by_match`：球員 × 場，另有 `set_fatigue_delta` (最後一局減第一局的每拍移動距離)。
+  共同欄位：`shots`, `total_distance`, `lateral_distance` (橫向), `depth_distance` (縱深), `reach_distance` (上步到擊球點),
+  `recovery_distance` (擊球後回位), `distance_per_shot`, `lateral_share`。
+  - `movement.for_player(player, level='set')`：取得某球員在 'rally' / 'set' / 'match' 層級的資料。"""
+
+
+class MovementLoad:
+    """
+    球員移動負荷表
+
+    Attributes:
+        by_rally: 球員 × 回合
+        by_set: 球員 × 局（含局內疲勞差異）
+        by_match: 球員 × 場（含跨局疲勞差異）
+    """
+
+    def __init__(self, by_rally, by_set, by_match):
+        self.by_rally = by_rally
+        self.by_set = by_set
+        self.by_match = by_match
+
+    def copy(self):
+        """回傳各表皆為副本的 MovementLoad（交給生成的程式碼，避免改動到快取）"""
+        return MovementLoad(self.by_rally.copy(), self.by_set.copy(), self.by_match.copy())
+
+    def for_player(self, player, level="set"):
+        """
+        取得單一球員的移動負荷
+
+        Args:
+            player: 球員名稱
+            level: 'rally' / 'set' / 'match'
+
+        Returns:
+            pd.DataFrame
+        """
+        tables = {"rally": self.by_rally, "set": self.by_set, "match": self.by_match}
+        if level not in tables:
+            raise ValueError(f"level 必須是 {list(tables)} 之一，收到: {level!r}")
+        table = tables[level]
+        return table[table["player"] == player].reset_index(drop=True)
+
+
+def _add_ratios(table):
+    """加上每拍距離與橫向比例"""
+    table["distance_per_shot"] = table["total_distance"] / table["shots"].replace(0, np.nan)
+    table["lateral_share"] = table["lateral_distance"] / (
+        table["lateral_distance"] + table["depth_distance"]
+    ).replace(0, np.nan)
+    return table
+
+
+def build_movement_load(df):
+    """
+    建立移動負荷表（全部向量化）
+
+    Args:
+        df: 逐拍資料 DataFrame
+
+    Returns:
+        MovementLoad
+    """
+    strokes = df[df["type"].ne(NO_RETURN_TYPE) & df["type"].notna()]
+    reach_x = strokes["ball_distance_x"].abs().fillna(0.0).to_numpy()
+    reach_y = strokes["ball_distance_y"].abs().fillna(0.0).to_numpy()
+    move_x = strokes["player_move_x"].fillna(0.0).to_numpy()
+    move_y = strokes["player_move_y"].fillna(0.0).to_numpy()
+
+    shot_load = pd.DataFrame({
+        "player": strokes["player"].to_numpy(),
+        "match_id": strokes["match_id"].to_numpy(),
+        "set": strokes["set"].to_numpy(),
+        "rally": strokes["rally"].to_numpy(),
+        "reach_distance": np.hypot(reach_x, reach_y),
+        "recovery_distance": np.hypot(move_x, move_y),
+        "lateral_distance": reach_x + np.abs(move_x),
+        "depth_distance": reach_y + np.abs(move_y),
+    })
+    shot_load["total_distance"] = shot_load["reach_distance"] + shot_load["recovery_distance"]
+    shot_load["shots"] = 1
+
+    sum_columns = ["shots"] + DISTANCE_COLUMNS
+    by_rally = shot_load.groupby(["player"] + RALLY_KEYS, sort=True)[sum_columns].sum().reset_index()
+
+    # 回合在該局中的相對位置 (0 ~ 1)，用來區分局內前段 / 後段
+    set_rallies = by_rally.groupby(SET_KEYS)["rally"]
+    position = (set_rallies.rank(method="first") - 1) / set_rallies.transform("size").clip(lower=2).sub(1)
+    by_rally["set_phase"] = np.select(
+        [position < EARLY_PHASE_END, position >= LATE_PHASE_START], ["early", "late"], default="middle"
+    )
+    by_rally = _add_ratios(by_rally)
+
+    by_set = by_rally.groupby(SET_KEYS, sort=True)[sum_columns].sum()
+    phase = by_rally.groupby(SET_KEYS + ["set_phase"])[["total_distance", "shots"]].sum().unstack("set_phase")
+    phase_per_shot = phase["total_distance"] / phase["shots"].replace(0, np.nan)
+    by_set["early_distance_per_shot"] = phase_per_shot.get("early")
+    by_set["late_distance_per_shot"] = phase_per_shot.get("late")
+    by_set["fatigue_delta"] = by_set["late_distance_per_shot"] - by_set["early_distance_per_shot"]
+    by_set = _add_ratios(by_set.reset_index())
+
+    by_match = by_set.groupby(MATCH_KEYS, sort=True)[sum_columns].sum()
+    ordered_sets = by_set.sort_values(SET_KEYS).groupby(MATCH_KEYS)["distance_per_shot"]
+    by_match["set_fatigue_delta"] = ordered_sets.last() - ordered_sets.first()
+    by_match = _add_ratios(by_match.reset_index())
+
+    return MovementLoad(by_rally=by_rally, by_set=by_set, by_match=by_match)
+
+
+def get_movement_load(df):
+    """
+    取得（並快取）移動負荷表；資料集內容不變時直接回傳快取結果
+
+    Args:
+        df: 逐拍資料 DataFrame
+
+    Returns:
+        MovementLoad or None: 若 df 為 None 則回傳 None
+    """
+    if df is None:
+        return None
+    version = get_dataset_version(df)
+    if version not in _MOVEMENT_CACHE:
+        _MOVEMENT_CACHE[version] = build_movement_load(df)
+    return _MOVEMENT_CACHE[version]
@@ -0,0 +1,176 @@
+"""
+回合 (rally) 層級特徵表
+Rally-level feature table derived from the shot log
+
+每一列代表一個 (match_id, set, rally)，全部以向量化的 pandas / NumPy 運算
+一次產生，供 LLM 生成的程式碼直接以 `rallies` 變數查詢。
+"""
+import numpy as np
+import pandas as pd
+
+from utils.data_loader import get_dataset_version
+
+
+RALLY_KEYS = ["match_id", "set", "rally"]
+
+# 「接不到」不是實際擊球，只代表上一拍讓對手無法回擊
+NO_RETURN_TYPE = "接不到"
+
+# 以資料集版本為鍵的快取
+_RALLY_TABLE_CACHE = {}
+
+# 給 LLM 的說明（注入到系統指令中）
+RALLY_TABLE_DESCRIPTION = """- `rallies` (pd.DataFrame)：每個回合一列，已預先計算好，回合相關問題請優先使用它而不是從 `df` 重新推導。
+  欄位：`match_id`, `set`, `rally`, `rally_id`, `shot_count` (實際擊球數), `duration_frames`, `duration_sec`,
+  `start_time_sec`, `end_time_sec` (已將 `time` 統一轉為秒數), `server` (發球者), `winner` (得分者), `loser` (失分者),
+  `ending_type` (最後一拍球種), `ending_player` (最後一拍擊球者), `win_reason`, `lose_reason`,
+  `score_owner` (該局 `player_score` 所屬的球員), `player_score_before`, `opponent_score_before`, `score_status_before`,
+  `player_score_after`, `opponent_score_after`, `score_status_after` (回合前比分加上該回合的得分；資料會跳過部分回合，
+  所以下一列的 `*_before` 不一定等於這一列的 `*_after`)。"""
+
+
+def parse_time_to_seconds(time_series):
+    """
+    將 `time` 欄位（混合 `0:07:39` 與 `00:07:43` 兩種格式）轉為秒數
+
+    Args:
+        time_series: `time` 欄位 (pd.Series of str)
+
+    Returns:
+        pd.Series: float 秒數，無法解析者為 NaN
+    """
+    return pd.to_timedelta(time_series, errors="coerce").dt.total_seconds()
+
+
+def score_owner(rallies):
+    """
+    每局記錄的 `player_score` 屬於哪位球員
+
+    只看回合編號相連的兩個回合：比分只有一方加一分時，前一回合的得分者就是該方，以多數決決定；
+    整局都無法判斷時，視為得分回合較多的一方。
+
+    Args:
+        rallies: 每回合一列，需要 `match_id`, `set`, `rally`, `winner`, `loser`,
+            `player_score_before`, `opponent_score_before`
+
+    Returns:
+        np.ndarray: 每回合該局 `player_score` 所屬的球員
+    """
+    r = rallies.reset_index(drop=True)
+    keys = r[["match_id", "set"]]
+    order = np.lexsort((r["rally"].to_numpy(), r["set"].to_numpy(), r["match_id"].to_numpy()))
+    s = r.iloc[order]
+    groups = s.groupby(["match_id", "set"], sort=False)
+    consecutive = (groups["rally"].shift(-1) == s["rally"] + 1).to_numpy()
+    d_player = (groups["player_score_before"].shift(-1) - s["player_score_before"]).to_numpy()
+    d_opponent = (groups["opponent_score_before"].shift(-1) - s["opponent_score_before"]).to_numpy()
+    owner = np.where(consecutive & (d_player == 1) & (d_opponent == 0), s["winner"].to_numpy(),
+                     np.where(consecutive & (d_opponent == 1) & (d_player == 0), s["loser"].to_numpy(), None))
+    s_keys = s[["match_id", "set"]]
+    votes = pd.concat([
+        s_keys.assign(owner=owner, w=1.0).dropna(subset=["owner"]),
+        # 權重極小的備案：只有在沒有任何可判斷的回合時才會決定結果
+        s_keys.assign(owner=s["winner"].to_numpy(), w=1e-6).dropna(subset=["owner"]),
+    ], ignore_index=True)
+    tally = votes.groupby(["match_id", "set", "owner"])["w"].sum().reset_index()
+    best = tally.sort_values("w", ascending=False, kind="mergesort").drop_duplicates(["match_id", "set"])
+    return best.set_index(["match_id", "set"])["owner"].reindex(pd.MultiIndex.from_frame(keys)).to_numpy()
+
+
+def build_rally_table(df):
+    """
+    由逐拍資料建立回合特徵表（向量化，不使用 Python 迴圈）
+
+    Args:
+        df: 逐拍資料 DataFrame (all_dataset.csv)
+
+    Returns:
+        pd.DataFrame: 每回合一列，欄位包含：
+            - match_id, set, rally, rally_id
+            - shot_count: 實際擊球數（不含「接不到」）
+            - start_frame, end_frame, duration_frames
+            - start_time_sec, end_time_sec, duration_sec
+            - server: 發球者
+            - winner, loser: 得分者 / 失分者
+            - ending_type: 最後一個實際擊球的球種
+            - ending_player: 最後一個實際擊球的球員
+            - win_reason, lose_reason
+            - score_owner: 該局 `player_score` 所屬的球員
+            - player_score_before, opponent_score_before, score_status_before
+            - player_score_after, opponent_score_after, score_status_after
+              （回合前比分加上該回合得分者的一分；不取下一個記錄回合的比分，因為資料會跳過部分回合）
+    """
+    shots = df.sort_values(RALLY_KEYS + ["ball_round"], kind="mergesort")
+    shots = shots.assign(time_sec=parse_time_to_seconds(shots["time"]))
+    is_stroke = shots["type"].ne(NO_RETURN_TYPE)
+
+    grouped = shots.groupby(RALLY_KEYS, sort=True)
+    rallies = grouped.agg(
+        rally_id=("rally_id", "first"),
+        server=("player", "first"),
+        winner=("getpoint_player", "last"),
+        win_reason=("win_reason", "last"),
+        lose_reason=("lose_reason", "last"),
+        start_frame=("frame_num", "min"),
+        end_frame=("frame_num", "max"),
+        start_time_sec=("time_sec", "min"),
+        end_time_sec=("time_sec", "max"),
+        player_score_before=("player_score", "first"),
+        opponent_score_before=("opponent_score", "first"),
+        score_status_before=("score_status", "first"),
+    )
+
+    strokes = shots[is_stroke].groupby(RALLY_KEYS, sort=True)
+    rallies["shot_count"] = strokes.size().reindex(rallies.index, fill_value=0).astype("int64")
+    last_stroke = strokes[["type", "player"]].last().reindex(rallies.index)
+    rallies["ending_type"] = last_stroke["type"]
+    rallies["ending_player"] = last_stroke["player"]
+
+    rallies["duration_frames"] = rallies["end_frame"] - rallies["start_frame"]
+    rallies["duration_sec"] = rallies["end_time_sec"] - rallies["start_time_sec"]
+
+    # 每場比賽只有兩位球員：失分者 = 該場另一位球員
+    match_players = shots.groupby("match_id")["player"].agg(["min", "max"])
+    players = match_players.reindex(rallies.index.get_level_values("match_id"))
+    p_min = players["min"].to_numpy()
+    p_max = players["max"].to_numpy()
+    winner = rallies["winner"].to_numpy()
+    loser = np.where(winner == p_min, p_max, p_min)
+    rallies["loser"] = np.where(rallies["winner"].isna().to_numpy(), None, loser)
+
+    # 回合結束後的比分 = 回合前比分 + 得分者的一分
+    rallies["score_owner"] = score_owner(rallies.reset_index())
+    has_winner = rallies["winner"].notna()
+    owner_won = (rallies["winner"] == rallies["score_owner"]) & has_winner
+    rallies["player_score_after"] = rallies["player_score_before"] + owner_won
+    rallies["opponent_score_after"] = rallies["opponent_score_before"] + (has_winner & ~owner_won)
+    rallies["score_status_after"] = rallies["player_score_after"] - rallies["opponent_score_after"]
+
+    columns = [
+        "rally_id", "shot_count",
+        "start_frame", "end_frame", "duration_frames",
+        "start_time_sec", "end_time_sec", "duration_sec",
+        "server", "winner", "loser", "ending_type", "ending_player",
+        "win_reason", "lose_reason", "score_owner",
+        "player_score_before", "opponent_score_before", "score_status_before",
+        "player_score_after", "opponent_score_after", "score_status_after",
+    ]
+    return rallies[columns].reset_index()
+
+
+def get_rally_table(df):
+    """
+    取得（並快取）回合特徵表；資料集內容不變時直接回傳快取結果
+
+    Args:
+        df: 逐拍資料 DataFrame
+
+    Returns:
+        pd.DataFrame or None: 回合特徵表，若 df 為 None 則回傳 None
+    """
+    if df is None:
+        return None
+    version = get_dataset_version(df)
+    if version not in _RALLY_TABLE_CACHE:
+        _RALLY_TABLE_CACHE[version] = build_rally_table(df)
+    return _RALLY_TABLE_CACHE[version]
@@ -0,0 +1,174 @@
+"""
+報告頁面的靜態快照
+Static snapshot export of rendered report pages
+
+報告產生後內容就不再改變，不需要每次瀏覽都重新以 Jinja 繪製、再經由 Flask 逐張傳送圖片。
+這裡把繪製好的報告 HTML 凍結成靜態檔案：
+- snapshots/<report_id>.html：引用的圖片 (/report-images/...) 與 static/ 的 CSS / JS 都改為相對路徑；
+- snapshots/<report_id>.json：輸出時的資料集版本（資料更新後，對戰報告等由資料算出的快照即失效）；
+- snapshots/assets/：以內容雜湊命名的資源檔（內容不變時檔名不變，可以長期快取）。
+整個 snapshots/ 資料夾可以交給任何靜態檔案伺服器，或複製到平板離線開啟。
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from urllib.parse import unquote, urlsplit
+
+
+DEFAULT_SNAPSHOT_DIR = "snapshots"
+ASSETS_DIR = "assets"
+
+# 需要複製進快照的網址前綴
+ASSET_PREFIXES = ("/static/", "/report-images/")
+_ASSET_REF = re.compile(r'(?P<attr>\b(?:src|href))="(?P<url>/(?:static|report-images)/[^"]+)"')
+_REPORT_ID = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+
+def snapshot_filename(report_id):
+    """
+    報告 ID -> 快照檔名（只接受英數字、底線與連字號，避免路徑穿越）
+
+    Raises:
+        ValueError: 報告 ID 含有其他字元
+    """
+    if not _REPORT_ID.match(report_id) or report_id == ASSETS_DIR:
+        raise ValueError(f"無法為報告 ID {report_id!r} 建立快照")
+    return f"{report_id}.html"
+
+
+def snapshot_path(report_id, out_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    已輸出的快照路徑
+
+    Returns:
+        str or None: 快照不存在（或報告 ID 不合法）時回傳 None
+    """
+    try:
+        path = os.path.join(out_dir, snapshot_filename(report_id))
+    except ValueError:
+        return None
+    return path if os.path.exists(path) else None
+
+
+def snapshot_version(report_id, out_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    快照輸出時的資料集版本
+
+    Returns:
+        str or None: 沒有快照、沒有版本紀錄（舊版輸出）或無法讀取時回傳 None
+    """
+    path = snapshot_path(report_id, out_dir)
+    if path is None:
+        return None
+    try:
+        with open(os.path.splitext(path)[0] + ".json", encoding="utf-8") as f:
+            return json.load(f).get("dataset_version")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def hashed_name(filename, data, length=10):
+    """以內容雜湊命名資源檔（例如 smash.png -> smash.3f2a9c1b0d.png）"""
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    return f"{stem}.{hashlib.sha1(data).hexdigest()[:length]}{ext}"
+
+
+def _write_atomic(path, data):
+    # 暫存檔名包含行程 / 執行緒，同時輸出同一份快照時不會互相覆寫
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def freeze_html(html, resolve, out_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    將 HTML 中引用的圖片與 static/ 檔案複製到 assets/（以內容雜湊命名），並改成相對路徑
+
+    Args:
+        html: 繪製好的報告 HTML
+        resolve: 網址路徑 -> 本機檔案路徑的函數（找不到時回傳 None，保留原本的網址）
+        out_dir: 快照資料夾
+
+    Returns:
+        tuple: (改寫後的 HTML, 複製的資源檔名 list)
+    """
+    assets_dir = os.path.join(out_dir, ASSETS_DIR)
+    os.makedirs(assets_dir, exist_ok=True)
+    copied = {}
+
+    def replace(match):
+        url = match.group("url")
+        if url not in copied:
+            source = resolve(unquote(urlsplit(url).path))
+            if source is None or not os.path.isfile(source):
+                print(f"[report_snapshot] 找不到資源，保留原本的網址: {url}")
+                return match.group(0)
+            with open(source, "rb") as f:
+                data = f.read()
+            name = hashed_name(source, data)
+            target = os.path.join(assets_dir, name)
+            if not os.path.exists(target):
+                _write_atomic(target, data)
+            copied[url] = name
+        return f'{match.group("attr")}="{ASSETS_DIR}/{copied[url]}"'
+
+    return _ASSET_REF.sub(replace, html), sorted(set(copied.values()))
+
+
+def export_snapshot(report_id, html, resolve, out_dir=DEFAULT_SNAPSHOT_DIR, dataset_version=None):
+    """
+    輸出單一報告的靜態快照
+
+    Args:
+        report_id: 報告 ID
+        html: 繪製好的報告 HTML
+        resolve: 網址路徑 -> 本機檔案路徑的函數
+        out_dir: 快照資料夾
+        dataset_version: 繪製時的資料集版本（寫入 <report_id>.json，供 `snapshot_version` 判斷是否過期）
+
+    Returns:
+        str: 快照 HTML 的路徑
+    """
+    filename = snapshot_filename(report_id)
+    frozen, _ = freeze_html(html, resolve, out_dir)
+    path = os.path.join(out_dir, filename)
+    # 先寫版本再寫 HTML：HTML 存在時，版本紀錄一定不比它舊
+    _write_atomic(os.path.splitext(path)[0] + ".json",
+                  json.dumps({"dataset_version": dataset_version}).encode("utf-8"))
+    _write_atomic(path, frozen.encode("utf-8"))
+    return path
+
+
+def remove_snapshot(report_id, out_dir=DEFAULT_SNAPSHOT_DIR):
+    """刪除報告的快照與版本紀錄（之後的瀏覽改回動態繪製）"""
+    path = snapshot_path(report_id, out_dir)
+    if path is not None:
+        os.remove(path)
+        version_path = os.path.splitext(path)[0] + ".json"
+        if os.path.exists(version_path):
+            os.remove(version_path)
+
+
+def prune_assets(out_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    刪除沒有任何快照引用的資源檔（報告重新輸出後，舊雜湊的檔案）
+
+    Returns:
+        list: 刪除的檔名
+    """
+    assets_dir = os.path.join(out_dir, ASSETS_DIR)
+    if not os.path.isdir(assets_dir):
+        return []
+    referenced = set()
+    for filename in os.listdir(out_dir):
+        if filename.endswith(".html"):
+            with open(os.path.join(out_dir, filename), encoding="utf-8") as f:
+                referenced.update(re.findall(rf'"{ASSETS_DIR}/([^"]+)"', f.read()))
+    removed = [name for name in os.listdir(assets_dir)
+               if name not in referenced and os.path.isfile(os.path.join(assets_dir, name))]
+    for name in removed:
+        os.remove(os.path.join(assets_dir, name))
+    return removed
@@ -0,0 +1,443 @@
+"""
+場次、報告、圖表與分析結果的 SQLite 儲存
+SQLite-backed store for sessions, reports, chart artifacts and cached analysis results
+
+取代 app.py 中寫死的模擬資料與「以檔名 {session_id}_{attribute}.png 覆寫圖表」的做法：
+- sessions / session_matches：場次與其對應的 match_id；
+- reports / chart_artifacts：報告文字與圖表（依 報告 / 場次 / 球員 / 指標 建立索引）；
+- analysis_results：儀表板分析的結果（AI 服務無法使用時的備援）。
+每個行程有一個固定大小的連線池（WAL 模式，讀寫不互相阻擋）；werkzeug 每個請求一條新執行緒，
+以執行緒為單位保存連線會讓連線數隨請求數成長，所以改為借出 / 歸還。
+"""
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_DB_PATH = "cache/goodminton.db"
+# 每個行程最多開啟的連線數；全部借出時最多等待 POOL_TIMEOUT_SECONDS 秒
+DEFAULT_POOL_SIZE = 4
+POOL_TIMEOUT_SECONDS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS session_matches (
+    session_id TEXT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    match_id INTEGER NOT NULL,
+    PRIMARY KEY (session_id, match_id)
+);
+CREATE INDEX IF NOT EXISTS idx_session_matches_match ON session_matches(match_id);
+
+CREATE TABLE IF NOT EXISTS reports (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'manual',
+    session_id TEXT,
+    player TEXT,
+    opponent TEXT,
+    main_text TEXT,
+    position INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_reports_session ON reports(session_id);
+CREATE INDEX IF NOT EXISTS idx_reports_player ON reports(player, opponent);
+
+CREATE TABLE IF NOT EXISTS chart_artifacts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    report_id TEXT,
+    session_id TEXT,
+    attribute TEXT,
+    player TEXT,
+    path TEXT NOT NULL,
+    title TEXT,
+    description TEXT,
+    position INTEGER NOT NULL DEFAULT 0,
+    dataset_version TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_charts_report ON chart_artifacts(report_id, position);
+CREATE INDEX IF NOT EXISTS idx_charts_session_attr ON chart_artifacts(session_id, attribute, created);
+CREATE INDEX IF NOT EXISTS idx_charts_player ON chart_artifacts(player);
+
+CREATE TABLE IF NOT EXISTS analysis_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    attribute TEXT NOT NULL,
+    player TEXT NOT NULL DEFAULT '',
+    mode TEXT NOT NULL,
+    dataset_version TEXT,
+    text TEXT,
+    chart_path TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_results_lookup ON analysis_results(session_id, attribute, player, created);
+"""
+
+
+def _rows(cursor):
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def content_hash(data, length=12):
+    """內容雜湊（用於圖表檔名：內容相同的圖表只存一份，不同的圖表不會互相覆寫）"""
+    return hashlib.sha1(data).hexdigest()[:length]
+
+
+class ReportStore:
+    """
+    場次 / 報告 / 圖表 / 分析結果的 SQLite 儲存
+
+    Args:
+        path: 資料庫檔案路徑（":memory:" 時連線池只有一條連線，所有操作共用同一個資料庫）
+        pool_size: 每個行程最多開啟的連線數
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, pool_size=DEFAULT_POOL_SIZE):
+        self.path = path
+        self.pool_size = 1 if path == ":memory:" else pool_size
+        self._pool_lock = threading.Lock()
+        self._pool_pid = None
+        self._write_lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._transaction() as conn:
+            conn.executescript(SCHEMA)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _pool(self):
+        """目前行程的連線池（fork 出來的 worker 不可沿用父行程的連線，改建新的池）"""
+        with self._pool_lock:
+            if self._pool_pid != os.getpid():
+                self._idle = queue.LifoQueue(maxsize=self.pool_size)
+                self._opened = 0
+                self._pool_pid = os.getpid()
+            return self._idle
+
+    @contextmanager
+    def _connection(self):
+        """
+        從連線池借出一條連線，離開 with 區塊時歸還
+
+        Raises:
+            sqlite3.OperationalError: 等待 POOL_TIMEOUT_SECONDS 秒仍沒有可用的連線
+        """
+        idle = self._pool()
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._opened < self.pool_size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                conn = self._open()
+            else:
+                try:
+                    conn = idle.get(timeout=POOL_TIMEOUT_SECONDS)
+                except queue.Empty:
+                    raise sqlite3.OperationalError(
+                        f"{POOL_TIMEOUT_SECONDS} 秒內沒有可用的資料庫連線（連線池大小 {self.pool_size}）"
+                    ) from None
+        try:
+            yield conn
+        finally:
+            if idle is self._idle:
+                idle.put_nowait(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """寫入：同一時間只有一個寫入者，離開時 commit（例外時 rollback）"""
+        with self._write_lock, self._connection() as conn, conn:
+            yield conn
+
+    def _read(self, sql, params=()):
+        with self._connection() as conn:
+            return _rows(conn.execute(sql, params))
+
+    def _read_one(self, sql, params=()):
+        with self._connection() as conn:
+            row = conn.execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def _write(self, sql, params=()):
+        with self._transaction() as conn:
+            return conn.execute(sql, params)
+
+    # --- 場次 ---
+    def upsert_session(self, session_id, name, match_ids=(), position=0):
+        """新增或更新場次與其對應的 match_id"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO sessions (id, name, position, created) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET name=excluded.name, position=excluded.position",
+                (session_id, name, position, time.time()),
+            )
+            conn.execute("DELETE FROM session_matches WHERE session_id = ?", (session_id,))
+            conn.executemany(
+                "INSERT INTO session_matches (session_id, match_id) VALUES (?, ?)",
+                [(session_id, int(m)) for m in match_ids],
+            )
+
+    def list_sessions(self):
+        """
+        所有場次（依 position 排序）
+
+        Returns:
+            list of {"id", "name"}
+        """
+        return self._read("SELECT id, name FROM sessions ORDER BY position, id")
+
+    def session_match_ids(self, session_id):
+        """場次對應的 match_id（由小到大）"""
+        rows = self._read(
+            "SELECT match_id FROM session_matches WHERE session_id = ? ORDER BY match_id", (session_id,)
+        )
+        return [row["match_id"] for row in rows]
+
+    def sessions_for_match(self, match_id):
+        """包含某個 match_id 的場次 ID"""
+        rows = self._read(
+            "SELECT session_id FROM session_matches WHERE match_id = ? ORDER BY session_id", (int(match_id),)
+        )
+        return [row["session_id"] for row in rows]
+
+    # --- 報告 ---
+    def upsert_report(self, report_id, title, kind="manual", session_id=None, player=None, opponent=None,
+                      main_text=None, position=0):
+        """新增或更新報告（main_text 為 None 時保留原本的文字）"""
+        self._write(
+            "INSERT INTO reports (id, title, kind, session_id, player, opponent, main_text, position, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET title=excluded.title, kind=excluded.kind, "
+            "session_id=excluded.session_id, player=excluded.player, opponent=excluded.opponent, "
+            "main_text=COALESCE(excluded.main_text, reports.main_text), position=excluded.position, "
+            "updated=excluded.updated",
+            (report_id, title, kind, session_id, player, opponent, main_text, position, time.time()),
+        )
+
+    def get_report(self, report_id):
+        """
+        取得單一報告
+
+        Returns:
+            dict or None
+        """
+        return self._read_one("SELECT * FROM reports WHERE id = ?", (report_id,))
+
+    def list_reports(self, kind=None):
+        """所有報告（依 position、ID 排序），可依種類篩選"""
+        if kind is None:
+            return self._read("SELECT * FROM reports ORDER BY position, id")
+        return self._read("SELECT * FROM reports WHERE kind = ? ORDER BY position, id", (kind,))
+
+    def remove_reports(self, report_ids):
+        """刪除報告與其圖表紀錄（圖片檔案保留）"""
+        report_ids = list(report_ids)
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM chart_artifacts WHERE report_id = ?", [(r,) for r in report_ids])
+            conn.executemany("DELETE FROM reports WHERE id = ?", [(r,) for r in report_ids])
+
+    def reports_for_player(self, player):
+        """某位球員（任一方）的所有報告"""
+        return self._read(
+            "SELECT * FROM reports WHERE player = ? UNION SELECT * FROM reports WHERE opponent = ? "
+            "ORDER BY position, id",
+            (player, player),
+        )
+
+    # --- 圖表 ---
+    def set_report_charts(self, report_id, charts, dataset_version=None):
+        """
+        取代報告的圖表清單
+
+        Args:
+            report_id: 報告 ID
+            charts: [{"path", "title", "description"}, ...]；path 為 report_pics 下的相對路徑
+            dataset_version: 產生圖表時的資料集版本
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM chart_artifacts WHERE report_id = ?", (report_id,))
+            conn.executemany(
+                "INSERT INTO chart_artifacts (report_id, path, title, description, position, dataset_version, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(report_id, c["path"], c.get("title"), c.get("description"), i, dataset_version, now)
+                 for i, c in enumerate(charts)],
+            )
+
+    def report_charts(self, report_id):
+        """報告的圖表（依 position 排序）"""
+        return self._read("SELECT * FROM chart_artifacts WHERE report_id = ? ORDER BY position", (report_id,))
+
+    def add_chart(self, path, session_id=None, attribute=None, player=None, title=None, description=None,
+                  dataset_version=None):
+        """新增一張儀表板分析產生的圖表，回傳其 ID"""
+        cursor = self._write(
+            "INSERT INTO chart_artifacts (session_id, attribute, player, path, title, description, dataset_version, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (session_id, attribute, player or None, path, title, description, dataset_version, time.time()),
+        )
+        return cursor.lastrowid
+
+    def latest_chart(self, session_id, attribute, player=None):
+        """
+        某場次 / 指標 / 球員最新的圖表（player 為 None 時只找沒有指定球員的圖表）
+
+        Returns:
+            dict or None
+        """
+        return self._read_one(
+            "SELECT * FROM chart_artifacts WHERE session_id = ? AND attribute = ? AND COALESCE(player, '') = ? "
+            "ORDER BY created DESC, id DESC LIMIT 1",
+            (session_id, attribute, player or ""),
+        )
+
+    def charts_for_player(self, player):
+        """某位球員的所有圖表（由新到舊）"""
+        return self._read("SELECT * FROM chart_artifacts WHERE player = ? ORDER BY created DESC, id DESC", (player,))
+
+    # --- 分析結果 ---
+    def save_result(self, session_id, attribute, mode, text, chart_path=None, player=None, dataset_version=None):
+        """保存一次成功的儀表板分析結果"""
+        self._write(
+            "INSERT INTO analysis_results (session_id, attribute, player, mode, dataset_version, text, chart_path, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (session_id, attribute, player or "", mode, dataset_version, text, chart_path, time.time()),
+        )
+
+    def latest_result(self, session_id, attribute, player=None, dataset_version=None):
+        """
+        某場次 / 指標 / 球員最新的分析結果（指定 dataset_version 時只找同版本的結果）
+
+        Returns:
+            dict or None
+        """
+        sql = "SELECT * FROM analysis_results WHERE session_id = ? AND attribute = ? AND player = ?"
+        params = [session_id, attribute, player or ""]
+        if dataset_version is not None:
+            sql += " AND dataset_version = ?"
+            params.append(dataset_version)
+        return self._read_one(sql + " ORDER BY created DESC, id DESC LIMIT 1", params)
+
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def open_store(path=None):
+    """
+    取得（並快取）某個路徑的 ReportStore；同一行程內的 app.py 與 llm_core 共用同一個實例
+
+    Args:
+        path: 資料庫路徑（省略時使用環境變數 REPORT_DB_PATH 或 DEFAULT_DB_PATH）
+
+    Returns:
+        ReportStore
+    """
+    path = path or os.getenv("REPORT_DB_PATH", DEFAULT_DB_PATH)
+    with _STORES_LOCK:
+        if path not in _STORES:
+            _STORES[path] = ReportStore(path)
+        return _STORES[path]
+
+
+# --- 初始資料：原本寫死在 app.py 的場次 / 報告，以及 report_pics 中既有的圖表 ---
+LEGACY_SESSION = ("S001", "場次1")
+LEGACY_REPORT_ID = "R001"
+LEGACY_REPORT_FOLDER = "chao_vs_tao"
+LEGACY_REPORT_TITLE = "R001: 趙 vs 陶 (chao_vs_tao)"
+LEGACY_REPORT_TEXT = """
+    這裡是報告 R001 的主要文字區塊。
+    周天成的主要得分手段為「落地致勝」，主要失分原因為「出界」、「掛網」和「未過網」。
+
+    關鍵發現：
+
+    得分手段集中： 周天成的得分手段主要依賴於「落地致勝」（80次），遠高於其他得分方式。這顯示其進攻具備一定威脅性，能直接得分。
+    數據來源：player_win_reasons
+    非受迫性失誤為主： 周天成的失分主要來自於「出界」（74次）、「掛網」（60次）和「未過網」（24次），這些都屬於非受迫性失誤。這暗示周天成在比賽中可能存在穩定性問題，需要減少自身失誤。
+    數據來源：player_lose_reasons
+
+    總結：
+
+    周天成具備強勁的進攻能力，但需要透過減少非受迫性失誤來提升比賽穩定性。
+    """
+# 檔名 -> (標題, 說明)
+LEGACY_REPORT_CHARTS = {
+    "diff_balls": ("不同球種", "這是從 report_pics 動態載入的球種圖。"),
+    "different_places_score": ("得分分布圖", "這是從 report_pics 動態載入的得分分布圖。"),
+    "opp_lose_reasons": ("得分分析圖", "這是從 report_pics 動態載入的得分分析圖。"),
+    "running": ("得分分析圖", "這是從 report_pics 動態載入的得分分析圖。"),
+    "score_reason": ("得分分析圖", "這是從 report_pics 動態載入的得分分析圖。"),
+    "smash": ("得分分析圖", "這是從 report_pics 動態載入的得分分析圖。"),
+    "time_error": ("得分分析圖", "這是從 report_pics 動態載入的得分分析圖。"),
+}
+DASHBOARD_CHART_DIR = "others"
+
+
+def seed_store(store, df=None, h2h=None, report_pics_dir="report_pics"):
+    """
+    建立初始資料（可重複執行）：
+    - 場次：原本的 S001（全部比賽）與每場比賽各一個場次 (M<match_id>)
+    - 報告：原本的 R001 與對戰矩陣中的每一組對戰 (文字與圖表在第一次瀏覽時產生)
+    - 圖表：report_pics/others 中既有的 {session_id}_{attribute}.png
+
+    Args:
+        store: ReportStore
+        df: 逐拍資料（None 時只建立原本的場次與報告）
+        h2h: HeadToHeadMatrix（None 時不建立對戰報告）
+        report_pics_dir: 圖表資料夾
+    """
+    match_ids = [] if df is None else sorted(int(m) for m in df["match_id"].dropna().unique())
+    store.upsert_session(*LEGACY_SESSION, match_ids=match_ids, position=0)
+    if df is not None:
+        players = df.dropna(subset=["match_id"]).groupby("match_id")["player"].unique()
+        for position, match_id in enumerate(match_ids, start=1):
+            names = " vs ".join(sorted(str(p) for p in players.loc[match_id]))
+            store.upsert_session(f"M{match_id}", f"比賽 {match_id}: {names}", match_ids=[match_id], position=position)
+
+    if store.get_report(LEGACY_REPORT_ID) is None:
+        store.upsert_report(LEGACY_REPORT_ID, LEGACY_REPORT_TITLE, main_text=LEGACY_REPORT_TEXT)
+        store.set_report_charts(LEGACY_REPORT_ID, [
+            {"path": f"{LEGACY_REPORT_FOLDER}/{name}.png", "title": f"{LEGACY_REPORT_FOLDER} - {title}",
+             "description": description}
+            for name, (title, description) in LEGACY_REPORT_CHARTS.items()
+        ])
+
+    if h2h is not None:
+        report_ids = set()
+        for position, (player, opponent) in enumerate(h2h.pairs(), start=1):
+            report_id = h2h.report_id(player, opponent)
+            report_ids.add(report_id)
+            store.upsert_report(report_id, f"對戰: {player} vs {opponent}", kind="h2h",
+                                player=player, opponent=opponent, position=position)
+        # 資料集中已沒有的對戰（以及舊版以球員序號組成的 H2H-i-j 報告）
+        store.remove_reports(r["id"] for r in store.list_reports(kind="h2h") if r["id"] not in report_ids)
+
+    chart_dir = os.path.join(report_pics_dir, DASHBOARD_CHART_DIR)
+    if os.path.isdir(chart_dir):
+        known = {c["path"] for c in store._read("SELECT path FROM chart_artifacts WHERE session_id IS NOT NULL")}
+        for filename in sorted(os.listdir(chart_dir)):
+            stem, ext = os.path.splitext(filename)
+            path = f"{DASHBOARD_CHART_DIR}/{filename}"
+            if ext != ".png" or "_" not in stem or path in known:
+                continue
+            session_id, attribute = stem.split("_", 1)
+            store.add_chart(path, session_id=session_id, attribute=attribute)
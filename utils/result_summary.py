@@ -0,0 +1,255 @@
+"""
+分析結果的精簡摘要（有明確 token 預算）
+Compact, token-budgeted summaries of captured analysis variables
+
+不先把整個表格轉成 Markdown 再丟掉，而是：
+1. 依關聯性排序擷取到的變數（被畫成圖的 > 彙總結果 > 大型中間資料），丟掉無關的中間變數；
+2. 每個變數只輸出精簡的 CSV 片段與統計（前 k 名、總和、占比）；
+3. 累計估計的 token 數，超過預算就停止（或改用更短的格式）。
+"""
+import ast
+import re
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_TOKEN_BUDGET = 1200
+TOP_K = 10
+# 列數超過此值的 DataFrame / Series 視為中間資料（只輸出統計，不輸出列）
+MAX_DETAIL_ROWS = 60
+# 常見的暫存 / 迴圈變數名稱
+SCRATCH_NAMES = {"i", "j", "k", "n", "x", "y", "idx", "row", "col", "mask", "tmp", "temp", "data_copy",
+                 "font_path_or_name", "font_prop", "colors", "color", "bar", "bars", "wedges", "texts", "autotexts"}
+PLOT_METHODS = {"bar", "barh", "plot", "pie", "scatter", "hist", "imshow", "heatmap", "boxplot", "violinplot",
+                "fill_between", "stackplot", "step", "errorbar", "draw_court_heatmap"}
+
+_CJK = re.compile(r"[⺀-鿿豈-﫿＀-￯]")
+
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓字元約 1 token / 字，其他約 4 字元 / token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def plotted_names(code):
+    """
+    找出程式碼中被傳進繪圖函數的變數名稱（例如 ax.bar(counts.index, counts.values) -> {'counts'}）
+
+    Args:
+        code: 執行的程式碼（None 或語法錯誤時回傳空集合）
+
+    Returns:
+        set of str
+    """
+    if not code:
+        return set()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        method = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+        # df.plot(kind='bar') / series.plot.bar() 也算
+        if method in PLOT_METHODS or (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Attribute)
+                                      and func.value.attr == "plot"):
+            targets = list(node.args) + [kw.value for kw in node.keywords]
+            if isinstance(func, ast.Attribute):
+                targets.append(func.value)
+            for target in targets:
+                names.update(n.id for n in ast.walk(target) if isinstance(n, ast.Name))
+    return names
+
+
+def is_summary_candidate(name, value):
+    """擷取階段的過濾：保留純量、pandas / NumPy 結果與小型容器，排除模組、函數、圖表物件"""
+    if name.startswith("_") or callable(value):
+        return False
+    if type(value).__module__.startswith("matplotlib"):
+        return False
+    return isinstance(value, (bool, int, float, str, np.generic, np.ndarray, pd.DataFrame, pd.Series,
+                              list, tuple, dict))
+
+
+def _relevance(name, value, plotted):
+    """變數關聯性分數：越高越優先放進摘要；None 代表直接丟棄"""
+    if name in SCRATCH_NAMES and name not in plotted:
+        return None
+    if isinstance(value, str) and (len(value) > 200 or "/" in value or "\\" in value):
+        return None
+    score = 0.0
+    if name in plotted:
+        score += 10
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        rows = len(value)
+        if rows == 0:
+            return None
+        if isinstance(value, pd.Series) and value.dtype == bool and rows > MAX_DETAIL_ROWS:
+            return None  # 布林遮罩
+        if rows > MAX_DETAIL_ROWS:
+            score += 0.5  # 大型中間資料（例如篩選後的 df），排在其他結果之後
+        else:
+            score += 5
+            if not isinstance(value.index, pd.RangeIndex):
+                score += 2  # groupby / value_counts 的結果
+    elif isinstance(value, (bool, int, float, np.generic)):
+        score += 4
+    elif isinstance(value, str):
+        score += 2
+    else:
+        score += 1
+    return score
+
+
+def _fmt(value):
+    """數值格式化：整數不帶小數，浮點數保留 4 位有效數字"""
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return ""
+        return f"{value:.4g}"
+    return str(value)
+
+
+def _series_lines(series, top_k):
+    """Series：前 k 名（數值依大小排序）+ 總和與占比"""
+    lines = []
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        values = series.dropna()
+        # 以位置排序（index 可能有重複標籤，不能用 reindex / drop）
+        order = np.argsort(-values.abs().to_numpy(), kind="stable") if len(values) > top_k else np.arange(len(values))
+        total = values.sum()
+        with_share = len(values) > 1 and (values >= 0).all() and total > 0
+        lines.append("index,value" + (",share" if with_share else ""))
+        for idx, val in values.iloc[order[:top_k]].items():
+            lines.append(f"{idx},{_fmt(val)}" + (f",{val / total:.1%}" if with_share else ""))
+        if len(values) > top_k:
+            rest = values.iloc[order[top_k:]]
+            lines.append(f"(其餘 {len(rest)} 項, 合計 {_fmt(rest.sum())})")
+        if len(values) > 1:
+            lines.append(f"total={_fmt(total)}, mean={_fmt(values.mean())}, n={len(values)}")
+    else:
+        counts = series.value_counts()
+        lines.append("value,count,share")
+        for idx, val in counts.head(top_k).items():
+            lines.append(f"{idx},{val},{val / max(counts.sum(), 1):.1%}")
+        if len(counts) > top_k:
+            lines.append(f"(其餘 {len(counts) - top_k} 種)")
+    return lines
+
+
+def _frame_lines(frame, top_k):
+    """DataFrame：小表輸出前 k 列的 CSV；大表只輸出數值欄位的統計"""
+    lines = [f"shape={frame.shape[0]}x{frame.shape[1]}"]
+    if len(frame) <= MAX_DETAIL_ROWS:
+        head = frame.head(top_k)
+        lines.append(",".join([str(head.index.name or "")] + [str(c) for c in head.columns]))
+        for idx, row in zip(head.index, head.itertuples(index=False)):
+            lines.append(",".join([str(idx)] + [_fmt(v) for v in row]))
+        if len(frame) > top_k:
+            lines.append(f"(其餘 {len(frame) - top_k} 列)")
+        numeric = frame.select_dtypes("number")
+        if len(frame) > 1 and not numeric.empty:
+            lines.append("total: " + ", ".join(f"{c}={_fmt(v)}" for c, v in numeric.sum().head(top_k).items()))
+    else:
+        numeric = frame.select_dtypes("number")
+        lines.append("columns: " + ", ".join(str(c) for c in frame.columns[:20]))
+        for col in numeric.columns[:min(top_k, 5)]:
+            values = numeric[col]
+            lines.append(f"{col}: mean={_fmt(values.mean())}, min={_fmt(values.min())}, max={_fmt(values.max())}")
+    return lines
+
+
+def _value_lines(value, top_k):
+    """依型別輸出摘要內容（list of str）"""
+    if isinstance(value, pd.Series):
+        lines = _series_lines(value, top_k)
+    elif isinstance(value, pd.DataFrame):
+        lines = _frame_lines(value, top_k)
+    elif isinstance(value, np.ndarray):
+        lines = [f"shape={value.shape}"]
+        if value.size and np.issubdtype(value.dtype, np.number) and not np.isnan(value).all():
+            flat_max = tuple(int(i) for i in np.unravel_index(np.nanargmax(value), value.shape))
+            lines.append(f"sum={_fmt(np.nansum(value))}, max={_fmt(np.nanmax(value))} at {flat_max}")
+    elif isinstance(value, (list, tuple, dict)):
+        # 只取前 k 項再轉成文字，避免對大型容器做完整的 repr
+        items = list(value.items())[:top_k] if isinstance(value, dict) else list(value)[:top_k]
+        text = repr(dict(items) if isinstance(value, dict) else items)
+        lines = [text[:300] + (f" ... (共 {len(value)} 項)" if len(value) > top_k or len(text) > 300 else "")]
+    else:
+        lines = [_fmt(value)]
+    return lines
+
+
+def _repr_lines(value, limit=300):
+    """無法依型別摘要時的備案：截斷的 repr"""
+    try:
+        text = repr(value)
+    except Exception as e:
+        return [f"(無法顯示: {type(e).__name__})"]
+    return [text[:limit] + (" ..." if len(text) > limit else "")]
+
+
+def summarize_value(name, value, top_k=TOP_K):
+    """
+    單一變數的精簡摘要（任何一個變數摘要失敗時改用截斷的 repr，不影響其他變數）
+
+    Args:
+        name: 變數名稱
+        value: 變數值
+        top_k: 最多輸出的列數
+
+    Returns:
+        str
+    """
+    header = f"### `{name}` ({type(value).__name__})"
+    try:
+        lines = _value_lines(value, top_k)
+    except Exception as e:
+        print(f"[result_summary] 無法摘要 `{name}`，改用 repr: {type(e).__name__}: {e}")
+        lines = _repr_lines(value)
+    return header + "\n" + "\n".join(lines)
+
+
+def summarize_results(summary_info, code=None, token_budget=DEFAULT_TOKEN_BUDGET, top_k=TOP_K):
+    """
+    將擷取到的變數排序並在 token 預算內輸出精簡摘要
+
+    Args:
+        summary_info: 變數名稱 -> 值
+        code: 執行的程式碼（用來判斷哪些變數被畫成圖）
+        token_budget: 摘要的 token 上限（估計值）
+        top_k: 每個變數最多輸出的列數
+
+    Returns:
+        tuple: (摘要文字, 實際放入的變數名稱 list, 丟棄的變數名稱 list)
+    """
+    plotted = plotted_names(code)
+    ranked = []
+    dropped = []
+    for order, (name, value) in enumerate(summary_info.items()):
+        score = _relevance(name, value, plotted)
+        if score is None:
+            dropped.append(name)
+        else:
+            # 分數相同時，較晚產生的變數（通常是最終結果）優先
+            ranked.append((-score, -order, name, value))
+    ranked.sort(key=lambda item: item[:2])
+
+    parts, used, remaining = [], [], token_budget
+    for _, _, name, value in ranked:
+        for k in (top_k, max(top_k // 2, 3), 1):
+            text = summarize_value(name, value, top_k=k)
+            cost = estimate_tokens(text)
+            if cost <= remaining:
+                parts.append(text)
+                used.append(name)
+                remaining -= cost
+                break
+        else:
+            dropped.append(name)
+    return "\n\n".join(parts), used, dropped
@@ -0,0 +1,213 @@
+"""
+球路序列模式索引
+Shot-sequence pattern mining index over rallies
+
+將每個回合的 `type` 序列編碼為整數陣列，一次建立 1 ~ MAX_NGRAM 拍的
+n-gram / 轉移索引（含各球員的出現次數與得分結果），之後的戰術問題
+（例如「我打長球後對手回什麼」、「哪些三拍組合最容易得分」）都只是查表。
+"""
+import numpy as np
+import pandas as pd
+
+from utils.data_loader import get_dataset_version
+from utils.rally_features import NO_RETURN_TYPE
+
+
+MAX_NGRAM = 4
+
+_PATTERN_INDEX_CACHE = {}
+
+# 給 LLM 的說明（注入到系統指令中）
+SHOT_PATTERN_DESCRIPTION = """- `shot_patterns` (ShotPatternIndex)：預先建立的球路序列索引，球路 / 戰術組合問題請優先使用，不要自行用迴圈掃描 `df`。
+  - `shot_patterns.next_shot_distribution(prev_type, player=None)`：`player` 打出 `prev_type` 後，對手下一拍各球種的次數與比例 (pd.DataFrame)。
+  - `shot_patterns.top_patterns(n=3, player=None, min_count=5, sort_by='win_rate', ending_only=False)`：
+    連續 n 拍 (1~4) 的球路組合統計 (pd.DataFrame)，欄位 `pattern`, `shot_1`..`shot_n`, `count`, `wins`, `win_rate`,
+    `ending_count` (組合剛好是回合最後 n 拍), `ending_wins`。`player` 為組合第一拍的擊球者，`wins` 表示該球員贏得此回合。
+  - `shot_patterns.pattern_stats(pattern, player=None)`：查詢單一組合，`pattern` 為球種 list，例如 ['長球', '殺球']。"""
+
+
+class ShotPatternIndex:
+    """
+    球路 n-gram 索引
+
+    Attributes:
+        shot_types: 球種名稱陣列，索引即為整數編碼
+        tables: dict，n -> 該長度的組合統計表 (pd.DataFrame)
+    """
+
+    def __init__(self, shot_types, tables):
+        self.shot_types = shot_types
+        self.tables = tables
+
+    def copy(self):
+        """回傳各表皆為副本的 ShotPatternIndex（交給生成的程式碼，避免改動到快取）"""
+        return ShotPatternIndex(self.shot_types.copy(),
+                                {n: table.copy() for n, table in self.tables.items()})
+
+    def top_patterns(self, n=3, player=None, min_count=5, sort_by="win_rate", ending_only=False):
+        """
+        取得連續 n 拍的球路組合排行
+
+        Args:
+            n: 組合長度 (1 ~ MAX_NGRAM)
+            player: 只看由此球員開始的組合；None 代表所有球員合計
+            min_count: 最少出現次數，過濾樣本太少的組合
+            sort_by: 排序欄位 ('win_rate', 'count', 'wins', ...)
+            ending_only: True 時只統計剛好結束回合的組合
+
+        Returns:
+            pd.DataFrame: 組合統計表
+        """
+        if n not in self.tables:
+            raise ValueError(f"n 必須介於 1 與 {MAX_NGRAM} 之間，收到: {n!r}")
+        table = self._select(self.tables[n], player)
+        if ending_only:
+            table = table.assign(count=table["ending_count"], wins=table["ending_wins"])
+            table = table.assign(win_rate=table["wins"] / table["count"].where(table["count"] > 0))
+        table = table[table["count"] >= min_count]
+        return table.sort_values([sort_by, "count"], ascending=False).reset_index(drop=True)
+
+    def next_shot_distribution(self, prev_type, player=None):
+        """
+        某球種之後，對手下一拍的球種分布
+
+        Args:
+            prev_type: 前一拍的球種（例如 '長球'）
+            player: 前一拍的擊球者；None 代表所有球員
+
+        Returns:
+            pd.DataFrame: index 為下一拍球種，欄位 `count`, `share`, `wins`, `win_rate`
+                          (`wins` 為前一拍擊球者最後贏得該回合的次數)
+        """
+        table = self._select(self.tables[2], player)
+        table = table[table["shot_1"] == prev_type]
+        result = table.groupby("shot_2")[["count", "wins"]].sum()
+        result["share"] = result["count"] / result["count"].sum()
+        result["win_rate"] = result["wins"] / result["count"]
+        result.index.name = "next_type"
+        return result.sort_values("count", ascending=False)[["count", "share", "wins", "win_rate"]]
+
+    def pattern_stats(self, pattern, player=None):
+        """
+        查詢單一球路組合的統計
+
+        Args:
+            pattern: 球種序列 (list 或 tuple)
+            player: 組合第一拍的擊球者；None 代表所有球員
+
+        Returns:
+            dict: count, wins, win_rate, ending_count, ending_wins
+        """
+        pattern = list(pattern)
+        n = len(pattern)
+        if n not in self.tables:
+            raise ValueError(f"組合長度必須介於 1 與 {MAX_NGRAM} 之間，收到: {n}")
+        table = self._select(self.tables[n], player)
+        row = table[table["pattern"] == " → ".join(pattern)]
+        count = int(row["count"].sum())
+        wins = int(row["wins"].sum())
+        return {
+            "count": count,
+            "wins": wins,
+            "win_rate": wins / count if count else float("nan"),
+            "ending_count": int(row["ending_count"].sum()),
+            "ending_wins": int(row["ending_wins"].sum()),
+        }
+
+    @staticmethod
+    def _select(table, player):
+        """篩選球員；player 為 None 時將所有球員合計"""
+        if player is not None:
+            return table[table["player"] == player].drop(columns="player")
+        shot_cols = [c for c in table.columns if c.startswith("shot_")]
+        summed = table.groupby(["pattern"] + shot_cols, sort=False)[
+            ["count", "wins", "ending_count", "ending_wins"]
+        ].sum().reset_index()
+        summed["win_rate"] = summed["wins"] / summed["count"]
+        return summed
+
+
+def build_shot_pattern_index(df, max_n=MAX_NGRAM):
+    """
+    建立球路 n-gram 索引（向量化：每個 n 只做一次陣列位移與一次 groupby）
+
+    Args:
+        df: 逐拍資料 DataFrame
+        max_n: 最長的組合長度
+
+    Returns:
+        ShotPatternIndex: 球路索引
+    """
+    shots = df[df["type"].ne(NO_RETURN_TYPE) & df["type"].notna()]
+    shots = shots.sort_values(["rally_id", "ball_round"], kind="mergesort")
+
+    type_codes, shot_types = pd.factorize(shots["type"], sort=True)
+    player_codes, players = pd.factorize(shots["player"], sort=True)
+    rally = shots["rally_id"].to_numpy()
+    player_won = (shots["getpoint_player"] == shots["player"]).to_numpy()
+    # 回合中最後一個實際擊球
+    is_last = np.append(rally[1:] != rally[:-1], True)
+
+    num_types = len(shot_types)
+    tables = {}
+    for n in range(1, max_n + 1):
+        if len(rally) < n:
+            break
+        # 第 i 筆組合 = shots[i : i+n]，必須落在同一回合內
+        start = np.arange(len(rally) - n + 1)
+        end = start + n - 1
+        valid = rally[start] == rally[end]
+        start, end = start[valid], end[valid]
+
+        key = np.zeros(len(start), dtype=np.int64)
+        for j in range(n):
+            key = key * num_types + type_codes[start + j]
+
+        occurrences = pd.DataFrame({
+            "key": key,
+            "player": player_codes[start],
+            "won": player_won[start],
+            "ending": is_last[end],
+        })
+        occurrences["ending_won"] = occurrences["won"] & occurrences["ending"]
+        table = occurrences.groupby(["key", "player"], sort=True).agg(
+            count=("won", "size"),
+            wins=("won", "sum"),
+            ending_count=("ending", "sum"),
+            ending_wins=("ending_won", "sum"),
+        ).reset_index()
+
+        # 將整數編碼還原為球種名稱
+        keys = table["key"].to_numpy()
+        shot_cols = []
+        for j in range(n):
+            digit = (keys // num_types ** (n - 1 - j)) % num_types
+            table[f"shot_{j + 1}"] = np.asarray(shot_types)[digit]
+            shot_cols.append(f"shot_{j + 1}")
+        table["pattern"] = table["shot_1"].str.cat([table[c] for c in shot_cols[1:]], sep=" → ")
+        table["player"] = np.asarray(players)[table["player"].to_numpy()]
+        table["win_rate"] = table["wins"] / table["count"]
+
+        tables[n] = table[["pattern"] + shot_cols + [
+            "player", "count", "wins", "win_rate", "ending_count", "ending_wins"
+        ]]
+
+    return ShotPatternIndex(np.asarray(shot_types), tables)
+
+
+def get_shot_pattern_index(df):
+    """
+    取得（並快取）球路索引；資料集內容不變時直接回傳快取結果
+
+    Args:
+        df: 逐拍資料 DataFrame
+
+    Returns:
+        ShotPatternIndex or None: 若 df 為 None 則回傳 None
+    """
+    if df is None:
+        return None
+    version = get_dataset_version(df)
+    if version not in _PATTERN_INDEX_CACHE:
+        _PATTERN_INDEX_CACHE[version] = build_shot_pattern_index(df)
+    return _PATTERN_INDEX_CACHE[version]
@@ -0,0 +1,78 @@
+"""
+相同請求的合併執行 (single-flight)
+Single-flight coalescing for identical in-flight computations
+
+同一時間有多個相同的請求（例如教練連點兩下、開會時多人同時打開同一個分析）時，
+只有第一個請求 (leader) 真正執行，其他請求等待並共用同一個結果。
+結果不會被快取：執行完畢後該 key 立即移除，下一次請求會重新執行。
+"""
+import threading
+
+
+class _Call:
+    """一個執行中的計算"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    以 key 合併同時進行中的相同計算
+
+    Example:
+        flight = SingleFlight()
+        result, shared = flight.do(key, compute, arg1, arg2)
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self):
+        """目前執行中的 key 數量"""
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        執行 fn(*args, **kwargs)；若相同 key 的計算已在執行中，等待並共用其結果
+
+        Args:
+            key: 可雜湊的請求識別
+            fn: 要執行的函數
+
+        Returns:
+            tuple: (結果, shared)；shared 為 True 代表結果來自其他請求的執行
+
+        Raises:
+            Exception: fn 拋出的例外（所有等待中的請求都會收到同一個例外）
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False